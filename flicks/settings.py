@@ -98,6 +98,15 @@ REST_FRAMEWORK = {
         'rest_framework.filters.SearchFilter',
         'rest_framework.filters.OrderingFilter',
     ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'products.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'products.renderers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 10
 }
@@ -133,6 +142,74 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+# Use a shared Redis cache in production so invalidation reaches every worker
+REDIS_URL = os.getenv("REDIS_URL")
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Seconds a cached product count may be reused before it is recomputed
+PRODUCT_COUNT_CACHE_TIMEOUT = 300
+
+# Seconds between checks for catalog changes made by other workers to the autocomplete index
+SUGGEST_INDEX_REFRESH_INTERVAL = 60
+
+# Seconds a cached trending/top list may be served before it is rebuilt
+FEATURED_CACHE_TIMEOUT = 300
+
+# Seconds FlicksAnalytics counter increments are buffered before being written
+# (0 writes every view through), and the number of pending products that forces a flush
+ANALYTICS_FLUSH_INTERVAL = 5
+ANALYTICS_BUFFER_MAX_PRODUCTS = 500
+
+# Spread each product's FlicksAnalytics increments over this many shard rows (1 disables sharding);
+# run compact_analytics_shards periodically to fold them back
+ANALYTICS_COUNTER_SHARDS = 1
+
+# Start views with a signed token instead of an open ViewSession row; the row is written when the view ends.
+# Tokens older than the max age (seconds) are rejected
+ANALYTICS_SIGNED_SESSIONS = False
+ANALYTICS_SESSION_TOKEN_MAX_AGE = 6 * 3600
+
+# Seconds ended view sessions are left to settle before rollup_view_sessions aggregates them
+ANALYTICS_ROLLUP_LAG = 60
+
+# Days view sessions are kept before prune_view_sessions archives them to gzip'd NDJSON
+# under this prefix of the default storage and removes them
+ANALYTICS_SESSION_RETENTION_DAYS = 90
+ANALYTICS_ARCHIVE_PREFIX = 'analytics/archive/view_sessions/'
+
+# Seconds product analytics reports and leaderboards are cached for (they are
+# also rebuilt whenever rollup_view_sessions advances)
+ANALYTICS_REPORT_CACHE_TIMEOUT = 60
+
+# Append view-tracking events to local segment files instead of writing them to the database;
+# load_analytics_spool loads closed segments. Segments close at the size (bytes) or age (seconds)
+# limit, and are fsync'd every FSYNC_EVERY events or FSYNC_INTERVAL seconds
+ANALYTICS_SPOOL_ENABLED = False
+ANALYTICS_SPOOL_DIR = BASE_DIR / 'var' / 'analytics-spool'
+ANALYTICS_SPOOL_SEGMENT_BYTES = 8 * 1024 * 1024
+ANALYTICS_SPOOL_SEGMENT_SECONDS = 60
+ANALYTICS_SPOOL_FSYNC_EVERY = 100
+ANALYTICS_SPOOL_FSYNC_INTERVAL = 1
+
+# Hours after which a view's contribution to a product's trending score has halved;
+# compute_trending updates the scores and the ranked snapshot the trending list is read from
+ANALYTICS_TRENDING_HALF_LIFE_HOURS = 24
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
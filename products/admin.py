@@ -11,7 +11,9 @@ from .models import (
     ProductGallery, FeaturedProduct, FlicksAnalytics, ViewSession
 )
 from django.utils.safestring import mark_safe
-from django.db import models 
+from django.db import models, transaction
+from . import rollups
+from .devices import device_breakdown
 
 def setup_groups():
     staff_group, created = Group.objects.get_or_create(name='Staff')
@@ -112,31 +114,34 @@ class ManufacturerAdmin(admin.ModelAdmin):
                 else:
                     data = pd.read_excel(uploaded_file).to_dict('records')
 
-                for row in data:
-                    original_age = row['Age Group']
-                    standardized_age = standardize_age(original_age)
+                # One transaction: the featured lists are rebuilt once for the whole
+                # import rather than after every product, and a bad row imports nothing
+                with transaction.atomic():
+                    for row in data:
+                        original_age = row['Age Group']
+                        standardized_age = standardize_age(original_age)
 
-                    # Map gender display value to database value
-                    gender_value = row['Gender']
-                    if gender_value.lower() == 'unisex':
-                        gender_value = 'U'
-                    elif gender_value.lower() == 'male':
-                        gender_value = 'M'
-                    elif gender_value.lower() == 'female':
-                        gender_value = 'F'
-                    else:
-                        gender_value = 'U'  # Default to unisex
+                        # Map gender display value to database value
+                        gender_value = row['Gender']
+                        if gender_value.lower() == 'unisex':
+                            gender_value = 'U'
+                        elif gender_value.lower() == 'male':
+                            gender_value = 'M'
+                        elif gender_value.lower() == 'female':
+                            gender_value = 'F'
+                        else:
+                            gender_value = 'U'  # Default to unisex
                     
-                    Product.objects.create(
-                        manufacturer=manufacturer,
-                        title=row['Title'],
-                        product_category=row['Product Category'],
-                        age_group=original_age, 
-                        standardized_age=standardized_age,
-                        brand=row['Brand'],
-                        gender=gender_value, 
-                        description=row['SEO Description']
-                    )
+                        Product.objects.create(
+                            manufacturer=manufacturer,
+                            title=row['Title'],
+                            product_category=row['Product Category'],
+                            age_group=original_age, 
+                            standardized_age=standardized_age,
+                            brand=row['Brand'],
+                            gender=gender_value, 
+                            description=row['SEO Description']
+                        )
                 
                 self.message_user(request, "File imported successfully")
             except Exception as e:
@@ -167,38 +172,35 @@ class ProductAdmin(admin.ModelAdmin):
     readonly_fields = ('analytics_panel',)  # Remove image_preview and video_preview
     inlines = [ProductGalleryInline]  # Replace ProductImageInline with ProductGalleryInline
 
+    def get_queryset(self, request):
+        # The changelist columns below come from these annotations, not a query per row
+        return super().get_queryset(request).with_counters().annotate(
+            has_gallery=models.Exists(ProductGallery.objects.filter(product=models.OuterRef('pk')))
+        )
+
     def has_media(self, obj):
         """Check if product has any media (images or videos)"""
-        has_gallery = obj.gallery.exists()
-        return bool(has_gallery or obj.flicks)
+        return bool(obj.has_gallery or obj.flicks)
     has_media.boolean = True
     
     def view_count(self, obj):
         """Display view count in admin list view"""
-        try:
-            analytics = FlicksAnalytics.objects.get(product=obj)
-            return analytics.views
-        except FlicksAnalytics.DoesNotExist:
-            return 0
+        return obj.analytics_views
     view_count.short_description = 'Views'
     
     def total_watch_time_display(self, obj):
         """Display formatted watch time in admin list view"""
-        try:
-            analytics = FlicksAnalytics.objects.get(product=obj)
-            seconds = analytics.total_watch_time
-            if seconds > 3600:
-                hours = seconds // 3600
-                minutes = (seconds % 3600) // 60
-                return f"{hours}h {minutes}m"
-            elif seconds > 60:
-                minutes = seconds // 60
-                secs = seconds % 60
-                return f"{minutes}m {secs}s"
-            else:
-                return f"{seconds}s"
-        except FlicksAnalytics.DoesNotExist:
-            return "0s"
+        seconds = obj.analytics_watch_time
+        if seconds > 3600:
+            hours = seconds // 3600
+            minutes = (seconds % 3600) // 60
+            return f"{hours}h {minutes}m"
+        elif seconds > 60:
+            minutes = seconds // 60
+            secs = seconds % 60
+            return f"{minutes}m {secs}s"
+        else:
+            return f"{seconds}s"
     total_watch_time_display.short_description = 'Watch Time'
     
     def analytics_panel(self, obj):
@@ -210,19 +212,33 @@ class ProductAdmin(admin.ModelAdmin):
             return mark_safe('<p>No video available for this product.</p>')
         
         try:
-            analytics, created = FlicksAnalytics.objects.get_or_create(product=obj)
+            # Includes counts not yet compacted out of shard rows
+            analytics = FlicksAnalytics.for_product(obj)
             
             # Calculate average time per view
             avg_time = 0
             if analytics.views > 0:
                 avg_time = round(analytics.total_watch_time / analytics.views)
             
-            # Calculate completion rate
-            completion_rate = 0
-            total_sessions = ViewSession.objects.filter(product=obj).count()
-            if total_sessions > 0:
-                completed_sessions = ViewSession.objects.filter(product=obj, completed=True).count()
-                completion_rate = round((completed_sessions / total_sessions) * 100, 2)
+            # Completion rate and per-day numbers come from the rollup tables
+            completion_rate = rollups.completion_rate(obj)
+            daily_rows = ''.join(
+                f"""
+                    <tr>
+                        <td style="padding: 8px; border-bottom: 1px solid #ddd;">{day['bucket']:%b %d}</td>
+                        <td style="text-align: right; padding: 8px; border-bottom: 1px solid #ddd;">{day['views']}</td>
+                        <td style="text-align: right; padding: 8px; border-bottom: 1px solid #ddd;">{day['completions']}</td>
+                    </tr>"""
+                for day in rollups.daily_totals(obj, days=7)
+            )
+            device_rows = ''.join(
+                f"""
+                    <tr>
+                        <td style="padding: 8px; border-bottom: 1px solid #ddd;">{row['device__form_factor'].title()}</td>
+                        <td style="text-align: right; padding: 8px; border-bottom: 1px solid #ddd;">{row['sessions']}</td>
+                    </tr>"""
+                for row in device_breakdown(obj.view_sessions.all())
+            )
             
             # Format watch time
             total_time = analytics.total_watch_time
@@ -268,6 +284,21 @@ class ProductAdmin(admin.ModelAdmin):
                         <td style="text-align: right; padding: 8px; border-bottom: 1px solid #ddd;">{completion_rate}%</td>
                     </tr>
                 </table>
+                <h4>Last 7 Days</h4>
+                <table style="width: 100%; border-collapse: collapse;">
+                    <tr>
+                        <th style="text-align: left; padding: 8px; border-bottom: 1px solid #ddd;">Day</th>
+                        <th style="text-align: right; padding: 8px; border-bottom: 1px solid #ddd;">Views</th>
+                        <th style="text-align: right; padding: 8px; border-bottom: 1px solid #ddd;">Completions</th>
+                    </tr>{daily_rows}
+                </table>
+                <h4>Sessions by Device</h4>
+                <table style="width: 100%; border-collapse: collapse;">
+                    <tr>
+                        <th style="text-align: left; padding: 8px; border-bottom: 1px solid #ddd;">Device</th>
+                        <th style="text-align: right; padding: 8px; border-bottom: 1px solid #ddd;">Sessions</th>
+                    </tr>{device_rows}
+                </table>
             </div>
             """
             return mark_safe(html)
@@ -419,21 +450,23 @@ class FeaturedProductAdmin(admin.ModelAdmin):
         trending_ids = [id for id in trending_ids if id]
         top_ids = [id for id in top_ids if id]
         
-        FeaturedProduct.objects.all().delete()
-        
-        for i, product_id in enumerate(trending_ids):
-            FeaturedProduct.objects.create(
-                product_id=product_id,
-                featured_type='trending',
-                display_order=i
-            )
+        # One transaction, so the cached featured lists are rebuilt once on commit
+        with transaction.atomic():
+            FeaturedProduct.objects.all().delete()
             
-        for i, product_id in enumerate(top_ids):
-            FeaturedProduct.objects.create(
-                product_id=product_id,
-                featured_type='top',
-                display_order=i
-            )
+            for i, product_id in enumerate(trending_ids):
+                FeaturedProduct.objects.create(
+                    product_id=product_id,
+                    featured_type='trending',
+                    display_order=i
+                )
+                
+            for i, product_id in enumerate(top_ids):
+                FeaturedProduct.objects.create(
+                    product_id=product_id,
+                    featured_type='top',
+                    display_order=i
+                )
             
         self.message_user(request, 'Featured products updated successfully.')
         return redirect('admin:products_featuredproduct_changelist')
\ No newline at end of file
@@ -1,10 +1,17 @@
 from django.http import JsonResponse
 from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.permissions import IsAdminUser, AllowAny
 from rest_framework.response import Response
 from rest_framework import status
+from django.db import DatabaseError
 from django.utils import timezone
 from .models import Product, ViewSession, FlicksAnalytics
+from . import analytics_buffer, analytics_reports, event_spool, rollups
+from .devices import request_device_id
+from .analytics_events import MAX_EVENTS, InvalidEvent, counts_as_view, is_completed, process_events, validate_event
+from .session_tokens import InvalidSessionToken, RequestTokens, is_token, issue_token, read_token, signed_sessions_enabled
+from .unique_viewers import estimate, session_viewer, viewer_sketch
+from .watch_histograms import to_number, watch_stats
 from django.db.models import Sum, Avg, Count
 import uuid
 
@@ -17,6 +24,9 @@ def start_view_session(request):
     if not product_id:
         return Response({"error": "Product ID is required"}, status=status.HTTP_400_BAD_REQUEST)
     
+    if event_spool.spool_enabled() and not signed_sessions_enabled():
+        return start_spooled_view_session(request, product_id)
+    
     try:
         product = Product.objects.get(id=product_id)
     except Product.DoesNotExist:
@@ -26,6 +36,15 @@ def start_view_session(request):
     if not product.flicks:
         return Response({"error": "This product has no video"}, status=status.HTTP_400_BAD_REQUEST)
     
+    if signed_sessions_enabled():
+        # Nothing is written until the view ends; the token carries the session
+        start_time = timezone.now()
+        return Response({
+            "session_id": issue_token(product, request, start_time),
+            "start_time": start_time,
+            "product_duration": product.video_duration or 30
+        }, status=status.HTTP_201_CREATED)
+    
     # Generate unique session ID
     session_id = str(uuid.uuid4())
     
@@ -35,7 +54,7 @@ def start_view_session(request):
         user=request.user if request.user.is_authenticated else None,
         session_id=session_id,
         ip_address=get_client_ip(request),
-        device_info=get_device_info(request),
+        device_id=request_device_id(request),
     )
     
     # Do not increment view count yet - we'll do that on end_view_session
@@ -58,29 +77,74 @@ def end_view_session(request):
     if not session_id:
         return Response({"error": "Session ID is required"}, status=status.HTTP_400_BAD_REQUEST)
     
+    if event_spool.spool_enabled():
+        return end_spooled_view_session(request, session_id, watch_duration, percent_watched)
+    
+    if is_token(session_id):
+        return end_signed_view_session(request, session_id, watch_duration, percent_watched)
+    
     try:
         session = ViewSession.objects.get(session_id=session_id, end_time=None)
     except ViewSession.DoesNotExist:
         return Response({"error": "Active session not found"}, status=status.HTTP_404_NOT_FOUND)
     
     # Record end time
-    session.end_time = timezone.now()
+    session.end_time = session.recorded_at = timezone.now()
     session.duration = watch_duration
     
     # Consider it completed if watched over 80%
-    session.completed = percent_watched >= 80
+    session.completed = is_completed(percent_watched)
     session.save()
+    analytics_buffer.record_watch(session.product_id, to_number(watch_duration), to_number(percent_watched))
     
     # Only count as a view if watched at least 3 seconds or 25% of the video
-    product_duration = getattr(session.product, 'video_duration', 30) or 30
-    min_view_duration = min(3, product_duration * 0.25)
+    if counts_as_view(watch_duration, session.product.video_duration):
+        # Count as a view; buffered and written to FlicksAnalytics in batches
+        analytics_buffer.record_view(
+            session.product_id, int(watch_duration), viewer=session_viewer(session, request.META.get('HTTP_USER_AGENT', ''))
+        )
+    
+    return Response({
+        "status": "success",
+        "duration": watch_duration,
+        "completed": session.completed
+    })
+
+def end_signed_view_session(request, token, watch_duration, percent_watched):
+    """End a view started with a signed token by inserting its completed session"""
+    try:
+        payload = read_token(token, request)
+    except InvalidSessionToken as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
     
-    if watch_duration >= min_view_duration:
-        # Update analytics - count as a view
-        analytics, created = FlicksAnalytics.objects.get_or_create(product=session.product)
-        analytics.views += 1
-        analytics.total_watch_time += watch_duration
-        analytics.save()
+    product = Product.objects.filter(pk=payload['product']).only('id', 'video_duration').first()
+    if product is None:
+        return Response({"error": "Product not found"}, status=status.HTTP_404_NOT_FOUND)
+    
+    # A token ends one view; a repeated (or concurrent) end finds the session already there
+    now = timezone.now()
+    session, created = ViewSession.objects.get_or_create(
+        session_id=payload['session'],
+        defaults={
+            'product': product,
+            'user_id': payload['user'],
+            'ip_address': get_client_ip(request),
+            'device_id': request_device_id(request),
+            'start_time': payload['start'],
+            'end_time': now,
+            'recorded_at': now,
+            'duration': watch_duration,
+            'completed': is_completed(percent_watched),
+        }
+    )
+    if not created:
+        return Response({"error": "Active session not found"}, status=status.HTTP_404_NOT_FOUND)
+    analytics_buffer.record_watch(product.id, to_number(watch_duration), to_number(percent_watched))
+    
+    if counts_as_view(watch_duration, product.video_duration):
+        analytics_buffer.record_view(
+            product.id, int(watch_duration), viewer=session_viewer(session, request.META.get('HTTP_USER_AGENT', ''))
+        )
     
     return Response({
         "status": "success",
@@ -88,7 +152,176 @@ def end_view_session(request):
         "completed": session.completed
     })
 
+def start_spooled_view_session(request, product_id):
+    """Start a view by appending its start event to the spool; the loader creates the session"""
+    try:
+        product_id = int(product_id)
+    except (TypeError, ValueError):
+        return Response({"error": "Product not found"}, status=status.HTTP_404_NOT_FOUND)
+    
+    try:
+        product = Product.objects.only('id', 'flicks', 'video_duration').filter(id=product_id).first()
+    except DatabaseError:
+        # Accept the view anyway; the loader skips it if the product doesn't exist
+        product_duration = 30
+    else:
+        if product is None:
+            return Response({"error": "Product not found"}, status=status.HTTP_404_NOT_FOUND)
+        if not product.flicks:
+            return Response({"error": "This product has no video"}, status=status.HTTP_400_BAD_REQUEST)
+        product_duration = product.video_duration or 30
+    
+    start_time = timezone.now()
+    session_id = str(uuid.uuid4())
+    event_spool.append(event_spool.request_record(
+        request, [{'type': 'start', 'product_id': product_id, 'session_id': session_id}], at=start_time
+    ))
+    return Response({
+        "session_id": session_id,
+        "start_time": start_time,
+        "product_duration": product_duration
+    }, status=status.HTTP_201_CREATED)
+
+def end_spooled_view_session(request, session_id, watch_duration, percent_watched):
+    """End a view by appending its end event (and, for a signed token, its start) to the spool"""
+    records = []
+    if is_token(session_id):
+        try:
+            payload = read_token(session_id, request)
+        except InvalidSessionToken as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        session_id = payload['session']
+        start = event_spool.request_record(
+            request, [{'type': 'start', 'product_id': payload['product'], 'session_id': session_id}], at=payload['start']
+        )
+        start['user_id'] = payload['user']
+        records.append(start)
+    
+    try:
+        end = validate_event({
+            'type': 'end', 'session_id': session_id, 'duration': watch_duration, 'percent_watched': percent_watched
+        })
+    except InvalidEvent as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    records.append(event_spool.request_record(request, [end]))
+    event_spool.append(*records)
+    
+    return Response({
+        "status": "success",
+        "duration": watch_duration,
+        "completed": is_completed(end['percent_watched'])
+    })
+
+@api_view(['POST'])
+@permission_classes([AllowAny])
+def record_events(request):
+    """Record a batch of start/heartbeat/end view events"""
+    events = request.data.get('events') if isinstance(request.data, dict) else None
+    
+    if not isinstance(events, list) or not events:
+        return Response({"error": "Provide a non-empty list of events"}, status=status.HTTP_400_BAD_REQUEST)
+    if len(events) > MAX_EVENTS:
+        return Response({"error": f"At most {MAX_EVENTS} events can be sent at once"}, status=status.HTTP_400_BAD_REQUEST)
+    
+    if event_spool.spool_enabled():
+        return Response({"results": event_spool.spool_events(request, events)})
+    
+    results = process_events(
+        events,
+        user=request.user if request.user.is_authenticated else None,
+        ip_address=get_client_ip(request),
+        device_id=request_device_id(request),
+        user_agent=request.META.get('HTTP_USER_AGENT', ''),
+        tokens=RequestTokens(request),
+    )
+    return Response({"results": results})
+
+MAX_UNIQUE_VIEWER_DAYS = 365
+
+# The reports below cover every product, and products aren't owned by a shop,
+# so they are for staff only (any shop user can register themselves)
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def unique_viewers(request):
+    """Estimated distinct viewers of some or all products, all-time or over the last N days"""
+    try:
+        product_ids = parse_product_ids(request)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    days = request.query_params.get('days')
+    if days is not None:
+        try:
+            days = int(days)
+        except ValueError:
+            days = 0
+        if not 1 <= days <= MAX_UNIQUE_VIEWER_DAYS:
+            return Response(
+                {"error": f"days must be between 1 and {MAX_UNIQUE_VIEWER_DAYS}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+    
+    return Response({
+        "product_ids": product_ids,
+        "days": days,
+        **estimate(viewer_sketch(product_ids, days)),
+    })
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def watch_retention(request):
+    """Watch-time percentiles and drop-off curves of some or all products"""
+    try:
+        product_ids = parse_product_ids(request)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    return Response({"product_ids": product_ids, **watch_stats(product_ids)})
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def product_analytics(request, product_id):
+    """Totals, completion rate, unique viewers and a time series of one product's views"""
+    try:
+        product = Product.objects.only('id', 'title').get(id=product_id)
+    except Product.DoesNotExist:
+        return Response({"error": "Product not found"}, status=status.HTTP_404_NOT_FOUND)
+    
+    try:
+        report = analytics_reports.product_report(product, request.query_params.get('window', '7d'))
+    except analytics_reports.InvalidReport as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(report)
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def analytics_leaderboard(request):
+    """Top products by views, watch time, completions, sessions or completion rate over a window"""
+    try:
+        limit = int(request.query_params.get('limit', 10))
+    except ValueError:
+        return Response({"error": "limit must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+    
+    try:
+        board = analytics_reports.leaderboard(
+            metric=request.query_params.get('metric', 'views'),
+            window=request.query_params.get('window', '7d'),
+            limit=limit,
+        )
+    except analytics_reports.InvalidReport as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(board)
+
 # Helper functions
+def parse_product_ids(request):
+    """Product ids from ?ids=1,2,3, or None for all products"""
+    ids = [value for param in request.query_params.getlist('ids') for value in param.split(',') if value.strip()]
+    try:
+        return [int(product_id) for product_id in ids] or None
+    except ValueError:
+        raise ValueError("Product ids must be integers")
+
 def get_client_ip(request):
     x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
     if x_forwarded_for:
@@ -97,22 +330,9 @@ def get_client_ip(request):
         ip = request.META.get('REMOTE_ADDR')
     return ip
 
-def get_device_info(request):
-    user_agent = request.META.get('HTTP_USER_AGENT', '')
-    return {
-        'user_agent': user_agent
-    }
-
 def get_completion_rate(product):
-    """Calculate percentage of views that were completed"""
-    sessions = ViewSession.objects.filter(product=product)
-    total_sessions = sessions.count()
-    
-    if total_sessions == 0:
-        return 0
-    
-    completed_sessions = sessions.filter(completed=True).count()
-    return round((completed_sessions / total_sessions) * 100, 2)
+    """Calculate percentage of views that were completed (from the daily rollups)"""
+    return rollups.completion_rate(product)
 
 def format_time(seconds):
     """Format seconds into human-readable time"""
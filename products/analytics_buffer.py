@@ -0,0 +1,237 @@
+"""
+Write-behind buffer for FlicksAnalytics counters.
+
+View and watch-time increments are summed per product in process and written
+in one flush: missing rows are created with a single bulk insert, then each
+product gets one atomic F() update. A flush happens ANALYTICS_FLUSH_INTERVAL
+seconds after the first buffered increment, as soon as more than
+ANALYTICS_BUFFER_MAX_PRODUCTS products are pending, and when the process
+exits. Counters read from the database lag by at most the flush interval;
+an interval of 0 writes every increment through immediately.
+
+With ANALYTICS_COUNTER_SHARDS > 1, increments go to one of that many
+FlicksAnalyticsShard rows per product instead of the FlicksAnalytics row.
+
+Views can carry their viewer, which is buffered alongside and merged into
+the unique-viewer sketches on flush (see unique_viewers). Ended sessions are
+buffered the same way for the watch-retention histograms (see
+watch_histograms), whether or not they counted as a view.
+"""
+import atexit
+import logging
+import random
+import threading
+from collections import defaultdict
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from .models import Product, FlicksAnalytics, FlicksAnalyticsShard
+from .unique_viewers import write_viewers
+from .watch_histograms import write_histograms
+
+logger = logging.getLogger(__name__)
+
+
+def flush_interval():
+    return getattr(settings, 'ANALYTICS_FLUSH_INTERVAL', 5)
+
+
+def max_pending_products():
+    return getattr(settings, 'ANALYTICS_BUFFER_MAX_PRODUCTS', 500)
+
+
+def counter_shards():
+    return getattr(settings, 'ANALYTICS_COUNTER_SHARDS', 1)
+
+
+def write_increments(increments, viewers=None, watched=None):
+    """
+    Apply {product id: [views, watch seconds]} to FlicksAnalytics, or to its
+    shards, {(product id, hour): viewer hashes} to the viewer sketches and
+    {product id: [(seconds, percent), ...]} to the watch histograms.
+
+    Everything is written in one transaction: a failed flush is put back in the
+    buffer, so none of it may have been applied.
+    """
+    with transaction.atomic():
+        product_ids = set(Product.objects.filter(pk__in=increments).values_list('pk', flat=True))
+        # Products with only uncounted sessions have nothing to add to the counters
+        counted_ids = {product_id for product_id in product_ids if any(increments[product_id])}
+        if counter_shards() > 1:
+            write_shard_increments(increments, counted_ids)
+        else:
+            write_canonical_increments(increments, counted_ids)
+        if viewers:
+            write_viewers(viewers, product_ids)
+        if watched:
+            write_histograms(watched, product_ids)
+
+
+def write_canonical_increments(increments, product_ids):
+    now = timezone.now()
+    with transaction.atomic():
+        FlicksAnalytics.objects.bulk_create(
+            [FlicksAnalytics(product_id=product_id) for product_id in product_ids],
+            ignore_conflicts=True
+        )
+        for product_id in sorted(product_ids):
+            views, watch_time = increments[product_id]
+            FlicksAnalytics.objects.filter(product_id=product_id).update(
+                views=F('views') + views,
+                total_watch_time=F('total_watch_time') + watch_time,
+                updated_at=now
+            )
+
+
+def write_shard_increments(increments, product_ids):
+    """Add each product's increments to one randomly chosen shard row"""
+    shards = {product_id: random.randrange(counter_shards()) for product_id in product_ids}
+    now = timezone.now()
+    with transaction.atomic():
+        FlicksAnalyticsShard.objects.bulk_create(
+            [FlicksAnalyticsShard(product_id=product_id, shard=shard) for product_id, shard in shards.items()],
+            ignore_conflicts=True
+        )
+        for product_id in sorted(product_ids):
+            views, watch_time = increments[product_id]
+            FlicksAnalyticsShard.objects.filter(product_id=product_id, shard=shards[product_id]).update(
+                views=F('views') + views,
+                total_watch_time=F('total_watch_time') + watch_time,
+                updated_at=now
+            )
+
+
+
+def compact_shards(product_ids):
+    """
+    Move the shard counts of these products into their FlicksAnalytics rows.
+
+    Shard rows are decremented rather than deleted, so increments that land on
+    them while compacting are kept.
+    """
+    with transaction.atomic():
+        shards = list(
+            FlicksAnalyticsShard.objects.select_for_update()
+            .filter(product_id__in=product_ids)
+            .exclude(views=0, total_watch_time=0)
+            .values_list('id', 'product_id', 'views', 'total_watch_time')
+        )
+        totals = defaultdict(lambda: [0, 0])
+        for _, product_id, views, watch_time in shards:
+            totals[product_id][0] += views
+            totals[product_id][1] += watch_time
+        if not totals:
+            return 0
+
+        write_canonical_increments(totals, totals.keys())
+        for shard_id, _, views, watch_time in shards:
+            FlicksAnalyticsShard.objects.filter(id=shard_id).update(
+                views=F('views') - views,
+                total_watch_time=F('total_watch_time') - watch_time
+            )
+    return len(totals)
+
+
+class CounterBuffer:
+    def __init__(self, autoflush=True):
+        # Without autoflush, increments are only written by an explicit flush()
+        self._autoflush = autoflush
+        self._lock = threading.Lock()
+        # Only one flush writes at a time, so increments to a row are never reordered
+        self._flush_lock = threading.Lock()
+        self._pending = defaultdict(lambda: [0, 0])
+        self._viewers = defaultdict(set)
+        self._watched = defaultdict(list)
+        self._timer = None
+
+    def add(self, product_id, views=1, watch_time=0, viewers=(), watched=()):
+        """
+        Buffer increments, the (start hour, viewer hash) pairs of the views and
+        the (seconds, percent) watched of ended sessions
+        """
+        with self._lock:
+            counters = self._pending[product_id]
+            counters[0] += views
+            counters[1] += watch_time
+            for hour, viewer in viewers:
+                self._viewers[(product_id, hour)].add(viewer)
+            self._watched[product_id].extend(watched)
+            size = len(self._pending)
+
+        if not self._autoflush:
+            return
+        if flush_interval() <= 0 or size > max_pending_products():
+            self.flush()
+        else:
+            self._schedule()
+
+    def flush(self):
+        """Write everything buffered so far; returns the number of products written"""
+        with self._flush_lock:
+            with self._lock:
+                increments, self._pending = self._pending, defaultdict(lambda: [0, 0])
+                viewers, self._viewers = self._viewers, defaultdict(set)
+                watched, self._watched = self._watched, defaultdict(list)
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            if not increments:
+                return 0
+            try:
+                write_increments(increments, viewers, watched)
+            except Exception:
+                # Keep the increments for the next flush rather than losing them
+                with self._lock:
+                    for product_id, (views, watch_time) in increments.items():
+                        self._pending[product_id][0] += views
+                        self._pending[product_id][1] += watch_time
+                    for key, hashes in viewers.items():
+                        self._viewers[key] |= hashes
+                    for product_id, pairs in watched.items():
+                        self._watched[product_id].extend(pairs)
+                raise
+            return len(increments)
+
+    def _schedule(self):
+        with self._lock:
+            if self._timer is not None:
+                return
+            self._timer = threading.Timer(flush_interval(), self._timed_flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _timed_flush(self):
+        with self._lock:
+            self._timer = None
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Error flushing analytics counters")
+            self._schedule()
+        finally:
+            connection.close()
+
+
+buffer = CounterBuffer()
+
+
+def record_view(product_id, watch_time, viewer=None):
+    buffer.add(product_id, views=1, watch_time=watch_time, viewers=[viewer] if viewer else ())
+
+
+def record_watch(product_id, seconds, percent):
+    """Buffer an ended session for the watch-retention histograms"""
+    buffer.add(product_id, views=0, watched=[(seconds, percent)])
+
+
+def flush():
+    return buffer.flush()
+
+
+@atexit.register
+def _flush_on_exit():
+    try:
+        flush()
+    except Exception:
+        logger.exception("Error flushing analytics counters on shutdown")
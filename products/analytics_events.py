@@ -0,0 +1,289 @@
+"""
+Batched view-tracking events.
+
+A client sends the start, heartbeat and end events of many flick views in one
+request. Events are validated up front, new sessions are inserted with one
+bulk_create, touched sessions are saved with one bulk_update, and the view
+counts they produce are summed per product before reaching FlicksAnalytics.
+
+Retries are safe: sessions are keyed by a client-generated session_id (unique
+in ViewSession), a repeated start finds its session already there, heartbeats
+only ever raise the recorded duration, and an end for a session that has
+already ended is reported but not counted again. When two copies of a batch
+run concurrently, the one whose insert conflicts starts over and finds the
+other's sessions.
+
+With signed sessions enabled, starts write nothing and get a signed token as
+their session_id (see session_tokens). Heartbeats of a token are acknowledged
+without a write, and its end inserts the completed session.
+"""
+import uuid
+from collections import defaultdict
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from .models import Product, ViewSession
+from . import analytics_buffer
+from .session_tokens import InvalidSessionToken, is_token, signed_sessions_enabled
+from .unique_viewers import session_viewer
+from .watch_histograms import to_number
+
+EVENT_TYPES = ('start', 'heartbeat', 'end')
+
+MAX_EVENTS = 500
+
+MAX_SESSION_ID_LENGTH = 100
+
+# Signed session tokens are longer than the ids clients generate
+MAX_TOKEN_LENGTH = 1000
+
+# A view counts once this many seconds (or a quarter of a shorter video) were watched
+MIN_VIEW_SECONDS = 3
+
+# Share of the video that makes a view complete
+COMPLETION_PERCENT = 80
+
+
+def counts_as_view(duration, video_duration):
+    return duration >= min(MIN_VIEW_SECONDS, (video_duration or 30) * 0.25)
+
+
+def is_completed(percent_watched):
+    return percent_watched >= COMPLETION_PERCENT
+
+
+class InvalidEvent(ValueError):
+    pass
+
+
+def _number(event, key, maximum=None):
+    value = event.get(key, 0)
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+        raise InvalidEvent(f"{key} must be a non-negative number")
+    if maximum is not None and value > maximum:
+        raise InvalidEvent(f"{key} must be at most {maximum}")
+    return value
+
+
+def validate_event(event):
+    """Normalized copy of one event, or InvalidEvent"""
+    if not isinstance(event, dict):
+        raise InvalidEvent("Event must be an object")
+    event_type = event.get('type')
+    if event_type not in EVENT_TYPES:
+        raise InvalidEvent(f"type must be one of: {', '.join(EVENT_TYPES)}")
+
+    session_id = event.get('session_id')
+    max_length = MAX_TOKEN_LENGTH if is_token(session_id) else MAX_SESSION_ID_LENGTH
+    if session_id is not None and (not isinstance(session_id, str) or not 0 < len(session_id) <= max_length):
+        raise InvalidEvent(f"session_id must be a string of at most {MAX_SESSION_ID_LENGTH} characters")
+
+    if event_type == 'start':
+        product_id = event.get('product_id')
+        if isinstance(product_id, bool) or not isinstance(product_id, int):
+            raise InvalidEvent("product_id is required")
+        if is_token(session_id):
+            raise InvalidEvent("session_id of a start can't be a signed session token")
+        return {'type': 'start', 'product_id': product_id, 'session_id': session_id}
+
+    if not session_id:
+        raise InvalidEvent("session_id is required")
+    return {
+        'type': event_type,
+        'session_id': session_id,
+        'duration': _number(event, 'duration'),
+        'percent_watched': _number(event, 'percent_watched', maximum=100),
+    }
+
+
+def read_signed_event(event, tokens):
+    """Verify the token an event has as its session_id; returns the event keyed by the token's session"""
+    if tokens is None:
+        raise InvalidEvent("Signed session tokens can't be used here")
+    try:
+        payload = tokens.read(event['session_id'])
+    except InvalidSessionToken as e:
+        raise InvalidEvent(str(e))
+    return {**event, 'session_id': payload['session'], 'token': event['session_id'], 'signed': payload}
+
+
+def process_events(events, user=None, ip_address=None, device_id=None, now=None, counter_buffer=None, tokens=None,
+                   user_agent=None):
+    """
+    Apply a batch of events; returns one result dict per event, in order.
+
+    `now` is when the events happened (when replaying spooled events), and
+    `counter_buffer` the CounterBuffer their view counts go to. `tokens` (a
+    session_tokens.RequestTokens) reads signed tokens sent as session ids and
+    issues them for starts; without it, tokens are rejected. `user_agent` is
+    the raw user agent anonymous viewers are identified by.
+    """
+    now = now or timezone.now()
+    counter_buffer = counter_buffer or analytics_buffer.buffer
+    results = [None] * len(events)
+    valid = []
+    for index, event in enumerate(events):
+        try:
+            event = validate_event(event)
+            if is_token(event['session_id']):
+                event = read_signed_event(event, tokens)
+            valid.append((index, event))
+        except InvalidEvent as e:
+            results[index] = {'index': index, 'status': 'error', 'error': str(e)}
+
+    increments = defaultdict(lambda: [0, 0])
+    viewers = defaultdict(list)
+    watched = defaultdict(list)
+    issue = tokens.issue if tokens is not None and signed_sessions_enabled() else None
+    with transaction.atomic():
+        sessions = _start_sessions(valid, results, user, ip_address, device_id, now, issue)
+        _apply_session_events(valid, results, sessions, increments, viewers, watched, now, user_agent)
+
+    # Buffered only once the sessions are committed
+    for product_id in increments.keys() | watched.keys():
+        views, watch_time = increments.get(product_id, (0, 0))
+        counter_buffer.add(
+            product_id, views=views, watch_time=watch_time,
+            viewers=viewers[product_id], watched=watched[product_id]
+        )
+    return results
+
+
+def _start_sessions(valid, results, user, ip_address, device_id, now, issue=None):
+    """
+    Insert sessions for new start events and for ends of signed sessions (or,
+    with `issue`, give starts a token instead); returns the sessions the batch
+    refers to by session_id
+    """
+    starts = [(index, event) for index, event in valid if event['type'] == 'start']
+    for index, event in starts:
+        if not event['session_id'] and not issue:
+            # Without a client session id a start can't be recognised on retry
+            event['session_id'] = str(uuid.uuid4())
+
+    try:
+        with transaction.atomic():
+            return _insert_sessions(valid, starts, results, user, ip_address, device_id, now, issue)
+    except IntegrityError:
+        # A concurrent copy of this batch inserted some of the sessions first. Its
+        # transaction has committed by now, so a second pass finds them as duplicates.
+        return _insert_sessions(valid, starts, results, user, ip_address, device_id, now, issue)
+
+
+def _insert_sessions(valid, starts, results, user, ip_address, device_id, now, issue):
+    signed_ends = [(index, event) for index, event in valid if event['type'] == 'end' and 'signed' in event]
+    session_ids = {event['session_id'] for _, event in valid if event['session_id']}
+    sessions = {}
+    # Locked so that concurrent retries of a batch can't close a session twice
+    for session in (
+        ViewSession.objects.select_for_update(of=('self',))
+        .filter(session_id__in=session_ids)
+        .select_related('product')
+        .order_by('id')
+    ):
+        sessions[session.session_id] = session
+
+    product_ids = {event['product_id'] for _, event in starts} | {event['signed']['product'] for _, event in signed_ends}
+    products = Product.objects.filter(pk__in=product_ids).only('id', 'flicks', 'video_duration').in_bulk()
+
+    new_sessions = []
+    for index, event in starts:
+        session_id = event['session_id']
+        product = products.get(event['product_id'])
+        if session_id in sessions:
+            results[index] = {'index': index, 'status': 'duplicate', 'session_id': session_id}
+        elif product is None:
+            results[index] = {'index': index, 'status': 'error', 'error': 'Product not found'}
+        elif not product.flicks:
+            results[index] = {'index': index, 'status': 'error', 'error': 'This product has no video'}
+        elif issue:
+            # Nothing is written until the view ends; the token carries the session
+            results[index] = {
+                'index': index,
+                'status': 'ok',
+                'session_id': issue(product, now),
+                'product_duration': product.video_duration or 30,
+            }
+        else:
+            session = ViewSession(
+                product=product,
+                user=user,
+                session_id=session_id,
+                ip_address=ip_address,
+                device_id=device_id,
+                start_time=now,
+            )
+            sessions[session_id] = session
+            new_sessions.append(session)
+            results[index] = {
+                'index': index,
+                'status': 'ok',
+                'session_id': session_id,
+                'product_duration': product.video_duration or 30,
+            }
+
+    for index, event in signed_ends:
+        results[index] = None
+        payload = event['signed']
+        if event['session_id'] in sessions:
+            # Inserted by an earlier end of the same token, which this end duplicates
+            continue
+        product = products.get(payload['product'])
+        if product is None:
+            results[index] = {'index': index, 'status': 'error', 'error': 'Product not found'}
+            continue
+        session = ViewSession(
+            product=product,
+            user_id=payload['user'],
+            session_id=event['session_id'],
+            ip_address=ip_address,
+            device_id=device_id,
+            start_time=payload['start'],
+        )
+        sessions[session.session_id] = session
+        new_sessions.append(session)
+
+    ViewSession.objects.bulk_create(new_sessions)
+    return sessions
+
+
+def _apply_session_events(valid, results, sessions, increments, viewers, watched, now, user_agent):
+    changed = {}
+    for index, event in valid:
+        if event['type'] == 'start' or results[index] is not None:
+            continue
+        if event['type'] == 'heartbeat' and 'signed' in event:
+            # A signed session has no row before it ends
+            results[index] = {
+                'index': index, 'status': 'ok', 'session_id': event['token'], 'duration': int(event['duration'])
+            }
+            continue
+        session = sessions.get(event['session_id'])
+        if session is None:
+            results[index] = {'index': index, 'status': 'error', 'error': 'Session not found'}
+            continue
+
+        result = {'index': index, 'session_id': event.get('token', session.session_id)}
+        if session.end_time is not None:
+            result.update(status='duplicate', completed=session.completed)
+        elif event['type'] == 'heartbeat':
+            session.duration = max(session.duration, int(event['duration']))
+            changed[session.session_id] = session
+            result.update(status='ok', duration=session.duration)
+        else:
+            session.end_time = now
+            # now is the original request time when the spool replays an event
+            session.recorded_at = timezone.now()
+            session.duration = int(event['duration'])
+            session.completed = is_completed(event['percent_watched'])
+            changed[session.session_id] = session
+            watched[session.product_id].append((event['duration'], event['percent_watched']))
+            counted = counts_as_view(event['duration'], session.product.video_duration)
+            if counted:
+                increments[session.product_id][0] += 1
+                increments[session.product_id][1] += int(event['duration'])
+                viewers[session.product_id].append(session_viewer(session, user_agent))
+            result.update(status='ok', completed=session.completed, counted=counted)
+        results[index] = result
+
+    # Sessions inserted by this batch have their ids now (bulk_create sets them)
+    ViewSession.objects.bulk_update(list(changed.values()), ['end_time', 'recorded_at', 'duration', 'completed'])
@@ -0,0 +1,129 @@
+"""
+Product analytics reports and leaderboards.
+
+Reports are assembled from precomputed data only: FlicksAnalytics counters,
+the hourly/daily rollups, the unique-viewer sketches and the watch
+histograms. Each report is cached under a key that includes the rollup
+watermark, so it refreshes as soon as rollup_view_sessions moves on.
+ANALYTICS_REPORT_CACHE_TIMEOUT bounds how stale the live counters can be.
+"""
+import re
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import ExpressionWrapper, F, FloatField, Sum
+from django.utils import timezone
+from . import rollups
+from .models import Product, FlicksAnalytics, HourlyViewRollup, DailyViewRollup, RollupWatermark
+from .unique_viewers import estimate, viewer_sketch
+from .watch_histograms import watch_stats
+
+LEADERBOARD_METRICS = [*rollups.ROLLUP_FIELDS, 'completion_rate']
+
+MAX_LEADERBOARD_SIZE = 100
+
+# Longest windows by unit: hourly rollups for hours, daily rollups for days
+MAX_WINDOW = {'h': 72, 'd': 365}
+
+
+class InvalidReport(ValueError):
+    pass
+
+
+def report_cache_timeout():
+    return getattr(settings, 'ANALYTICS_REPORT_CACHE_TIMEOUT', 60)
+
+
+def parse_window(window):
+    """'24h' or '7d' as (amount, unit)"""
+    match = re.fullmatch(r'(\d+)([hd])', window or '')
+    if not match:
+        raise InvalidReport("window must look like 24h or 7d")
+    amount, unit = int(match.group(1)), match.group(2)
+    if not 1 <= amount <= MAX_WINDOW[unit]:
+        raise InvalidReport(f"window must be between 1{unit} and {MAX_WINDOW[unit]}{unit}")
+    return amount, unit
+
+
+def cached(build, *key_parts):
+    """A report from the cache, building it when missing or when the rollups have moved on"""
+    position = RollupWatermark.objects.filter(name=rollups.WATERMARK).values_list('position', flat=True).first()
+    key = ':'.join(['analytics', 'report', position.isoformat() if position else '-', *map(str, key_parts)])
+    report = cache.get(key)
+    if report is None:
+        report = build()
+        cache.set(key, report, report_cache_timeout())
+    return report
+
+
+def product_report(product, window='7d'):
+    """Totals, completion rate, unique viewers, watch percentiles and a time series for one product"""
+    amount, unit = parse_window(window)
+
+    def build():
+        counters = FlicksAnalytics.for_product(product)
+        watch = watch_stats([product.id])
+        if unit == 'h':
+            series = rollups.hourly_totals(product, hours=amount)
+        else:
+            series = rollups.daily_totals(product, days=amount)
+        return {
+            'product_id': product.id,
+            'title': product.title,
+            'window': window,
+            'totals': {
+                'views': counters.views,
+                'total_watch_time': counters.total_watch_time,
+                'average_watch_time': counters.average_watch_time,
+                **rollups.product_totals(product),
+            },
+            'completion_rate': rollups.completion_rate(product),
+            'unique_viewers': estimate(viewer_sketch([product.id])),
+            'watch_time': {key: watch[key] for key in ('p50_seconds', 'p90_seconds', 'p50_percent', 'p90_percent')},
+            'series': series,
+        }
+
+    return cached(build, 'product', product.id, window)
+
+
+def leaderboard(metric='views', window='7d', limit=10):
+    """The top `limit` products by a rolled-up metric over a recent window"""
+    if metric not in LEADERBOARD_METRICS:
+        raise InvalidReport(f"metric must be one of: {', '.join(LEADERBOARD_METRICS)}")
+    if not 1 <= limit <= MAX_LEADERBOARD_SIZE:
+        raise InvalidReport(f"limit must be between 1 and {MAX_LEADERBOARD_SIZE}")
+    amount, unit = parse_window(window)
+
+    def build():
+        if unit == 'h':
+            current = timezone.localtime().replace(minute=0, second=0, microsecond=0)
+            rows = HourlyViewRollup.objects.filter(bucket__gt=current - timedelta(hours=amount))
+        else:
+            rows = DailyViewRollup.objects.filter(bucket__gt=timezone.localdate() - timedelta(days=amount))
+        totals = (
+            rows.values('product_id')
+            .annotate(**{field: Sum(field) for field in rollups.ROLLUP_FIELDS})
+            .filter(sessions__gt=0)
+        )
+        if metric == 'completion_rate':
+            totals = totals.annotate(completion_rate=ExpressionWrapper(
+                F('completions') * 100.0 / F('sessions'), output_field=FloatField()
+            ))
+        top = list(totals.order_by(f'-{metric}', '-sessions', 'product_id')[:limit])
+
+        products = Product.objects.only('id', 'title', 'brand').in_bulk([row['product_id'] for row in top])
+        results = []
+        for rank, row in enumerate(top, start=1):
+            product = products.get(row['product_id'])
+            if metric == 'completion_rate':
+                row['completion_rate'] = round(row['completion_rate'], 2)
+            results.append({
+                'rank': rank,
+                'title': product.title if product else None,
+                'brand': product.brand if product else None,
+                'value': row[metric],
+                **row,
+            })
+        return {'metric': metric, 'window': window, 'results': results}
+
+    return cached(build, 'leaderboard', metric, window, limit)
@@ -12,6 +12,17 @@ from django.db.models import Q, Count
 from django.db import transaction
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth import authenticate
+from products.caching import cached_count
+from products.pagination import SORT_OPTIONS, InvalidCursor, paginate_keyset, parse_page_size
+from products.search import ranked_search
+from products import suggest
+from products.facets import facet_counts, selected_filters
+from products.featured import featured_products, featured_response
+from products.fieldsets import InvalidFieldset, requested_fields, fieldset_queryset
+from products.row_compiler import compile_products, product_values
+from products.renderers import streaming_json_response
+from products.conditional import catalog_condition, catalog_get_condition, product_condition
+import hashlib
 import json
 
 # Authentication endpoints
@@ -196,41 +207,44 @@ def subscription_details(request):
         return Response({"message": "Subscription updated successfully"})
 
 @api_view(['GET'])
+@catalog_condition
 def trending_products(request):
     """Get trending products"""
-    featured_trending = FeaturedProduct.objects.filter(
-        featured_type='trending'
-    ).select_related('product').order_by('display_order')
-    
-    if featured_trending.exists():
-        products = [item.product for item in featured_trending]
-    else:
-        products = Product.objects.all().order_by('-id')[:10]
-    
-    serializer = ProductSerializer(products, many=True)
-    return Response(serializer.data)
+    return featured_list(request, 'trending')
 
 @api_view(['GET'])
+@catalog_condition
 def top_products(request):
     """Get top products"""
-    featured_top = FeaturedProduct.objects.filter(
-        featured_type='top'
-    ).select_related('product').order_by('display_order')
+    return featured_list(request, 'top')
+
+def featured_list(request, featured_type):
+    params = request.query_params
+    try:
+        fields = requested_fields(params, ProductSerializer)
+    except InvalidFieldset as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
     
-    if featured_top.exists():
-        products = [item.product for item in featured_top]
-    else:
-        products = Product.objects.all().order_by('-id')[:10]
+    if 'fields' in params or 'exclude' in params:
+        # Ad hoc fieldsets aren't materialized
+        products, _ = featured_products(featured_type, fields)
+        return Response(ProductSerializer(products, many=True, fields=fields).data)
     
-    serializer = ProductSerializer(products, many=True)
-    return Response(serializer.data)
+    # Pre-rendered list, rebuilt whenever featured placements or their products change
+    return featured_response(featured_type, params.get('view') or 'full')
 
 @api_view(['GET'])
+@product_condition
 def product_detail(request, product_id):
     """Get detailed information about a specific product"""
     try:
-        product = Product.objects.get(id=product_id)
-        serializer = ProductDetailSerializer(product)
+        fields = requested_fields(request.query_params, ProductDetailSerializer)
+    except InvalidFieldset as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    try:
+        product = fieldset_queryset(Product.objects.all(), fields).get(id=product_id)
+        serializer = ProductDetailSerializer(product, fields=fields)
         return Response(serializer.data)
     except Product.DoesNotExist:
         return Response(
@@ -238,7 +252,53 @@ def product_detail(request, product_id):
             status=status.HTTP_404_NOT_FOUND
         )
 
+MAX_BATCH_SIZE = 100
+
+def parse_batch_ids(request):
+    """Requested product ids, in order and without repeats, from ?ids=1,2,3 or a JSON body"""
+    if request.method == 'POST':
+        ids = request.data.get('ids') if isinstance(request.data, dict) else None
+        if not isinstance(ids, list):
+            raise ValueError("Provide ids as a list in the request body")
+        # JSON ids must be integers already; int() would turn true or 1.7 into 1
+        if not all(isinstance(product_id, int) and not isinstance(product_id, bool) for product_id in ids):
+            raise ValueError("Product ids must be integers")
+    else:
+        values = [value for param in request.query_params.getlist('ids') for value in param.split(',') if value.strip()]
+        try:
+            ids = [int(value) for value in values]
+        except ValueError:
+            raise ValueError("Product ids must be integers")
+    
+    ids = list(dict.fromkeys(ids))
+    
+    if not ids:
+        raise ValueError("Provide at least one product id")
+    if len(ids) > MAX_BATCH_SIZE:
+        raise ValueError(f"At most {MAX_BATCH_SIZE} products can be fetched at once")
+    return ids
+
+@api_view(['GET', 'POST'])
+@catalog_get_condition
+def batch_products(request):
+    """Get details of several products at once, in the order requested"""
+    try:
+        product_ids = parse_batch_ids(request)
+        fields = requested_fields(request.query_params, ProductDetailSerializer)
+    except (ValueError, InvalidFieldset) as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    # One query for the products and manufacturers, one for all their gallery items
+    products_by_id = fieldset_queryset(Product.objects.all(), fields).in_bulk(product_ids)
+    products = [products_by_id[product_id] for product_id in product_ids if product_id in products_by_id]
+    
+    return Response({
+        'results': ProductDetailSerializer(products, many=True, fields=fields).data,
+        'missing': [product_id for product_id in product_ids if product_id not in products_by_id]
+    })
+
 @api_view(['GET'])
+@catalog_condition
 def search_products(request):
     """Search products by keywords, searching with title, description, brand, manufacturer age group and so on."""
     query = request.query_params.get('q', '')
@@ -249,58 +309,69 @@ def search_products(request):
             status=status.HTTP_400_BAD_REQUEST
         )
     
-    query_words = query.split()
-    
-    q_objects = Q()
-    
-    for word in query_words:
-        q_objects |= Q(title__icontains=word)
-        q_objects |= Q(description__icontains=word)
-        q_objects |= Q(brand__icontains=word)
-        q_objects |= Q(product_category__icontains=word)
-        q_objects |= Q(age_group__icontains=word)
-        q_objects |= Q(manufacturer__name__icontains=word)
-    
-    products = Product.objects.filter(q_objects).distinct()
-    
-    products_with_title_match = products.filter(title__icontains=query)
-    other_products = products.exclude(id__in=products_with_title_match.values_list('id', flat=True))
-    
-    sorted_products = list(products_with_title_match) + list(other_products)
+    try:
+        fields = requested_fields(request.query_params, ProductSerializer)
+    except InvalidFieldset as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
     
-    page = int(request.query_params.get('page', 1))
-    page_size = int(request.query_params.get('page_size', 10))
+    try:
+        page = max(1, int(request.query_params.get('page', 1)))
+    except ValueError:
+        page = 1
+    page_size = parse_page_size(request.query_params.get('page_size'), default=10)
     
     start = (page - 1) * page_size
     end = start + page_size
     
-    paginated_products = sorted_products[start:end]
-    
-    serializer = ProductSerializer(paginated_products, many=True)
+    # Match, rank and paginate in the search index, then load the page with its media
+    page_ids, total_count = ranked_search(query, offset=start, limit=page_size)
+    rows_by_id = {row['id']: row for row in product_values(Product.objects.filter(id__in=page_ids), fields)}
+    paginated_rows = [rows_by_id[product_id] for product_id in page_ids if product_id in rows_by_id]
     
     return Response({
-        'results': serializer.data,
-        'count': len(sorted_products),
-        'has_more': len(sorted_products) > end,
+        'results': compile_products(paginated_rows, fields),
+        'count': total_count,
+        'has_more': total_count > end,
         'page': page,
         'page_size': page_size,
         'query': query
     })
 
+@api_view(['GET'])
+def suggest_products(request):
+    """Autocomplete titles, brands, categories and manufacturers for a typed prefix"""
+    query = request.query_params.get('q', '')
+    
+    try:
+        limit = int(request.query_params.get('limit', 10))
+    except ValueError:
+        limit = 10
+    
+    # Served from the in-process index; no database query per keystroke
+    return Response({
+        'query': query,
+        'suggestions': suggest.suggest(query, limit=max(1, limit))
+    })
+
 @api_view(['GET'])
 @permission_classes([AllowAny])
+@catalog_condition
 def product_categories(request):
     """Get the top 6 most common product categories for filtering"""
-    category_counts = Product.objects.values('product_category') \
-                        .annotate(count=Count('product_category')) \
-                        .filter(product_category__isnull=False) \
-                        .exclude(product_category='') \
-                        .order_by('-count')[:6]
+    # Read from the cached facet counts rather than grouping the table on every call
+    category_counts = facet_counts({})['facets']['category'][:6]
     
-    top_categories = [item['product_category'] for item in category_counts]
+    top_categories = [item['value'] for item in category_counts]
     
     return Response(top_categories)
 
+@api_view(['GET'])
+@permission_classes([AllowAny])
+@catalog_condition
+def product_facets(request):
+    """Get product counts by category, age group, gender, brand and manufacturer for the current filters"""
+    return Response(facet_counts(selected_filters(request.query_params)))
+
 @api_view(['GET'])
 @permission_classes([AllowAny])
 def age_groups(request):
@@ -316,26 +387,57 @@ def age_groups(request):
     
     return Response(standard_age_groups)
 
+# Unpaginated filter results larger than this are streamed
+STREAM_CHUNK_SIZE = 500
+
+# Filter query parameters and the Product fields they match
+FILTER_PARAMS = {
+    'gender': 'gender',
+    'age_group': 'standardized_age',
+    'category': 'product_category',
+}
+
+def product_filters(params):
+    """Build filter kwargs from query parameters; repeat a parameter to match any of several values"""
+    filters = {}
+    for param, field in FILTER_PARAMS.items():
+        values = sorted(set(value for value in params.getlist(param) if value))
+        if len(values) == 1:
+            filters[field] = values[0]
+        elif values:
+            filters[f'{field}__in'] = values
+    return filters
+
 @api_view(['GET'])
+@catalog_condition
 def filter_products(request):
     """Filter products by gender, age, and category"""
-    gender = request.query_params.get('gender')
-    age_group = request.query_params.get('age_group')
-    product_category = request.query_params.get('category')
-    
-    products = Product.objects.all()
-    
-    if gender:
-        products = products.filter(gender=gender)
-    
-    if product_category:
-        products = products.filter(product_category=product_category)
-        
-    if age_group:
-        products = products.filter(standardized_age=age_group)
-    
-    serializer = ProductSerializer(products, many=True)
-    return Response(serializer.data)
+    try:
+        fields = requested_fields(request.query_params, ProductSerializer)
+    except InvalidFieldset as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    filters = product_filters(request.query_params)
+    products = Product.objects.filter(**filters)
+    
+    if wants_cursor_pagination(request.query_params):
+        count_key = 'filter:' + hashlib.md5(repr(sorted(filters.items())).encode()).hexdigest()
+        return cursor_paginated_products(request, products, fields, count_key=count_key)
+    
+    # Small results are returned whole; larger ones are streamed in id order, a chunk at a time
+    rows = list(product_values(products.order_by('id'), fields)[:STREAM_CHUNK_SIZE])
+    if len(rows) < STREAM_CHUNK_SIZE:
+        return Response(compile_products(rows, fields))
+    return streaming_json_response(compiled_product_chunks(products, fields, rows))
+
+def compiled_product_chunks(products, fields, rows):
+    """Serialized chunks of a product queryset, starting from its first fetched rows"""
+    while rows:
+        yield compile_products(rows, fields)
+        if len(rows) < STREAM_CHUNK_SIZE:
+            break
+        next_rows = products.filter(id__gt=rows[-1]['id']).order_by('id')
+        rows = list(product_values(next_rows, fields)[:STREAM_CHUNK_SIZE])
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
@@ -380,11 +482,22 @@ def redeem_reward(request):
 
 @api_view(['GET'])
 @permission_classes([AllowAny])
+@catalog_condition
 def all_products(request):
     """Get all products with optional pagination"""
+    params = request.query_params
+    
+    try:
+        fields = requested_fields(params, ProductSerializer)
+    except InvalidFieldset as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    if wants_cursor_pagination(params):
+        return cursor_paginated_products(request, Product.objects.all(), fields)
+    
     # Get query parameters for pagination
-    page = request.query_params.get('page', 1)
-    page_size = request.query_params.get('page_size', 10)
+    page = params.get('page', 1)
+    page_size = params.get('page_size', 10)
     
     try:
         page = int(page)
@@ -397,22 +510,60 @@ def all_products(request):
     start = (page - 1) * page_size
     end = start + page_size
     
-    # Get products
-    products = Product.objects.all().order_by('id')[start:end]
-    
-    # Get total count for pagination info
-    total_count = Product.objects.count()
+    # Get products as plain rows
+    rows = product_values(Product.objects.order_by('id'), fields)[start:end]
     
-    # Serialize the data
-    serializer = ProductSerializer(products, many=True, context={'request': request})
+    # Get total count for pagination info (cached until the catalog changes)
+    total_count = cached_count(Product.objects.all(), 'all')
     
     # Return data with pagination info
     return Response({
-        'results': serializer.data,
+        'results': compile_products(rows, fields, request),
         'count': total_count,
         'total_pages': (total_count + page_size - 1) // page_size,
         'current_page': page
     })
+
+def wants_cursor_pagination(params):
+    """Cursor mode: ?after=/?before= tokens, or ?sort= / ?pagination=cursor for the first page"""
+    return any(key in params for key in ('after', 'before', 'sort')) or params.get('pagination') == 'cursor'
+
+def cursor_paginated_products(request, products, fields=None, count_key='all'):
+    """Serialize one keyset page of a product queryset, limited to a sparse fieldset"""
+    params = request.query_params
+    sort = params.get('sort', 'id')
+    
+    if sort not in SORT_OPTIONS:
+        return Response(
+            {"error": f"Unsupported sort. Choose one of: {', '.join(SORT_OPTIONS)}"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    page_size = parse_page_size(params.get('page_size'))
+    
+    try:
+        rows, page_info = paginate_keyset(
+            product_values(products, fields, extra_columns=SORT_OPTIONS[sort]),
+            sort=sort,
+            after=params.get('after'),
+            before=params.get('before'),
+            page_size=page_size
+        )
+    except InvalidCursor as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    response_data = {
+        'results': compile_products(rows, fields, request),
+        'page_size': page_size,
+        'sort': sort,
+        **page_info
+    }
+    
+    # Counting is optional in cursor mode, and cached when asked for
+    if params.get('include_count') in ('1', 'true'):
+        response_data['count'] = cached_count(products, count_key)
+    
+    return Response(response_data)
     
 # Flicks Feed endpoints
 @api_view(['GET'])
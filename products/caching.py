@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.core.cache import cache
+
+CATALOG_GENERATION_KEY = 'products:catalog-generation'
+
+# Upper bound on how stale a cached count can be when the cache isn't shared
+# between workers (e.g. the default local-memory cache)
+COUNT_CACHE_TIMEOUT = getattr(settings, 'PRODUCT_COUNT_CACHE_TIMEOUT', 300)
+
+
+def catalog_generation():
+    """Current catalog generation; bumped whenever a product changes"""
+    return cache.get_or_set(CATALOG_GENERATION_KEY, 1, None)
+
+
+def bump_catalog_generation():
+    """Invalidate every cache entry keyed on the catalog generation"""
+    try:
+        cache.incr(CATALOG_GENERATION_KEY)
+    except ValueError:
+        cache.set(CATALOG_GENERATION_KEY, 1, None)
+
+
+def catalog_cache_key(*parts):
+    """Build a cache key that changes whenever the catalog does"""
+    return ':'.join(['products', str(catalog_generation()), *[str(part) for part in parts]])
+
+
+def cached_count(queryset, *key_parts):
+    """Count a product queryset, reusing the result until the catalog changes"""
+    key = catalog_cache_key('count', *key_parts)
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, COUNT_CACHE_TIMEOUT)
+    return count
@@ -0,0 +1,77 @@
+"""
+Conditional GET support for the product endpoints.
+
+ETags and Last-Modified dates are computed from version columns before the
+view runs, so a request that revalidates successfully costs one indexed
+lookup and gets a 304 without anything being serialized.
+"""
+import hashlib
+from functools import wraps
+from django.views.decorators.http import condition
+from .models import Product, CatalogVersion
+
+
+def representation_hash(request):
+    # The same path can be rendered as JSON or as the browsable API
+    source = f"{request.get_full_path()}|{request.META.get('HTTP_ACCEPT', '')}"
+    return hashlib.md5(source.encode()).hexdigest()[:16]
+
+
+def catalog_state(request):
+    if not hasattr(request, '_catalog_state'):
+        request._catalog_state = CatalogVersion.current()
+    return request._catalog_state
+
+
+def catalog_etag(request, *args, **kwargs):
+    version, _ = catalog_state(request)
+    return f'"catalog-{version}-{representation_hash(request)}"'
+
+
+def catalog_last_modified(request, *args, **kwargs):
+    return catalog_state(request)[1]
+
+
+def product_state(request, product_id):
+    if not hasattr(request, '_product_state'):
+        request._product_state = (
+            Product.objects.filter(pk=product_id).values_list('version', 'updated_at').first()
+        )
+    return request._product_state
+
+
+def product_etag(request, product_id, *args, **kwargs):
+    state = product_state(request, product_id)
+    if state is None:
+        return None
+    return f'"product-{product_id}-{state[0]}-{representation_hash(request)}"'
+
+
+def product_last_modified(request, product_id, *args, **kwargs):
+    state = product_state(request, product_id)
+    return state[1] if state else None
+
+
+# Responses that can change with any catalog edit (lists, searches, featured lists)
+catalog_condition = condition(etag_func=catalog_etag, last_modified_func=catalog_last_modified)
+
+
+def get_only(conditional):
+    """Apply a conditional decorator to GET and HEAD requests only"""
+    def decorator(view):
+        conditional_view = conditional(view)
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method in ('GET', 'HEAD'):
+                return conditional_view(request, *args, **kwargs)
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Views that also accept POST, which must never get a 412 from a matching If-None-Match
+catalog_get_condition = get_only(catalog_condition)
+
+# Responses that depend on a single product and its gallery
+product_condition = condition(etag_func=product_etag, last_modified_func=product_last_modified)
@@ -0,0 +1,122 @@
+"""
+Device dimension for view sessions.
+
+User-agent strings are parsed into (platform, os, browser, app version, form
+factor) by an LRU-cached parser, and each distinct result is stored once in
+the Device table. ViewSession rows reference it by a 4-byte id instead of
+carrying the raw user agent, so per-device breakdowns are GROUP BYs on a
+small integer.
+
+Device ids are remembered per process once their row is known to be
+committed, so resolving a device is normally free.
+"""
+import re
+from functools import lru_cache
+from django.db import IntegrityError, transaction
+from django.db.models import Count
+from .models import Device, ViewSession
+
+PARSE_CACHE_SIZE = 2048
+
+# Our mobile apps identify themselves as "Flicks/<version>"; HTTP client libraries mean an app too
+APP_PATTERN = re.compile(r'\bFlicks/([\w.]+)')
+APP_CLIENT_PATTERN = re.compile(r'\b(Dart|okhttp|CFNetwork|Alamofire)/', re.I)
+BOT_PATTERN = re.compile(r'bot\b|crawler|spider|slurp|headless', re.I)
+
+OS_PATTERNS = [
+    ('iOS', re.compile(r'iPhone|iPad|iPod|\biOS\b|CPU OS')),
+    ('Android', re.compile(r'Android')),
+    ('Windows', re.compile(r'Windows')),
+    ('ChromeOS', re.compile(r'CrOS')),
+    ('macOS', re.compile(r'Macintosh|Mac OS X')),
+    ('Linux', re.compile(r'Linux')),
+]
+
+# Order matters: Edge and Opera also say Chrome, and Chrome also says Safari
+BROWSER_PATTERNS = [
+    ('Edge', re.compile(r'\bEdg(e|A|iOS)?/')),
+    ('Opera', re.compile(r'\bOPR/|\bOpera\b')),
+    ('Samsung Internet', re.compile(r'SamsungBrowser/')),
+    ('Firefox', re.compile(r'\b(Firefox|FxiOS)/')),
+    ('Chrome', re.compile(r'\b(Chrome|CriOS)/')),
+    ('Safari', re.compile(r'Version/[\d.]+.*Safari/')),
+]
+
+# Parsed dimensions -> Device id, for rows known to be committed
+_device_ids = {}
+
+
+def _first_match(patterns, user_agent, default):
+    for name, pattern in patterns:
+        if pattern.search(user_agent):
+            return name
+    return default
+
+
+DIMENSIONS = ['platform', 'os', 'browser', 'app_version', 'form_factor']
+
+
+def parse_user_agent(user_agent):
+    """Device dimensions of a user-agent string, as a dict of Device field values"""
+    return dict(zip(DIMENSIONS, _parse(user_agent or '')))
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse(user_agent):
+    user_agent = user_agent[:512]
+    app = APP_PATTERN.search(user_agent)
+    if app or APP_CLIENT_PATTERN.search(user_agent):
+        platform, browser = 'app', ''
+    elif user_agent.startswith('Mozilla/'):
+        platform, browser = 'web', _first_match(BROWSER_PATTERNS, user_agent, 'Other')
+    else:
+        platform, browser = 'other', ''
+
+    os = _first_match(OS_PATTERNS, user_agent, 'Other')
+    if BOT_PATTERN.search(user_agent):
+        form_factor = 'bot'
+    elif 'iPad' in user_agent or 'Tablet' in user_agent or (os == 'Android' and 'Mobile' not in user_agent):
+        form_factor = 'tablet'
+    elif os in ('iOS', 'Android') or 'Mobile' in user_agent:
+        form_factor = 'mobile'
+    elif os in ('Windows', 'macOS', 'Linux', 'ChromeOS'):
+        form_factor = 'desktop'
+    else:
+        form_factor = 'other'
+
+    return platform, os, browser, app.group(1)[:30] if app else '', form_factor
+
+
+def device_id(user_agent):
+    """Id of the Device row for a user agent, creating it if needed"""
+    fields = parse_user_agent(user_agent)
+    key = tuple(fields.values())
+    if key in _device_ids:
+        return _device_ids[key]
+
+    try:
+        device, _ = Device.objects.get_or_create(**fields)
+    except IntegrityError:
+        # Created concurrently by another request
+        device = Device.objects.get(**fields)
+    # Only remember the id once the row can't be rolled back
+    transaction.on_commit(lambda: _device_ids.setdefault(key, device.id))
+    return device.id
+
+
+def request_device_id(request):
+    return device_id(request.META.get('HTTP_USER_AGENT', ''))
+
+
+def device_breakdown(sessions=None, dimension='form_factor'):
+    """Session counts per value of a device dimension, largest first"""
+    if dimension not in DIMENSIONS:
+        raise ValueError(f"Unknown device dimension: {dimension}")
+    sessions = ViewSession.objects.all() if sessions is None else sessions
+    field = f'device__{dimension}'
+    return list(
+        sessions.filter(device__isnull=False)
+        .values(field)
+        .annotate(sessions=Count('id'))
+        .order_by('-sessions', field)
+    )
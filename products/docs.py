@@ -135,13 +135,21 @@ def api_documentation(request):
             'description': 'Get all products with pagination',
             'parameters': {
                 'page': 'Page number (default: 1)',
-                'page_size': 'Number of results per page (default: 10)'
+                'page_size': 'Number of results per page (default: 10)',
+                'after': 'Cursor mode: next_cursor from the previous response',
+                'before': 'Cursor mode: previous_cursor from the previous response',
+                'sort': 'Cursor mode sort key: id, -id, title, -title, brand, -brand (default: id)',
+                'pagination': 'Set to "cursor" to request the first page in cursor mode',
+                'include_count': 'Cursor mode: set to true to include the total count'
             },
             'response': {
                 'results': 'List of products',
-                'count': 'Total number of products',
-                'total_pages': 'Total number of pages',
-                'current_page': 'Current page number'
+                'count': 'Total number of products (cursor mode: only with include_count)',
+                'total_pages': 'Total number of pages (page mode)',
+                'current_page': 'Current page number (page mode)',
+                'next_cursor': 'Cursor for the next page, or null (cursor mode)',
+                'previous_cursor': 'Cursor for the previous page, or null (cursor mode)',
+                'has_more': 'Whether there are more results (cursor mode)'
             }
         },
         'Product Detail': {
@@ -151,12 +159,28 @@ def api_documentation(request):
             'parameters': {
                 'product_id': 'ID of the product (in URL path)'
             },
-            'response': 'Detailed product information including gallery items'
+            'response': 'Detailed product information including gallery items',
+            'caching': 'Responses carry ETag and Last-Modified; send If-None-Match to get 304 Not Modified when unchanged'
+        },
+        'Batch Products': {
+            'url': f"{base_url}/products/batch/",
+            'method': 'GET, POST',
+            'description': 'Get details of up to 100 products in one call',
+            'parameters': {
+                'ids': 'Comma separated product ids (GET), or a JSON list in the body (POST)',
+                'view': 'Optional: card or full (default)',
+                'fields': 'Optional: comma separated fields to return',
+                'exclude': 'Optional: comma separated fields to leave out'
+            },
+            'response': {
+                'results': 'Product details, in the order requested',
+                'missing': 'Requested ids that do not exist'
+            }
         },
         'Trending Products': {
             'url': f"{base_url}/products/trending/",
             'method': 'GET',
-            'description': 'Get list of trending products',
+            'description': 'Get list of trending products: pinned products, then the latest engagement ranking',
             'response': 'List of trending products'
         },
         'Top Products': {
@@ -183,22 +207,58 @@ def api_documentation(request):
                 'query': 'Search query used'
             }
         },
+        'Suggest Products': {
+            'url': f"{base_url}/products/suggest/",
+            'method': 'GET',
+            'description': 'Typo-tolerant autocomplete for the search box',
+            'parameters': {
+                'q': 'Typed prefix',
+                'limit': 'Maximum number of suggestions (default: 10, max: 20)'
+            },
+            'response': {
+                'query': 'Prefix used',
+                'suggestions': 'List of {text, type} where type is title, brand, category or manufacturer'
+            }
+        },
         'Filter Products': {
             'url': f"{base_url}/products/filter/",
             'method': 'GET',
             'description': 'Filter products by gender, age, and category',
             'parameters': {
-                'gender': 'Filter by gender (M, F, U)',
-                'age_group': 'Filter by age group',
-                'category': 'Filter by product category'
+                'gender': 'Filter by gender (M, F, U); repeat to match several',
+                'age_group': 'Filter by standardized age group; repeat to match several',
+                'category': 'Filter by product category; repeat to match several',
+                'sort': 'Sort key: id, -id, title, -title, brand, -brand (default: id)',
+                'after': 'Cursor from next_cursor of the previous page',
+                'before': 'Cursor from previous_cursor of the previous page',
+                'page_size': 'Number of results per page in cursor mode (default: 10, max: 100)',
+                'pagination': 'Set to "cursor" to request the first page in cursor mode',
+                'include_count': 'Set to true to include the total count (cursor mode)'
             },
-            'response': 'List of filtered products'
+            'response': 'List of filtered products, or a cursor page (results, next_cursor, previous_cursor, has_more) in cursor mode'
         },
         'Product Categories': {
             'url': f"{base_url}/products/categories/",
             'method': 'GET',
             'description': 'Get the top 6 most common product categories',
             'response': 'List of category names'
+        },
+        'Product Facets': {
+            'url': f"{base_url}/products/facets/",
+            'method': 'GET',
+            'description': 'Get product counts per filter value for the current filters',
+            'parameters': {
+                'category': 'Selected categories; repeat to select several',
+                'age_group': 'Selected standardized age groups; repeat to select several',
+                'gender': 'Selected genders (M, F, U); repeat to select several',
+                'brand': 'Selected brands; repeat to select several',
+                'manufacturer': 'Selected manufacturer ids; repeat to select several'
+            },
+            'response': {
+                'count': 'Number of products matching all selected filters',
+                'facets': 'Per facet, a list of {value, count} (manufacturer also has name). '
+                          'Each facet is counted ignoring its own selection.'
+            }
         }
     }
     
@@ -259,7 +319,7 @@ def api_documentation(request):
                 'product_id': 'ID of the product being viewed'
             },
             'response': {
-                'session_id': 'Unique session identifier',
+                'session_id': 'Unique session identifier (a signed session token when signed sessions are enabled)',
                 'start_time': 'Timestamp when view started',
                 'product_duration': 'Duration of the product video in seconds'
             }
@@ -278,6 +338,83 @@ def api_documentation(request):
                 'duration': 'Recorded watch duration',
                 'completed': 'Whether the view is considered complete'
             }
+        },
+        'Record Events': {
+            'url': f"{base_url}/analytics/events/",
+            'method': 'POST',
+            'description': 'Record up to 500 view events in one request; safe to retry',
+            'parameters': {
+                'events': 'List of events. start: type, product_id, session_id (client-generated UUID). '
+                          'heartbeat/end: type, session_id, duration (seconds), percent_watched (0-100). '
+                          'With signed sessions, starts return a session token to send as the session_id'
+            },
+            'response': {
+                'results': 'One result per event, in order: index, status (ok, duplicate or error), '
+                           'session_id, and error, completed or counted where relevant'
+            }
+        },
+        'Unique Viewers': {
+            'url': f"{base_url}/analytics/unique-viewers/",
+            'method': 'GET',
+            'description': 'Estimated number of distinct people who watched (counted views only)',
+            'authentication': 'Required (staff)',
+            'parameters': {
+                'ids': 'Optional comma-separated product ids (default: all products)',
+                'days': 'Optional number of recent days to count (1-365; default: all time)'
+            },
+            'response': {
+                'unique_viewers': 'Estimated distinct viewers',
+                'relative_error': 'Standard error of the estimate as a fraction (about 0.016)',
+                'lower_bound': 'Lower bound of the ~95% confidence interval',
+                'upper_bound': 'Upper bound of the ~95% confidence interval'
+            }
+        },
+        'Watch Retention': {
+            'url': f"{base_url}/analytics/watch-retention/",
+            'method': 'GET',
+            'description': 'How far into their videos viewers watch, over all ended view sessions',
+            'authentication': 'Required (staff)',
+            'parameters': {
+                'ids': 'Optional comma-separated product ids (default: all products)'
+            },
+            'response': {
+                'sessions': 'Number of ended view sessions',
+                'p50_seconds / p90_seconds': 'Median and 90th percentile seconds watched',
+                'p50_percent / p90_percent': 'Median and 90th percentile share of the video watched',
+                'percent_drop_off': 'List of {at, retained}: share of sessions that watched at least `at` percent, in 5% steps',
+                'seconds_drop_off': 'List of {at, retained}: share of sessions that watched at least `at` seconds',
+                'percent_histogram / seconds_histogram': 'Session counts per bucket'
+            }
+        },
+        'Product Analytics': {
+            'url': f"{base_url}/analytics/products/{{product_id}}/",
+            'method': 'GET',
+            'description': 'Performance of one product from precomputed aggregates (cached, refreshed as rollups run)',
+            'authentication': 'Required (staff)',
+            'parameters': {
+                'window': 'Time series range: 1h-72h for hourly buckets or 1d-365d for daily buckets (default: 7d)'
+            },
+            'response': {
+                'totals': 'Live view counters plus all-time rolled-up views, watch_seconds, completions and sessions',
+                'completion_rate': 'Percentage of sessions completed',
+                'unique_viewers': 'Unique viewer estimate with error bounds',
+                'watch_time': 'p50/p90 seconds and percent watched',
+                'series': 'List of {bucket, views, watch_seconds, completions, sessions}, oldest first'
+            }
+        },
+        'Analytics Leaderboard': {
+            'url': f"{base_url}/analytics/leaderboard/",
+            'method': 'GET',
+            'description': 'Top products over a recent window, from the rollups (cached)',
+            'authentication': 'Required (staff)',
+            'parameters': {
+                'metric': 'views, watch_seconds, completions, sessions or completion_rate (default: views)',
+                'window': '1h-72h or 1d-365d (default: 7d)',
+                'limit': 'Number of products, 1-100 (default: 10)'
+            },
+            'response': {
+                'results': 'List of {rank, product_id, title, brand, value, views, watch_seconds, completions, sessions}'
+            }
         }
     }
     
@@ -288,6 +425,15 @@ def api_documentation(request):
         'Products': product_endpoints,
         'Analytics': analytics_endpoints,
         'Other': other_endpoints,
+        'Analytics Spool': 'When the event spool is enabled, start-view, end-view and events only append to a local '
+                           'log and return; sessions and view counts appear once the spool is loaded. Batched '
+                           'events are reported with status accepted',
+        'Trending': 'The trending list is ranked by time-decayed views, completions and watch time, recomputed '
+                    'by the compute_trending command; manually pinned products come first',
+        'Sparse Fieldsets': 'Product detail, product lists, search and the trending/top lists accept '
+                            'view=card|full, fields=a,b and exclude=a,b to return (and load) only some fields',
+        'Conditional Requests': 'Product detail, product lists, search, facets and the trending/top lists send '
+                                'ETag and Last-Modified headers and answer If-None-Match/If-Modified-Since with 304',
         'API Overview': {
             'url': f"{base_url}/",
             'method': 'GET',
@@ -0,0 +1,335 @@
+"""
+Durable spool for view-tracking events.
+
+With ANALYTICS_SPOOL_ENABLED, the view-tracking endpoints don't write to the
+database. Each request's events are appended as one JSON line (with the time,
+user, IP address and user agent of the request) to a segment file in
+ANALYTICS_SPOOL_DIR, and the request returns. Every process writes its own
+segment, named <creation time>-<pid>-<n>.jsonl.open. A segment is fsync'd every
+ANALYTICS_SPOOL_FSYNC_EVERY lines or ANALYTICS_SPOOL_FSYNC_INTERVAL seconds,
+and closed (renamed to .jsonl) once it reaches ANALYTICS_SPOOL_SEGMENT_BYTES or
+is ANALYTICS_SPOOL_SEGMENT_SECONDS old.
+
+load_analytics_spool replays closed segments, oldest first, through
+analytics_events.process_events. A segment is loaded in one transaction that
+also inserts a SpoolCheckpoint row naming it, so it is applied exactly once
+even if the loader stops between committing and removing the file. Ends of
+sessions whose start is in a segment that hasn't been loaded yet are written
+to a new segment and retried on the next run, for up to ORPHAN_RETRY_SECONDS.
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .analytics_buffer import CounterBuffer
+from .analytics_events import InvalidEvent, process_events, read_signed_event, validate_event
+from .devices import device_id
+from .models import Product, ShopUser, SpoolCheckpoint
+from .renderers import dumps
+from .session_tokens import RequestTokens, is_token, signed_sessions_enabled
+
+logger = logging.getLogger(__name__)
+
+OPEN_SUFFIX = '.jsonl.open'
+SEGMENT_SUFFIX = '.jsonl'
+
+# How long ends whose session hasn't been loaded yet keep being retried
+ORPHAN_RETRY_SECONDS = 6 * 3600
+
+
+def spool_enabled():
+    return getattr(settings, 'ANALYTICS_SPOOL_ENABLED', False)
+
+
+def spool_dir():
+    return str(getattr(settings, 'ANALYTICS_SPOOL_DIR', os.path.join(settings.BASE_DIR, 'var', 'analytics-spool')))
+
+
+def segment_bytes():
+    return getattr(settings, 'ANALYTICS_SPOOL_SEGMENT_BYTES', 8 * 1024 * 1024)
+
+
+def segment_seconds():
+    return getattr(settings, 'ANALYTICS_SPOOL_SEGMENT_SECONDS', 60)
+
+
+def fsync_every():
+    return getattr(settings, 'ANALYTICS_SPOOL_FSYNC_EVERY', 100)
+
+
+def fsync_interval():
+    return getattr(settings, 'ANALYTICS_SPOOL_FSYNC_INTERVAL', 1)
+
+
+def request_record(request, events, at=None, user_id=None):
+    """The spool record of events sent in a request"""
+    if user_id is None and request.user.is_authenticated:
+        user_id = request.user.pk
+    forwarded = request.META.get('HTTP_X_FORWARDED_FOR')
+    return {
+        'at': (at or timezone.now()).isoformat(),
+        'user_id': user_id,
+        'ip_address': forwarded.split(',')[0] if forwarded else request.META.get('REMOTE_ADDR'),
+        'user_agent': request.META.get('HTTP_USER_AGENT', ''),
+        'events': events,
+    }
+
+
+def spool_events(request, events):
+    """
+    Validate a batch and append its valid events to the spool; returns one
+    result per event. Signed tokens are verified now, as they may have
+    expired by the time the spool is loaded.
+    """
+    tokens = RequestTokens(request)
+    now = timezone.now()
+    results = []
+    starts = []
+    valid = []
+    for index, event in enumerate(events):
+        try:
+            event = validate_event(event)
+            if is_token(event['session_id']):
+                event = read_signed_event(event, tokens)
+        except InvalidEvent as e:
+            results.append({'index': index, 'status': 'error', 'error': str(e)})
+            continue
+
+        session_id = event.pop('token', event['session_id'])
+        payload = event.pop('signed', None)
+        if event['type'] == 'start' and signed_sessions_enabled():
+            # Nothing is spooled until the view ends; the token carries the session
+            session_id = tokens.issue(Product(pk=event['product_id']), now)
+        elif payload and event['type'] == 'heartbeat':
+            # A signed session has no row before it ends
+            pass
+        else:
+            if payload:
+                # Spooled ahead of the end, at the time and for the user the view started with
+                start = request_record(request, [
+                    {'type': 'start', 'product_id': payload['product'], 'session_id': event['session_id']}
+                ], at=payload['start'])
+                start['user_id'] = payload['user']
+                starts.append(start)
+            elif event['type'] == 'start' and not event['session_id']:
+                event['session_id'] = session_id = str(uuid.uuid4())
+            valid.append(event)
+        results.append({'index': index, 'status': 'accepted', 'session_id': session_id})
+    if valid:
+        append(*starts, request_record(request, valid, at=now))
+    return results
+
+
+class SegmentWriter:
+    """Appends records to this process's open segment"""
+
+    def __init__(self, directory=None, prefix=''):
+        self._directory = directory
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        self._file = None
+        self._path = None
+        self._pid = None
+        self._opened_at = 0
+        self._unsynced = 0
+        self._sequence = 0
+        self._timer = None
+
+    def append(self, *records):
+        """Append records as consecutive lines; they are durable by the next fsync"""
+        data = b''.join(dumps(record) + b'\n' for record in records)
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked: the parent's segment belongs to the parent
+                self._file = self._timer = None
+                self._pid = os.getpid()
+            if self._file is not None and (
+                self._file.tell() + len(data) > segment_bytes()
+                or time.monotonic() - self._opened_at >= segment_seconds()
+            ):
+                self._close()
+            if self._file is None:
+                self._open()
+            self._file.write(data)
+            self._file.flush()
+            self._unsynced += len(records)
+            if self._unsynced >= fsync_every():
+                self._sync()
+            self._schedule()
+
+    def close(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                self._close()
+
+    def _open(self):
+        directory = self._directory or spool_dir()
+        os.makedirs(directory, exist_ok=True)
+        self._sequence += 1
+        name = f'{self._prefix}{time.time_ns()}-{os.getpid()}-{self._sequence}{OPEN_SUFFIX}'
+        self._path = os.path.join(directory, name)
+        self._file = open(self._path, 'ab')
+        self._opened_at = time.monotonic()
+
+    def _sync(self):
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    def _close(self):
+        if self._file is None:
+            return
+        self._sync()
+        self._file.close()
+        self._file = None
+        os.rename(self._path, self._path[:-len(OPEN_SUFFIX)] + SEGMENT_SUFFIX)
+
+    def _schedule(self):
+        if self._timer is None:
+            self._timer = threading.Timer(fsync_interval(), self._timed_sync)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _timed_sync(self):
+        with self._lock:
+            self._timer = None
+            if self._pid != os.getpid() or self._file is None:
+                return
+            try:
+                if time.monotonic() - self._opened_at >= segment_seconds():
+                    # Close idle segments so the loader can pick them up
+                    self._close()
+                else:
+                    self._sync()
+                    self._schedule()
+            except OSError:
+                logger.exception("Error syncing analytics spool segment")
+
+
+writer = SegmentWriter()
+
+
+def append(*records):
+    writer.append(*records)
+
+
+@atexit.register
+def _close_on_exit():
+    try:
+        writer.close()
+    except OSError:
+        logger.exception("Error closing analytics spool segment on shutdown")
+
+
+# Loading
+
+def close_stale_segments(max_age, directory=None):
+    """Close open segments not written to for max_age seconds (their process is gone)"""
+    directory = directory or spool_dir()
+    closed = 0
+    for name in os.listdir(directory) if os.path.isdir(directory) else []:
+        path = os.path.join(directory, name)
+        if name.endswith(OPEN_SUFFIX) and time.time() - os.path.getmtime(path) >= max_age:
+            os.rename(path, path[:-len(OPEN_SUFFIX)] + SEGMENT_SUFFIX)
+            closed += 1
+    return closed
+
+
+def closed_segments(directory=None):
+    """Paths of closed segments, oldest first"""
+    directory = directory or spool_dir()
+    if not os.path.isdir(directory):
+        return []
+    names = [name for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX)]
+    # Retried orphans are prefixed, so sort on the creation time they are named by
+    names.sort(key=lambda name: name.rsplit('~', 1)[-1])
+    return [os.path.join(directory, name) for name in names]
+
+
+def read_segment(path):
+    with open(path, 'rb') as segment:
+        for number, line in enumerate(segment, start=1):
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # Only the last line of a segment whose writer crashed can be partial
+                logger.warning("Skipping unreadable line %s of %s", number, path)
+
+
+def orphaned_ends(record, results, now):
+    """Events of a record to retry because their session wasn't loaded yet"""
+    if now - parse_datetime(record['at']) > timedelta(seconds=ORPHAN_RETRY_SECONDS):
+        return []
+    return [
+        record['events'][result['index']] for result in results
+        if result.get('error') == 'Session not found'
+    ]
+
+
+def load_segment(path, retry_writer=None):
+    """
+    Apply one closed segment and remove it; returns the number of records
+    loaded, or None if it had already been loaded
+    """
+    name = os.path.basename(path)
+    records = list(read_segment(path))
+    counters = CounterBuffer(autoflush=False)
+    retries = []
+    now = timezone.now()
+    try:
+        with transaction.atomic():
+            SpoolCheckpoint.objects.create(segment=name, records=len(records))
+            users = ShopUser.objects.in_bulk({record['user_id'] for record in records if record.get('user_id')})
+            for record in records:
+                results = process_events(
+                    record['events'],
+                    user=users.get(record.get('user_id')),
+                    ip_address=record.get('ip_address'),
+                    device_id=device_id(record.get('user_agent', '')),
+                    user_agent=record.get('user_agent', ''),
+                    now=parse_datetime(record['at']),
+                    counter_buffer=counters,
+                )
+                orphans = orphaned_ends(record, results, now)
+                if orphans:
+                    retries.append({**record, 'events': orphans})
+            counters.flush()
+    except IntegrityError:
+        # Loaded before (or concurrently by another loader)
+        if not SpoolCheckpoint.objects.filter(segment=name).exists():
+            raise
+        os.remove(path)
+        return None
+
+    if retries:
+        retry_writer = retry_writer or SegmentWriter(os.path.dirname(path), prefix='retry~')
+        retry_writer.append(*retries)
+    os.remove(path)
+    return len(records)
+
+
+def load_spool(directory=None, stale_after=None):
+    """Load every closed segment; returns (segments loaded, records loaded)"""
+    directory = directory or spool_dir()
+    if stale_after is not None:
+        close_stale_segments(stale_after, directory)
+    retry_writer = SegmentWriter(directory, prefix='retry~')
+    segments = records = 0
+    try:
+        for path in closed_segments(directory):
+            loaded = load_segment(path, retry_writer)
+            if loaded is not None:
+                segments += 1
+                records += loaded
+    finally:
+        # Retries go in a segment of their own for the next run
+        retry_writer.close()
+    return segments, records
@@ -0,0 +1,103 @@
+"""
+Faceted product counts.
+
+One GROUP BY over the facet columns gives the number of products for every
+combination of category, age, gender, brand and manufacturer. That table is
+cached until the catalog changes, and the counts for any filter context are
+computed from it in memory.
+"""
+import hashlib
+from collections import Counter
+from django.core.cache import cache
+from django.db.models import Count
+from .caching import catalog_cache_key, COUNT_CACHE_TIMEOUT
+from .models import Product
+
+# Facet name (also its filter query parameter) -> Product field
+FACETS = {
+    'category': 'product_category',
+    'age_group': 'standardized_age',
+    'gender': 'gender',
+    'brand': 'brand',
+    'manufacturer': 'manufacturer_id',
+}
+
+
+def combination_counts():
+    """Product counts per combination of facet values, plus manufacturer names"""
+    key = catalog_cache_key('facet-combinations')
+    cached = cache.get(key)
+    if cached is None:
+        rows = (
+            Product.objects.order_by()
+            .values_list(*FACETS.values(), 'manufacturer__name')
+            .annotate(count=Count('id'))
+        )
+        combinations, manufacturer_names = [], {}
+        for *values, manufacturer_name, count in rows:
+            combinations.append((tuple(values), count))
+            if values[-1] is not None:
+                manufacturer_names[values[-1]] = manufacturer_name
+        cached = (combinations, manufacturer_names)
+        cache.set(key, cached, COUNT_CACHE_TIMEOUT)
+    return cached
+
+
+def selected_filters(params):
+    """Read facet filters from query parameters; repeat a parameter to select several values"""
+    selected = {}
+    for facet in FACETS:
+        values = {value for value in params.getlist(facet) if value}
+        if values:
+            selected[facet] = values
+    return selected
+
+
+def facet_counts(selected):
+    """
+    Count products per facet value within the filter context.
+
+    Each facet is counted with every filter applied except its own, so a UI can
+    show how many products selecting another value of that facet would add.
+    """
+    key_source = repr(sorted((facet, sorted(values)) for facet, values in selected.items()))
+    key = catalog_cache_key('facets', hashlib.md5(key_source.encode()).hexdigest())
+    result = cache.get(key)
+    if result is not None:
+        return result
+
+    combinations, manufacturer_names = combination_counts()
+    names = list(FACETS)
+    counters = {facet: Counter() for facet in names}
+    total = 0
+
+    for values, count in combinations:
+        mismatched = [
+            facet for facet, value in zip(names, values)
+            if facet in selected and str(value) not in selected[facet]
+        ]
+        if not mismatched:
+            total += count
+            for facet, value in zip(names, values):
+                counters[facet][value] += count
+        elif len(mismatched) == 1:
+            facet = mismatched[0]
+            counters[facet][values[names.index(facet)]] += count
+
+    facets = {}
+    for facet, counter in counters.items():
+        items = sorted(
+            ((value, count) for value, count in counter.items() if value not in (None, '')),
+            key=lambda item: (-item[1], str(item[0]))
+        )
+        if facet == 'manufacturer':
+            facets[facet] = [
+                {'value': value, 'name': manufacturer_names.get(value), 'count': count}
+                for value, count in items
+            ]
+        else:
+            facets[facet] = [{'value': value, 'count': count} for value, count in items]
+
+    result = {'count': total, 'facets': facets}
+    cache.set(key, result, COUNT_CACHE_TIMEOUT)
+    return result
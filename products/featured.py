@@ -0,0 +1,139 @@
+"""
+Materialized trending/top product lists.
+
+Each featured list is stored in the cache as its rendered JSON body, so the
+home-screen endpoints are a single cache read. The blobs are rebuilt once the
+transaction that changed a featured placement, product, gallery item or
+manufacturer commits.
+
+The trending list is the products pinned to it, followed by the latest
+snapshot of the trending ranking (see trending), and is also rebuilt when
+that ranking changes.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from collections import Counter
+from django.db import transaction
+from django.http import HttpResponse
+from .fieldsets import VIEWS, fieldset_queryset
+from .models import Product, FeaturedProduct, TrendingScore
+from .renderers import dumps
+from .serializers import ProductSerializer
+
+FEATURED_TYPES = [featured_type for featured_type, _ in FeaturedProduct.FEATURED_TYPE_CHOICES]
+
+# Every named view of a list is materialized
+FEATURED_VIEWS = ['full', *VIEWS]
+
+# Length of the trending list when it's filled from the trending ranking
+TRENDING_SIZE = 10
+
+# Bounds staleness in workers that don't share the cache (the blobs are rebuilt on change anyway)
+FEATURED_CACHE_TIMEOUT = getattr(settings, 'FEATURED_CACHE_TIMEOUT', 300)
+
+# Rebuild requests per featured type, and the request count each type was last built at
+_requested = Counter()
+_built = {}
+
+
+def featured_cache_key(featured_type, view='full'):
+    if view == 'full':
+        return f'products:featured:{featured_type}'
+    return f'products:featured:{featured_type}:{view}'
+
+
+def trending_product_ids(size=TRENDING_SIZE):
+    """Products pinned to the trending list in display order, then the best-ranked other products"""
+    pinned = list(
+        FeaturedProduct.objects.filter(featured_type='trending')
+        .order_by('display_order').values_list('product_id', flat=True)
+    )
+    ranked = (
+        TrendingScore.objects.filter(rank__isnull=False).exclude(product_id__in=pinned)
+        .order_by('rank').values_list('product_id', flat=True)[:max(size - len(pinned), 0)]
+    )
+    return pinned + list(ranked)
+
+
+def featured_products(featured_type, fields=None):
+    """Get products placed in a featured list, falling back to the newest products"""
+    if featured_type == 'trending':
+        product_ids = trending_product_ids()
+        by_id = fieldset_queryset(Product.objects.all(), fields, extra_columns=['id']).in_bulk(product_ids)
+        products = [by_id[product_id] for product_id in product_ids if product_id in by_id]
+    else:
+        products = list(
+            fieldset_queryset(Product.objects.all(), fields, extra_columns=['id'])
+            .filter(featured_placements__featured_type=featured_type)
+            .order_by('featured_placements__display_order')
+        )
+
+    if not products:
+        return list(fieldset_queryset(Product.objects.order_by('-id'), fields)[:10]), True
+
+    return products, False
+
+
+def build_featured(featured_type, view='full'):
+    """Serialize and render one view of a featured list, and store it in the cache"""
+    fields = VIEWS.get(view)
+    products, fallback = featured_products(featured_type, fields)
+    entry = {
+        'body': dumps(ProductSerializer(products, many=True, fields=fields).data),
+        'product_ids': [product.id for product in products],
+        'fallback': fallback,
+    }
+    cache.set(featured_cache_key(featured_type, view), entry, FEATURED_CACHE_TIMEOUT)
+    return entry
+
+
+def featured_response(featured_type, view='full'):
+    entry = cache.get(featured_cache_key(featured_type, view))
+    if entry is None:
+        entry = build_featured(featured_type, view)
+    return HttpResponse(entry['body'], content_type='application/json')
+
+
+def affects_featured(featured_type, product_ids):
+    """Whether a change to any of the products can change a cached view of a featured list"""
+    entries = cache.get_many([featured_cache_key(featured_type, view) for view in FEATURED_VIEWS])
+    # The fallback list is the newest products, which any product write can change
+    return any(entry['fallback'] or not product_ids.isdisjoint(entry['product_ids']) for entry in entries.values())
+
+
+def schedule_rebuild(featured_types=None):
+    """Drop the cached lists now and rebuild them once the current transaction commits"""
+    featured_types = featured_types or FEATURED_TYPES
+    for featured_type in featured_types:
+        cache.delete_many([featured_cache_key(featured_type, view) for view in FEATURED_VIEWS])
+        _requested[featured_type] += 1
+        transaction.on_commit(lambda featured_type=featured_type: _rebuild(featured_type))
+
+
+def _rebuild(featured_type):
+    # Several writes in one transaction queue several callbacks; the first one builds for all
+    requested = _requested[featured_type]
+    if _built.get(featured_type) == requested:
+        return
+    _built[featured_type] = requested
+    for view in FEATURED_VIEWS:
+        build_featured(featured_type, view)
+
+
+def products_changed(product_ids):
+    product_ids = set(product_ids)
+    featured_types = [
+        featured_type for featured_type in FEATURED_TYPES
+        if affects_featured(featured_type, product_ids)
+    ]
+    if featured_types:
+        schedule_rebuild(featured_types)
+
+
+def product_changed(product_id):
+    products_changed([product_id])
+
+
+def manufacturer_changed(manufacturer):
+    """Manufacturer names are part of the list bodies"""
+    products_changed(manufacturer.products.values_list('id', flat=True))
@@ -0,0 +1,87 @@
+"""
+Sparse fieldsets for product responses.
+
+?view=card|full picks a named set of serializer fields; ?fields= and ?exclude=
+(comma separated) choose or drop individual ones. The product queryset is then
+narrowed with only() to the columns those fields read, and the manufacturer
+join and gallery prefetch are skipped unless a chosen field needs them.
+"""
+
+
+class InvalidFieldset(ValueError):
+    pass
+
+
+# Named views; 'full' is every field of the serializer
+VIEWS = {
+    'card': ['id', 'title', 'brand', 'image_url'],
+}
+
+# Serializer field -> product columns it reads
+FIELD_COLUMNS = {
+    'id': ['id'],
+    'title': ['title'],
+    'brand': ['brand'],
+    'product_category': ['product_category'],
+    'age_group': ['age_group'],
+    'gender': ['gender'],
+    'description': ['description'],
+    'manufacturer_name': ['manufacturer__name'],
+    'image_url': ['primary_image_file', 'flicks'],
+    'video_url': ['flicks'],
+    'gallery_items': [],
+    'gallery': [],
+}
+
+# Serializer fields read from the prefetched gallery
+GALLERY_FIELDS = {'gallery_items', 'gallery'}
+
+
+def split_fields(value):
+    return [name.strip() for name in (value or '').split(',') if name.strip()]
+
+
+def requested_fields(params, serializer_class):
+    """
+    Serializer fields picked by the query parameters, in serializer order.
+
+    Returns None when every field is wanted, so callers can keep their full query.
+    """
+    available = list(serializer_class.Meta.fields)
+    view = params.get('view') or 'full'
+    if view != 'full' and view not in VIEWS:
+        raise InvalidFieldset(f"Unsupported view. Choose one of: full, {', '.join(VIEWS)}")
+
+    chosen = set(VIEWS.get(view, available))
+    requested = split_fields(params.get('fields'))
+    excluded = split_fields(params.get('exclude'))
+    unknown = [name for name in requested + excluded if name not in available]
+    if unknown:
+        raise InvalidFieldset(f"Unknown fields: {', '.join(unknown)}. Choose from: {', '.join(available)}")
+
+    if requested:
+        chosen = set(requested)
+    chosen -= set(excluded)
+
+    fields = [name for name in available if name in chosen]
+    return None if fields == available else fields
+
+
+def fieldset_queryset(queryset, fields, extra_columns=()):
+    """
+    Load only what `fields` needs from a product queryset.
+
+    extra_columns are loaded as well, e.g. the columns a keyset page is sorted on.
+    """
+    if fields is None:
+        return queryset.with_media()
+
+    columns = {'id', *(column.lstrip('-') for column in extra_columns)}
+    for name in fields:
+        columns.update(FIELD_COLUMNS[name])
+
+    if 'manufacturer__name' in columns:
+        queryset = queryset.select_related('manufacturer')
+    if GALLERY_FIELDS.intersection(fields):
+        queryset = queryset.prefetch_related('gallery')
+    return queryset.only(*sorted(columns))
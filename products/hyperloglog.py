@@ -0,0 +1,87 @@
+"""
+HyperLogLog cardinality sketches.
+
+A sketch estimates the number of distinct values added to it from 2**precision
+one-byte registers, with a relative standard error of 1.04 / sqrt(2**precision)
+(1.6% at the default precision of 12). Sketches of the same precision merge by
+taking the register-wise maximum, so the union of any set of sketches (days,
+products) is estimated as accurately as a single one.
+"""
+import hashlib
+import math
+import zlib
+import numpy as np
+
+DEFAULT_PRECISION = 12
+
+
+def hash_value(value):
+    """64-bit hash of a string, the unit sketches are built from"""
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+
+class HyperLogLog:
+    def __init__(self, precision=DEFAULT_PRECISION, registers=None):
+        if not 4 <= precision <= 16:
+            raise ValueError("precision must be between 4 and 16")
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8) if registers is None else registers
+
+    @property
+    def size(self):
+        return 1 << self.precision
+
+    def add_hash(self, hashed):
+        """Add a 64-bit hash (see hash_value)"""
+        rest_bits = 64 - self.precision
+        index = hashed >> rest_bits
+        rest = hashed & ((1 << rest_bits) - 1)
+        # Position of the leftmost 1 bit in the remaining bits
+        rank = rest_bits - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def add(self, value):
+        self.add_hash(hash_value(value))
+
+    def merge(self, other):
+        """Fold another sketch into this one"""
+        if other.precision != self.precision:
+            raise ValueError("Only sketches of the same precision can be merged")
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    @classmethod
+    def union(cls, sketches, precision=DEFAULT_PRECISION):
+        result = cls(precision)
+        for sketch in sketches:
+            result.merge(sketch)
+        return result
+
+    @property
+    def relative_error(self):
+        """Relative standard error of the estimate"""
+        return 1.04 / math.sqrt(self.size)
+
+    def estimate(self):
+        m = self.size
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / float(np.sum(np.ldexp(1.0, -self.registers.astype(np.int64))))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small cardinalities
+            return m * math.log(m / zeros)
+        return raw
+
+    def to_bytes(self):
+        # Mostly-empty sketches (the usual case for an hour of one product) compress to a few bytes
+        return bytes([self.precision]) + zlib.compress(self.registers.tobytes())
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = bytes(data)
+        registers = np.frombuffer(zlib.decompress(data[1:]), dtype=np.uint8).copy()
+        return cls(data[0], registers)
+
+    def __len__(self):
+        return round(self.estimate())
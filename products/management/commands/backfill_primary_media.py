@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from products.models import PRIMARY_MEDIA_FIELDS, Product, ProductGallery
+from products.utils.media_processors import get_image_size
+
+
+class Command(BaseCommand):
+    help = 'Populate the denormalized primary image/video columns on existing products'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Number of products to update per transaction (default: 500)'
+        )
+        parser.add_argument(
+            '--read-dimensions', action='store_true',
+            help='Read missing image dimensions from storage (one file read per primary image)'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        read_dimensions = options['read_dimensions']
+        last_id = 0
+        updated = 0
+
+        while True:
+            # Walk the table by id so each batch is an index range scan
+            batch = list(
+                Product.objects.filter(id__gt=last_id)
+                .order_by('id')
+                .only('id')
+                .prefetch_related('gallery')[:batch_size]
+            )
+            if not batch:
+                break
+
+            with transaction.atomic():
+                for product in batch:
+                    if read_dimensions:
+                        self.fill_dimensions(product)
+                    for field, value in product.primary_media_values().items():
+                        setattr(product, field, value)
+                Product.objects.bulk_update(batch, PRIMARY_MEDIA_FIELDS)
+
+            updated += len(batch)
+            last_id = batch[-1].id
+            self.stdout.write(f"Updated {updated} products...")
+
+        self.stdout.write(self.style.SUCCESS(f"Backfilled primary media for {updated} products"))
+
+    def fill_dimensions(self, product):
+        item = product.primary_gallery_item('image')
+        if not item or not item.image or item.width:
+            return
+        item.width, item.height = get_image_size(item.image)
+        ProductGallery.objects.filter(pk=item.pk).update(width=item.width, height=item.height)
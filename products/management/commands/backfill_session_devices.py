@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from products.devices import device_id
+from products.models import ViewSession
+
+
+class Command(BaseCommand):
+    help = 'Point view sessions that store a raw user agent at their Device row, and drop the user agent'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=2000,
+            help='Number of sessions to update per transaction (default: 2000)'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_id = 0
+        updated = 0
+
+        while True:
+            # Walk the table by id so each batch is an index range scan
+            batch = list(
+                ViewSession.objects.filter(id__gt=last_id, device__isnull=True)
+                .order_by('id')
+                .only('id', 'device_info')[:batch_size]
+            )
+            if not batch:
+                break
+
+            with transaction.atomic():
+                for session in batch:
+                    session.device_id = device_id((session.device_info or {}).get('user_agent', ''))
+                    session.device_info = {}
+                ViewSession.objects.bulk_update(batch, ['device', 'device_info'])
+
+            updated += len(batch)
+            last_id = batch[-1].id
+            self.stdout.write(f"Updated {updated} sessions...")
+
+        self.stdout.write(self.style.SUCCESS(f"Backfilled devices for {updated} view sessions"))
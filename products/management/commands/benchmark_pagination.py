@@ -0,0 +1,82 @@
+import statistics
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from products.models import Product
+from products.pagination import encode_cursor, paginate_keyset
+
+
+class Command(BaseCommand):
+    help = 'Compare OFFSET and cursor pagination latency for the product list at different page depths'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--pages', default='1,5000',
+            help='Comma separated page numbers to time (default: 1,5000)'
+        )
+        parser.add_argument('--page-size', type=int, default=10)
+        parser.add_argument('--repeat', type=int, default=20, help='Runs per measurement (median is reported)')
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='Insert this many synthetic products first; they are rolled back afterwards'
+        )
+
+    def handle(self, *args, **options):
+        page_size = options['page_size']
+        repeat = options['repeat']
+        pages = [int(page) for page in options['pages'].split(',') if page]
+
+        with transaction.atomic():
+            if options['seed']:
+                self.seed(options['seed'])
+
+            total = Product.objects.count()
+            self.stdout.write(f"{total} products, page size {page_size}, median of {repeat} runs")
+            self.stdout.write(f"{'page':>8} {'offset ms':>12} {'cursor ms':>12}")
+
+            for page in pages:
+                offset = (page - 1) * page_size
+                if offset >= total:
+                    self.stdout.write(self.style.WARNING(f"{page:>8} skipped: only {total} products"))
+                    continue
+
+                offset_ms = self.time(repeat, lambda: list(
+                    Product.objects.with_media().order_by('id')[offset:offset + page_size]
+                ))
+
+                # The cursor a client would hold after scrolling to this page
+                after = None
+                if offset:
+                    last_id = Product.objects.order_by('id').values_list('id', flat=True)[offset - 1]
+                    after = encode_cursor('id', [last_id])
+                cursor_ms = self.time(repeat, lambda: paginate_keyset(
+                    Product.objects.with_media(), after=after, page_size=page_size
+                ))
+
+                self.stdout.write(f"{page:>8} {offset_ms:>12.3f} {cursor_ms:>12.3f}")
+
+            transaction.set_rollback(True)
+
+    def time(self, repeat, func):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - start) * 1000)
+        return statistics.median(timings)
+
+    def seed(self, count):
+        Product.objects.bulk_create(
+            [
+                Product(
+                    title=f'Benchmark product {i}',
+                    product_category='Benchmark',
+                    age_group='3-5 Years',
+                    standardized_age='3-5 Years',
+                    brand='Benchmark',
+                    description='Synthetic product for pagination benchmarks',
+                )
+                for i in range(count)
+            ],
+            batch_size=1000
+        )
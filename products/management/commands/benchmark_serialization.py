@@ -0,0 +1,87 @@
+import statistics
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from products.models import Product, ProductGallery
+from products.row_compiler import compile_products, product_values
+from products.serializers import ProductSerializer
+
+
+class Command(BaseCommand):
+    help = 'Compare DRF serializer and row compiler latency for product list pages'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--page-sizes', default='10,50,100',
+            help='Comma separated page sizes to time (default: 10,50,100)'
+        )
+        parser.add_argument('--repeat', type=int, default=20, help='Runs per measurement (median is reported)')
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='Insert this many synthetic products (with two gallery items each) first; '
+                 'they are rolled back afterwards'
+        )
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+        page_sizes = [int(size) for size in options['page_sizes'].split(',') if size]
+
+        with transaction.atomic():
+            if options['seed']:
+                self.seed(options['seed'])
+
+            total = Product.objects.count()
+            self.stdout.write(f"{total} products, median of {repeat} runs")
+            self.stdout.write(f"{'page size':>10} {'drf ms':>10} {'compiled ms':>12} {'speedup':>8}")
+
+            for page_size in page_sizes:
+                drf_ms = self.time(repeat, lambda: ProductSerializer(
+                    Product.objects.with_media().order_by('id')[:page_size], many=True
+                ).data)
+                compiled_ms = self.time(repeat, lambda: compile_products(
+                    product_values(Product.objects.order_by('id'))[:page_size]
+                ))
+                self.stdout.write(
+                    f"{page_size:>10} {drf_ms:>10.3f} {compiled_ms:>12.3f} {drf_ms / compiled_ms:>7.1f}x"
+                )
+
+            transaction.set_rollback(True)
+
+    def time(self, repeat, func):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - start) * 1000)
+        return statistics.median(timings)
+
+    def seed(self, count):
+        products = Product.objects.bulk_create(
+            [
+                Product(
+                    title=f'Benchmark product {i}',
+                    product_category='Benchmark',
+                    age_group='3-5 Years',
+                    standardized_age='3-5 Years',
+                    brand='Benchmark',
+                    description='Synthetic product for serialization benchmarks',
+                    primary_image_file=f'products/photos/benchmark-{i}.jpg',
+                )
+                for i in range(count)
+            ],
+            batch_size=1000
+        )
+        ProductGallery.objects.bulk_create(
+            [
+                ProductGallery(
+                    product=product,
+                    media_type='image',
+                    image=f'products/gallery/benchmark-{product.pk}-{n}.jpg',
+                    is_primary=n == 0,
+                    display_order=n,
+                )
+                for product in products
+                for n in range(2)
+            ],
+            batch_size=1000
+        )
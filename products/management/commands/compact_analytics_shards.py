@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from products.analytics_buffer import compact_shards
+from products.models import FlicksAnalyticsShard
+
+
+class Command(BaseCommand):
+    help = 'Fold sharded FlicksAnalytics counters back into the per-product FlicksAnalytics rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=200,
+            help='Number of products to compact per transaction (default: 200)'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_id = 0
+        compacted = 0
+
+        while True:
+            product_ids = list(
+                FlicksAnalyticsShard.objects.filter(product_id__gt=last_id)
+                .exclude(views=0, total_watch_time=0)
+                .order_by('product_id')
+                .values_list('product_id', flat=True)
+                .distinct()[:batch_size]
+            )
+            if not product_ids:
+                break
+
+            compacted += compact_shards(product_ids)
+            last_id = product_ids[-1]
+
+        self.stdout.write(self.style.SUCCESS(f'Compacted analytics shards of {compacted} products'))
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from products.trending import run_trending
+
+
+class Command(BaseCommand):
+    help = 'Update the time-decayed trending scores and store a new ranked snapshot (run every few minutes)'
+
+    def handle(self, *args, **options):
+        scored = run_trending()
+        self.stdout.write(self.style.SUCCESS(f'Added engagement for {scored} products to the trending scores'))
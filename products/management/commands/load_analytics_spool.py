@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from products.event_spool import load_spool
+
+
+class Command(BaseCommand):
+    help = 'Load closed analytics spool segments into ViewSession and FlicksAnalytics, each exactly once'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dir', default=None,
+            help='Spool directory (default: ANALYTICS_SPOOL_DIR)'
+        )
+        parser.add_argument(
+            '--close-stale', type=int, default=600, metavar='SECONDS',
+            help='First close open segments not written to for this long, left by exited processes (default: 600)'
+        )
+
+    def handle(self, *args, **options):
+        segments, records = load_spool(options['dir'], stale_after=options['close_stale'])
+        self.stdout.write(self.style.SUCCESS(f'Loaded {records} records from {segments} spool segments'))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from products.retention import load_archive
+
+
+class Command(BaseCommand):
+    help = 'Re-import archived view sessions from a file or directory on the default storage'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path',
+            help='An archive file, or a directory such as analytics/archive/view_sessions/2025/01'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Sessions per insert (default: 1000)'
+        )
+
+    def handle(self, *args, **options):
+        loaded, skipped = load_archive(options['path'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Loaded {loaded} view sessions ({skipped} skipped: already present or product deleted)'
+        ))
@@ -0,0 +1,59 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from products import retention
+
+
+class Command(BaseCommand):
+    help = 'Archive view sessions past the retention window to the default storage and remove them'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=None,
+            help='Keep sessions started in the last N days (default: ANALYTICS_SESSION_RETENTION_DAYS)'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=5000,
+            help='Sessions per archive file and delete (default: 5000)'
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only report how many sessions would be archived'
+        )
+        parser.add_argument(
+            '--create-partitions', type=int, default=None, metavar='MONTHS',
+            help='On a partitioned PostgreSQL table, also create partitions for the next MONTHS months'
+        )
+        parser.add_argument(
+            '--print-partition-sql', action='store_true',
+            help='Print the one-off DDL converting the table to monthly partitions, and exit'
+        )
+
+    def handle(self, *args, **options):
+        today = timezone.localdate()
+
+        if options['print_partition_sql']:
+            first = retention.retention_cutoff().date()
+            last = today + timedelta(days=92)
+            self.stdout.write(retention.partition_conversion_sql(first, last))
+            return
+
+        if options['days'] is not None:
+            cutoff = timezone.now() - timedelta(days=options['days'])
+        else:
+            cutoff = retention.retention_cutoff()
+
+        if options['dry_run']:
+            count = retention.prunable_sessions(cutoff).count()
+            self.stdout.write(f'{count} view sessions started before {cutoff:%Y-%m-%d %H:%M} would be archived')
+            return
+
+        if options['create_partitions'] is not None:
+            if not retention.is_partitioned():
+                self.stderr.write('The view session table is not partitioned; see --print-partition-sql')
+            else:
+                created = retention.create_partitions(options['create_partitions'], today)
+                self.stdout.write(f"Created partitions: {', '.join(created) or 'none'}")
+
+        archived = retention.prune_sessions(cutoff, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Archived and removed {archived} view sessions'))
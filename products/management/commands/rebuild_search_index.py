@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from products.models import Product
+from products.search import ensure_search_index, index_products
+
+
+class Command(BaseCommand):
+    help = 'Create the product search index if needed and (re)index every product'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of products to index per batch (default: 1000)'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        ensure_search_index()
+
+        last_id = 0
+        indexed = 0
+        while True:
+            product_ids = list(
+                Product.objects.filter(id__gt=last_id)
+                .order_by('id')
+                .values_list('id', flat=True)[:batch_size]
+            )
+            if not product_ids:
+                break
+            index_products(product_ids)
+            indexed += len(product_ids)
+            last_id = product_ids[-1]
+            self.stdout.write(f"Indexed {indexed} products...")
+
+        self.stdout.write(self.style.SUCCESS(f"Search index rebuilt for {indexed} products"))
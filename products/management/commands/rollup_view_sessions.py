@@ -0,0 +1,17 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from products.rollups import run_rollups
+
+
+class Command(BaseCommand):
+    help = 'Add view sessions that ended since the last run to the hourly and daily analytics rollups'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--window-hours', type=int, default=24,
+            help='Hours of sessions to aggregate per transaction (default: 24)'
+        )
+
+    def handle(self, *args, **options):
+        groups = run_rollups(window=timedelta(hours=options['window_hours']))
+        self.stdout.write(self.style.SUCCESS(f'Rolled up {groups} product-hours of view sessions'))
@@ -1,11 +1,14 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models.functions import Coalesce
 from django.core.exceptions import ValidationError
 from django.core.validators import RegexValidator
 from django.contrib.auth.models import AbstractUser, Group, Permission
+from django.contrib.postgres.search import SearchVectorField
 from .utils.media_processors import (
     process_video, 
     process_product_image, 
-    process_banner_image
+    process_banner_image,
+    get_image_size
 )
 from django.utils import timezone
 
@@ -128,6 +131,36 @@ class Distributor(models.Model):
         if not self.email and not self.phone:
             raise ValidationError('At least one contact method (email/phone) is required')
 
+class ProductQuerySet(models.QuerySet):
+    def with_media(self):
+        """Load manufacturer and gallery up front so list serialization costs a fixed number of queries"""
+        return self.select_related('manufacturer').prefetch_related('gallery')
+
+    def with_counters(self):
+        """
+        Annotate analytics_views and analytics_watch_time, the FlicksAnalytics counters
+        including shard counts (as FlicksAnalytics.for_product), in the same query
+        """
+        def counter(field):
+            canonical = FlicksAnalytics.objects.filter(product=models.OuterRef('pk')).values(field)[:1]
+            shards = (
+                FlicksAnalyticsShard.objects.filter(product=models.OuterRef('pk'))
+                .values('product').annotate(total=models.Sum(field)).values('total')
+            )
+            return (
+                Coalesce(models.Subquery(canonical), 0)
+                + Coalesce(models.Subquery(shards), 0)
+            )
+
+        return self.annotate(analytics_views=counter('views'), analytics_watch_time=counter('total_watch_time'))
+
+
+# Denormalized from the gallery by Product.refresh_primary_media only
+PRIMARY_MEDIA_FIELDS = (
+    'primary_image_file', 'primary_image_width', 'primary_image_height',
+    'primary_video_file', 'primary_video_duration',
+)
+
 class Product(models.Model):
     GENDER_CHOICES=[
         ('M','Male'),
@@ -176,6 +209,38 @@ class Product(models.Model):
         help_text="Duration of the video in seconds"
     )
 
+    # Copied from the primary ProductGallery items on write, so product cards
+    # can be rendered from this row alone. Kept current by ProductGallery and
+    # its post_delete signal, and never written by Product.save (see
+    # PRIMARY_MEDIA_FIELDS), so a stale instance can't overwrite them.
+    primary_image_file = models.ImageField(upload_to='products/photos/', blank=True, null=True, editable=False)
+    primary_image_width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    primary_image_height = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    primary_video_file = models.FileField(upload_to='products/videos/', blank=True, null=True, editable=False)
+    primary_video_duration = models.PositiveIntegerField(null=True, blank=True, editable=False)
+
+    # Weighted full-text document on PostgreSQL (GIN indexed, see products.search)
+    search_vector = SearchVectorField(null=True, blank=True, editable=False)
+
+    # Bumped whenever the product or its gallery changes; product ETags are built from it
+    version = models.PositiveIntegerField(default=1, editable=False)
+    updated_at = models.DateTimeField(default=timezone.now, editable=False)
+
+    objects = ProductQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Keyset pagination over the supported sort keys
+            models.Index(fields=['title', 'id']),
+            models.Index(fields=['brand', 'id']),
+            # filter_products: each filter alone, and gender with age, read in
+            # id order so keyset pages need no sort
+            models.Index(fields=['product_category', 'id']),
+            models.Index(fields=['gender', 'id']),
+            models.Index(fields=['standardized_age', 'id']),
+            models.Index(fields=['gender', 'standardized_age', 'id']),
+        ]
+
     def primary_image(self):
         """Get primary image from the ProductImage model"""
         primary = self.images.filter(is_primary=True).first()
@@ -186,11 +251,21 @@ class Product(models.Model):
 
     def primary_image(self):
         """Get primary image from the ProductGallery model"""
-        primary = self.gallery.filter(is_primary=True, media_type='image').first()
+        primary = self.primary_gallery_item('image')
         if primary and primary.image:
             return primary.image
         return None
 
+    def primary_gallery_item(self, media_type):
+        """Get the primary gallery item of a media type, using prefetched gallery rows when available"""
+        if 'gallery' in getattr(self, '_prefetched_objects_cache', {}):
+            # Gallery ordering puts primary items first, matching .filter(...).first()
+            for item in self.gallery.all():
+                if item.is_primary and item.media_type == media_type:
+                    return item
+            return None
+        return self.gallery.filter(is_primary=True, media_type=media_type).first()
+
     # Remove the primary_video method if you don't want that concept
     # Or replace it with a method that just returns the flicks field
     def get_video(self):
@@ -209,12 +284,57 @@ class Product(models.Model):
         """Get all videos from gallery"""
         return self.gallery.filter(media_type='video')
 
+    def primary_media_values(self):
+        """Get the denormalized primary media column values from the gallery"""
+        image_item = self.primary_gallery_item('image')
+        video_item = self.primary_gallery_item('video')
+        return {
+            'primary_image_file': image_item.image.name if image_item and image_item.image else None,
+            'primary_image_width': image_item.width if image_item else None,
+            'primary_image_height': image_item.height if image_item else None,
+            'primary_video_file': video_item.video.name if video_item and video_item.video else None,
+            'primary_video_duration': video_item.video_duration if video_item else None,
+        }
+
+    def refresh_primary_media(self):
+        """Copy the current primary gallery image/video onto the product row"""
+        # Drop any prefetched gallery so the values reflect the write that just happened
+        getattr(self, '_prefetched_objects_cache', {}).pop('gallery', None)
+        values = self.primary_media_values()
+        Product.objects.filter(pk=self.pk).update(**values)
+        for field, value in values.items():
+            setattr(self, field, value)
+
+    def bump_version(self):
+        """Mark the product as changed without saving the whole row (e.g. on gallery edits)"""
+        Product.objects.filter(pk=self.pk).update(
+            version=models.F('version') + 1,
+            updated_at=timezone.now()
+        )
+
     def save(self, *args, **kwargs):
         if self.flicks and hasattr(self.flicks, 'file') and not kwargs.pop('no_process', False):
             self.flicks, duration = process_video(self.flicks)
             if duration:
                 self.video_duration = duration
-        super().save(*args, **kwargs)
+        self.updated_at = timezone.now()
+        if self._state.adding:
+            super().save(*args, **kwargs)
+            return
+
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None:
+            update_fields = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in PRIMARY_MEDIA_FIELDS
+            ]
+        # The version is only ever bumped in the database, so a stale instance
+        # can't write back a version another change already used
+        kwargs['update_fields'] = [name for name in update_fields if name != 'version']
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            self.bump_version()
+        self.refresh_from_db(fields=['version', 'updated_at'])
 
     def __str__(self):
         return self.title
@@ -255,6 +375,8 @@ class ProductGallery(models.Model):
         blank=True,
         help_text="Duration of the video in seconds"
     )
+    width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    height = models.PositiveIntegerField(null=True, blank=True, editable=False)
     is_primary = models.BooleanField(default=False)
     alt_text = models.CharField(max_length=100, blank=True)
     display_order = models.PositiveIntegerField(default=0)
@@ -308,24 +430,32 @@ class ProductGallery(models.Model):
                 # Log exception
                 print(f"Error while processing video in ProductGallery: {str(e)}")
         
-        # Handle primary flag (ensure only one primary media per product)
-        if self.is_primary:
-            # First, ensure we're only competing with the same media type
-            ProductGallery.objects.filter(
-                product=self.product, 
-                media_type=self.media_type,
-                is_primary=True
-            ).exclude(pk=self.pk).update(is_primary=False)
+        # Record dimensions of newly uploaded images
+        if self.media_type == 'image' and self.image and not self.image._committed:
+            self.width, self.height = get_image_size(self.image)
         
-        # Make first gallery item primary by default
-        if not self.pk and not ProductGallery.objects.filter(
-            product=self.product, 
-            media_type=self.media_type
-        ).exists():
-            self.is_primary = True
+        with transaction.atomic():
+            # Handle primary flag (ensure only one primary media per product)
+            if self.is_primary:
+                # First, ensure we're only competing with the same media type
+                ProductGallery.objects.filter(
+                    product=self.product, 
+                    media_type=self.media_type,
+                    is_primary=True
+                ).exclude(pk=self.pk).update(is_primary=False)
             
-        super().save(*args, **kwargs)
-
+            # Make first gallery item primary by default
+            if not self.pk and not ProductGallery.objects.filter(
+                product=self.product, 
+                media_type=self.media_type
+            ).exists():
+                self.is_primary = True
+                
+            super().save(*args, **kwargs)
+            
+            # Keep the product's denormalized primary media in step
+            self.product.refresh_primary_media()
+    
 class Shop(models.Model):
     name = models.CharField(max_length=200)
     description = models.TextField(blank=True)
@@ -406,11 +536,34 @@ class FeaturedProduct(models.Model):
         return f"{self.product.title} - {self.get_featured_type_display()}"
 
 
+class CatalogVersion(models.Model):
+    """Single-row counter bumped on every change that can alter a product API response"""
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    @classmethod
+    def current(cls):
+        """Get (version, updated_at) of the catalog"""
+        return cls.objects.filter(pk=1).values_list('version', 'updated_at').first() or (0, None)
+
+    @classmethod
+    def bump(cls):
+        if not cls.objects.filter(pk=1).update(version=models.F('version') + 1, updated_at=timezone.now()):
+            cls.objects.get_or_create(pk=1, defaults={'version': 1})
+
+    def __str__(self):
+        return f"Catalog version {self.version}"
+
+
 class FlicksAnalytics(models.Model):
     """Aggregate analytics for product flicks/videos"""
     product = models.OneToOneField(Product, on_delete=models.CASCADE, related_name='flicks_analytics')
     views = models.PositiveIntegerField(default=0)
     total_watch_time = models.PositiveIntegerField(default=0)  # in seconds
+    unique_viewers = models.BinaryField(null=True, blank=True)  # HyperLogLog sketch of all-time viewers
+    # Ended sessions per bucket of percent / seconds watched (see watch_histograms)
+    percent_histogram = models.BinaryField(null=True, blank=True)
+    seconds_histogram = models.BinaryField(null=True, blank=True)
     updated_at = models.DateTimeField(auto_now=True)
     
     @property
@@ -418,26 +571,154 @@ class FlicksAnalytics(models.Model):
         """Calculate average watch time in seconds"""
         return round(self.total_watch_time / self.views, 2) if self.views > 0 else 0
 
+    @classmethod
+    def for_product(cls, product):
+        """
+        Read-only counters for a product, including increments still held in shard rows.
+
+        The returned instance may be unsaved and must not be saved, or shard counts
+        would be counted twice.
+        """
+        analytics = cls.objects.filter(product=product).first() or cls(product=product)
+        shards = FlicksAnalyticsShard.objects.filter(product=product).aggregate(
+            views=models.Sum('views'), total_watch_time=models.Sum('total_watch_time')
+        )
+        analytics.views += shards['views'] or 0
+        analytics.total_watch_time += shards['total_watch_time'] or 0
+        return analytics
+
     def __str__(self):
         return f"Analytics for {self.product.title}"
 
+class FlicksAnalyticsShard(models.Model):
+    """
+    Partial FlicksAnalytics counters, spread over several rows per product so that
+    concurrent increments for a popular product don't all lock one row.
+    compact_analytics_shards folds them into FlicksAnalytics.
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='flicks_analytics_shards')
+    shard = models.PositiveSmallIntegerField()
+    views = models.IntegerField(default=0)
+    total_watch_time = models.IntegerField(default=0)  # in seconds
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ['product', 'shard']
+
+    def __str__(self):
+        return f"Analytics shard {self.shard} for product {self.product_id}"
+
+class Device(models.Model):
+    """A parsed user agent, shared by every view session from that kind of device"""
+    FORM_FACTOR_CHOICES = (
+        ('mobile', 'Mobile'),
+        ('tablet', 'Tablet'),
+        ('desktop', 'Desktop'),
+        ('bot', 'Bot'),
+        ('other', 'Other'),
+    )
+    
+    # A 4-byte key keeps the reference from ViewSession small
+    id = models.AutoField(primary_key=True)
+    platform = models.CharField(max_length=20)  # app, web or other
+    os = models.CharField(max_length=30)
+    browser = models.CharField(max_length=30, blank=True)
+    app_version = models.CharField(max_length=30, blank=True)
+    form_factor = models.CharField(max_length=10, choices=FORM_FACTOR_CHOICES)
+    
+    class Meta:
+        unique_together = ['platform', 'os', 'browser', 'app_version', 'form_factor']
+    
+    def __str__(self):
+        client = f"{self.platform} {self.app_version}" if self.app_version else self.browser or self.platform
+        return f"{client} on {self.os} ({self.form_factor})"
+
 class ViewSession(models.Model):
     """Individual viewing sessions"""
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='view_sessions')
     user = models.ForeignKey(ShopUser, on_delete=models.SET_NULL, null=True, blank=True)
-    session_id = models.CharField(max_length=100)
+    # Unique, so concurrent retries of a batch can't insert the same session twice
+    session_id = models.CharField(max_length=100, unique=True)
     ip_address = models.GenericIPAddressField(null=True, blank=True)
-    device_info = models.JSONField(default=dict, blank=True)
-    start_time = models.DateTimeField(auto_now_add=True)
+    device_info = models.JSONField(default=dict, blank=True)  # raw user agent of sessions from before Device
+    device = models.ForeignKey(Device, on_delete=models.PROTECT, null=True, blank=True, related_name='view_sessions')
+    start_time = models.DateTimeField(default=timezone.now)
     end_time = models.DateTimeField(null=True, blank=True)
+    # When the end was written; spooled events are loaded well after their end_time
+    recorded_at = models.DateTimeField(null=True, blank=True)
     duration = models.PositiveIntegerField(default=0)  # in seconds
     completed = models.BooleanField(default=False)
     
     class Meta:
         indexes = [
-            models.Index(fields=['session_id']),
             models.Index(fields=['product']),
+            # Rollups pick up newly ended sessions by the time their end was written
+            models.Index(fields=['recorded_at']),
+            # Retention archives and prunes by start time
+            models.Index(fields=['start_time']),
         ]
     
     def __str__(self):
         return f"Session {self.id} for {self.product.title}"
+
+class ViewRollup(models.Model):
+    """Per-product ViewSession totals for one time bucket, keyed by session start time"""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    views = models.PositiveIntegerField(default=0)  # sessions long enough to count as a view
+    watch_seconds = models.PositiveBigIntegerField(default=0)  # watch time of those views
+    completions = models.PositiveIntegerField(default=0)
+    sessions = models.PositiveIntegerField(default=0)  # distinct ended sessions
+    unique_viewers = models.BinaryField(null=True, blank=True)  # HyperLogLog sketch of the bucket's viewers
+
+    class Meta:
+        abstract = True
+
+class HourlyViewRollup(ViewRollup):
+    bucket = models.DateTimeField()  # start of the hour
+
+    class Meta:
+        unique_together = ['product', 'bucket']
+        indexes = [models.Index(fields=['bucket'])]
+
+    def __str__(self):
+        return f"Views of product {self.product_id} in hour {self.bucket:%Y-%m-%d %H}:00"
+
+class DailyViewRollup(ViewRollup):
+    bucket = models.DateField()
+
+    class Meta:
+        unique_together = ['product', 'bucket']
+        indexes = [models.Index(fields=['bucket'])]
+
+    def __str__(self):
+        return f"Views of product {self.product_id} on {self.bucket}"
+
+class TrendingScore(models.Model):
+    """Time-decayed engagement score of a product (see trending)"""
+    product = models.OneToOneField(Product, on_delete=models.CASCADE, related_name='trending_score')
+    score = models.FloatField(default=0)
+    rank = models.PositiveIntegerField(null=True, blank=True)  # position in the latest snapshot
+
+    class Meta:
+        indexes = [models.Index(fields=['rank'])]
+
+    def __str__(self):
+        return f"Trending score {self.score:.2f} for product {self.product_id}"
+
+class SpoolCheckpoint(models.Model):
+    """An analytics spool segment that has been loaded (see event_spool)"""
+    segment = models.CharField(max_length=100, unique=True)
+    records = models.PositiveIntegerField(default=0)
+    loaded_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Spool segment {self.segment}"
+
+class RollupWatermark(models.Model):
+    """How far an incremental aggregation has got"""
+    name = models.CharField(max_length=50, unique=True)
+    position = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} at {self.position}"
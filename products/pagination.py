@@ -0,0 +1,135 @@
+import base64
+import json
+from django.db import models
+from django.db.models import Q
+from django.utils.dateparse import parse_date, parse_datetime
+
+# Supported sort keys and the ordering behind each one. Every ordering ends in
+# id so the keyset is unique and a cursor always points at exactly one row.
+SORT_OPTIONS = {
+    'id': ['id'],
+    '-id': ['-id'],
+    'title': ['title', 'id'],
+    '-title': ['-title', '-id'],
+    'brand': ['brand', 'id'],
+    '-brand': ['-brand', '-id'],
+}
+
+DEFAULT_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 100
+
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor can't be decoded or doesn't match the sort"""
+
+
+def encode_cursor(sort, values):
+    """Encode the sort key values of a row into an opaque cursor token"""
+    raw = json.dumps({'s': sort, 'v': values}, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def valid_cursor_value(field, value):
+    """Whether a decoded cursor value can be compared with the model field it seeks on"""
+    if value is None:
+        return field.null
+    if isinstance(field, models.IntegerField):
+        return isinstance(value, int) and not isinstance(value, bool)
+    if isinstance(field, models.DateTimeField):
+        return isinstance(value, str) and parse_datetime(value) is not None
+    if isinstance(field, models.DateField):
+        return isinstance(value, str) and parse_date(value) is not None
+    if isinstance(field, (models.CharField, models.TextField)):
+        return isinstance(value, str)
+    return False
+
+
+def decode_cursor(token, sort, model=None):
+    """Decode a cursor token back into sort key values, checked against the model's fields if given"""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        data = json.loads(raw)
+        values = data['v']
+    except (ValueError, TypeError, KeyError):
+        raise InvalidCursor('Invalid pagination cursor')
+
+    ordering = SORT_OPTIONS[sort]
+    if data.get('s') != sort or not isinstance(values, list) or len(values) != len(ordering):
+        raise InvalidCursor('Pagination cursor does not match the requested sort')
+    if model is not None:
+        for field, value in zip(ordering, values):
+            if not valid_cursor_value(model._meta.get_field(field.lstrip('-')), value):
+                raise InvalidCursor('Invalid pagination cursor')
+    return values
+
+
+def parse_page_size(value, default=DEFAULT_PAGE_SIZE):
+    """Parse a page_size query parameter, clamped to MAX_PAGE_SIZE"""
+    try:
+        page_size = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(page_size, MAX_PAGE_SIZE))
+
+
+def keyset_filter(ordering, values, forward=True):
+    """
+    Build the WHERE clause selecting rows after (or before) a cursor position.
+
+    For ordering (a, id) this is: a > v1 OR (a = v1 AND id > v2)
+    """
+    condition = Q()
+    equal = {}
+    for field, value in zip(ordering, values):
+        descending = field.startswith('-')
+        name = field.lstrip('-')
+        lookup = 'lt' if descending == forward else 'gt'
+        condition |= Q(**equal, **{f'{name}__{lookup}': value})
+        equal[name] = value
+    return condition
+
+
+def reverse_ordering(ordering):
+    return [field[1:] if field.startswith('-') else f'-{field}' for field in ordering]
+
+
+def row_values(row, ordering):
+    # Rows are model instances, or dicts from a values() queryset
+    if isinstance(row, dict):
+        return [row[field.lstrip('-')] for field in ordering]
+    return [getattr(row, field.lstrip('-')) for field in ordering]
+
+
+def paginate_keyset(queryset, sort='id', after=None, before=None, page_size=DEFAULT_PAGE_SIZE):
+    """
+    Fetch one page of a queryset by keyset (seek) pagination.
+
+    Cost is one indexed range scan of page_size + 1 rows, regardless of how deep
+    the page is. Returns (rows, page_info) where page_info has the cursors for
+    the neighbouring pages.
+    """
+    ordering = SORT_OPTIONS[sort]
+
+    if before:
+        values = decode_cursor(before, sort, queryset.model)
+        rows = list(
+            queryset.filter(keyset_filter(ordering, values, forward=False))
+            .order_by(*reverse_ordering(ordering))[:page_size + 1]
+        )
+        has_previous = len(rows) > page_size
+        rows = rows[:page_size][::-1]
+        has_next = True
+    else:
+        if after:
+            queryset = queryset.filter(keyset_filter(ordering, decode_cursor(after, sort, queryset.model)))
+        rows = list(queryset.order_by(*ordering)[:page_size + 1])
+        has_next = len(rows) > page_size
+        rows = rows[:page_size]
+        has_previous = after is not None
+
+    page_info = {
+        'next_cursor': encode_cursor(sort, row_values(rows[-1], ordering)) if rows and has_next else None,
+        'previous_cursor': encode_cursor(sort, row_values(rows[0], ordering)) if rows and has_previous else None,
+        'has_more': has_next,
+    }
+    return rows, page_info
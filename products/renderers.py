@@ -0,0 +1,79 @@
+"""
+Fast JSON rendering and parsing for the API.
+
+orjson does the encoding and decoding when it is installed; otherwise these
+classes behave exactly like DRF's JSONRenderer and JSONParser. Types orjson
+doesn't know (or formats differently: datetimes, Decimals, lazy translation
+strings, ...) are handed to DRF's JSONEncoder, so the output is the same
+either way.
+"""
+import json
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from rest_framework import renderers, parsers
+from rest_framework.exceptions import ParseError
+from rest_framework.utils import encoders
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_encoder = encoders.JSONEncoder()
+
+if orjson is not None:
+    ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+
+def dumps(data):
+    """Encode data as compact UTF-8 JSON bytes, the way DRF's JSONRenderer does"""
+    if orjson is None:
+        content = json.dumps(
+            data, cls=encoders.JSONEncoder, ensure_ascii=False, allow_nan=False, separators=(',', ':')
+        ).encode()
+    else:
+        content = orjson.dumps(data, default=_encoder.default, option=ORJSON_OPTIONS)
+    # Line and paragraph separators are valid JSON but not valid JavaScript
+    if b'\xe2\x80\xa8' in content or b'\xe2\x80\xa9' in content:
+        content = content.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+    return content
+
+
+class FastJSONRenderer(renderers.JSONRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        # Indented output (e.g. for the browsable API) isn't on the hot path
+        if orjson is None or self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        return dumps(data)
+
+
+class FastJSONParser(parsers.JSONParser):
+    renderer_class = FastJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        if orjson is None or encoding.lower().replace('-', '') != 'utf8':
+            return super().parse(stream, media_type, parser_context)
+        try:
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as exc:
+            raise ParseError('JSON parse error - %s' % str(exc))
+
+
+def stream_json_array(chunks):
+    """Render an iterable of item lists as one JSON array, a chunk at a time"""
+    yield b'['
+    separator = b''
+    for items in chunks:
+        if items:
+            yield separator + dumps(items)[1:-1]
+            separator = b','
+    yield b']'
+
+
+def streaming_json_response(chunks, **kwargs):
+    """JSON array response that is encoded and sent chunk by chunk instead of built in memory"""
+    return StreamingHttpResponse(stream_json_array(chunks), content_type='application/json', **kwargs)
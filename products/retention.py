@@ -0,0 +1,296 @@
+"""
+ViewSession retention.
+
+Sessions that started more than ANALYTICS_SESSION_RETENTION_DAYS ago are
+written to gzip'd NDJSON files on the default storage, then removed from the
+database. Only sessions that are already in the rollups (whose end was
+recorded before the rollup watermark) or that were never ended are pruned, so
+no analytics are lost.
+
+On PostgreSQL the table can be range-partitioned by month on start_time
+(see partition_conversion_sql); whole partitions past the retention window
+are then archived and dropped instead of deleted row by row. Everywhere else
+rows are deleted in id-ordered chunks.
+
+load_archive() re-imports archive files, e.g. for an ad-hoc investigation.
+"""
+import gzip
+import io
+import json
+from datetime import date, datetime, time, timedelta
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .models import Device, Product, ShopUser, ViewSession, RollupWatermark
+from .renderers import dumps
+from .rollups import WATERMARK
+
+ARCHIVE_FIELDS = [
+    'id', 'product_id', 'user_id', 'session_id', 'ip_address', 'device_info', 'device_id',
+    'start_time', 'end_time', 'recorded_at', 'duration', 'completed',
+]
+
+PARTITION_PREFIX = f'{ViewSession._meta.db_table}_p'
+
+
+def retention_days():
+    return getattr(settings, 'ANALYTICS_SESSION_RETENTION_DAYS', 90)
+
+
+def archive_prefix():
+    return getattr(settings, 'ANALYTICS_ARCHIVE_PREFIX', 'analytics/archive/view_sessions/')
+
+
+def retention_cutoff(now=None):
+    return (now or timezone.now()) - timedelta(days=retention_days())
+
+
+def prunable_sessions(cutoff):
+    """Sessions started before the cutoff whose numbers can no longer change the rollups"""
+    sessions = ViewSession.objects.filter(start_time__lt=cutoff)
+    watermark = RollupWatermark.objects.filter(name=WATERMARK).values_list('position', flat=True).first()
+    rolled_up = Q(recorded_at__lte=watermark) if watermark else Q(pk__in=[])
+    return sessions.filter(rolled_up | Q(end_time__isnull=True))
+
+
+# Archives
+
+def archive_name(rows):
+    first, last = rows[0], rows[-1]
+    return f"{archive_prefix()}{first['start_time']:%Y/%m/%d}/view-sessions-{first['id']}-{last['id']}.ndjson.gz"
+
+
+def write_archive(rows):
+    """Store rows as one gzip'd NDJSON file; returns its name"""
+    name = archive_name(rows)
+    # A file for the same id range was written by an earlier, interrupted run
+    if default_storage.exists(name):
+        return name
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb') as archive:
+        for row in rows:
+            archive.write(dumps(row) + b'\n')
+    return default_storage.save(name, ContentFile(buffer.getvalue()))
+
+
+def read_archive(name):
+    """Rows of one archive file"""
+    with default_storage.open(name, 'rb') as stored:
+        with gzip.GzipFile(fileobj=stored) as archive:
+            for line in archive:
+                if line.strip():
+                    row = json.loads(line)
+                    for field in ('start_time', 'end_time', 'recorded_at'):
+                        row[field] = parse_datetime(row[field]) if row.get(field) else None
+                    yield row
+
+
+def archive_names(path):
+    """Archive files at a path: a single file, or every file under a directory prefix"""
+    if path.endswith('.ndjson.gz'):
+        return [path]
+    directories, files = default_storage.listdir(path)
+    names = [f"{path.rstrip('/')}/{name}" for name in sorted(files) if name.endswith('.ndjson.gz')]
+    for directory in sorted(directories):
+        names += archive_names(f"{path.rstrip('/')}/{directory}")
+    return names
+
+
+def load_archive(path, batch_size=1000):
+    """
+    Re-import archived sessions; returns (loaded, skipped).
+
+    Sessions still in the table are left alone, and sessions of products that
+    no longer exist are skipped.
+    """
+    loaded = skipped = 0
+    for name in archive_names(path):
+        rows = list(read_archive(name))
+        product_ids = set(Product.objects.filter(pk__in={row['product_id'] for row in rows}).values_list('pk', flat=True))
+        user_ids = set(ShopUser.objects.filter(pk__in={row['user_id'] for row in rows if row['user_id']}).values_list('pk', flat=True))
+        device_ids = set(Device.objects.filter(pk__in={row.get('device_id') for row in rows}).values_list('pk', flat=True))
+        existing = set(ViewSession.objects.filter(pk__in=[row['id'] for row in rows]).values_list('pk', flat=True))
+
+        sessions = []
+        for row in rows:
+            if row['product_id'] not in product_ids or row['id'] in existing:
+                skipped += 1
+                continue
+            if row['user_id'] not in user_ids:
+                row['user_id'] = None
+            if row.get('device_id') not in device_ids:
+                row['device_id'] = None
+            sessions.append(ViewSession(**row))
+        ViewSession.objects.bulk_create(sessions, batch_size=batch_size)
+        loaded += len(sessions)
+    return loaded, skipped
+
+
+# Pruning
+
+def archive_and_delete(sessions, batch_size=5000, delete=True):
+    """Archive a queryset in id-ordered chunks, deleting each chunk once it is stored"""
+    archived = 0
+    last_id = 0
+    while True:
+        rows = list(sessions.filter(id__gt=last_id).order_by('id').values(*ARCHIVE_FIELDS)[:batch_size])
+        if not rows:
+            return archived
+        write_archive(rows)
+        if delete:
+            ViewSession.objects.filter(id__in=[row['id'] for row in rows]).delete()
+        archived += len(rows)
+        last_id = rows[-1]['id']
+
+
+def prune_sessions(cutoff=None, batch_size=5000):
+    """Archive and remove expired sessions; returns the number of sessions archived"""
+    cutoff = cutoff or retention_cutoff()
+    if is_partitioned():
+        return prune_partitions(cutoff, batch_size)
+    return archive_and_delete(prunable_sessions(cutoff), batch_size)
+
+
+# PostgreSQL partitions
+
+def is_partitioned():
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = %s",
+            [ViewSession._meta.db_table]
+        )
+        return cursor.fetchone() is not None
+
+
+def month_start(day):
+    return date(day.year, day.month, 1)
+
+
+def next_month(day):
+    return date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f'{PARTITION_PREFIX}{month:%Y%m}'
+
+
+def partitions():
+    """Existing monthly partitions as {first day of month: table name}"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = %s",
+            [ViewSession._meta.db_table]
+        )
+        names = [row[0] for row in cursor.fetchall()]
+    months = {}
+    for name in names:
+        suffix = name[len(PARTITION_PREFIX):]
+        if name.startswith(PARTITION_PREFIX) and suffix.isdigit() and len(suffix) == 6:
+            months[date(int(suffix[:4]), int(suffix[4:]), 1)] = name
+    return months
+
+
+def partition_bounds(month):
+    tz = timezone.get_current_timezone()
+    return (
+        timezone.make_aware(datetime.combine(month, time.min), tz),
+        timezone.make_aware(datetime.combine(next_month(month), time.min), tz),
+    )
+
+
+def create_partitions(months_ahead=3, today=None):
+    """Make sure monthly partitions exist from this month to months_ahead months from now"""
+    month = month_start(today or timezone.localdate())
+    created = []
+    existing = partitions()
+    table = connection.ops.quote_name(ViewSession._meta.db_table)
+    with connection.cursor() as cursor:
+        for _ in range(months_ahead + 1):
+            if month not in existing:
+                name = partition_name(month)
+                cursor.execute(
+                    f"CREATE TABLE IF NOT EXISTS {connection.ops.quote_name(name)} "
+                    f"PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)",
+                    list(partition_bounds(month))
+                )
+                created.append(name)
+            month = next_month(month)
+    return created
+
+
+def prune_partitions(cutoff, batch_size=5000):
+    """Archive and drop partitions that end before the cutoff, then prune what's left row by row"""
+    archived = 0
+    table = connection.ops.quote_name(ViewSession._meta.db_table)
+    for month, name in sorted(partitions().items()):
+        start, end = partition_bounds(month)
+        if end > cutoff:
+            continue
+        month_sessions = ViewSession.objects.filter(start_time__gte=start, start_time__lt=end)
+        if month_sessions.exclude(pk__in=prunable_sessions(cutoff).values('pk')).exists():
+            # Not rolled up yet; try again on a later run
+            continue
+        archived += archive_and_delete(month_sessions, batch_size, delete=False)
+        with connection.cursor() as cursor:
+            cursor.execute(f"ALTER TABLE {table} DETACH PARTITION {connection.ops.quote_name(name)}")
+            cursor.execute(f"DROP TABLE {connection.ops.quote_name(name)}")
+    return archived + archive_and_delete(prunable_sessions(cutoff), batch_size)
+
+
+def partition_conversion_sql(first_month, last_month):
+    """
+    One-off DDL turning the ViewSession table into a table range-partitioned by
+    month on start_time, with partitions from first_month to last_month.
+
+    Review before running it in a maintenance window: the primary key becomes
+    (id, start_time), as PostgreSQL requires the partition key in it. For the
+    same reason session_id can't stay unique on its own; the output says so.
+    """
+    table = ViewSession._meta.db_table
+    foreign_keys = [
+        ('product_id', Product._meta.db_table),
+        ('user_id', ShopUser._meta.db_table),
+        ('device_id', Device._meta.db_table),
+    ]
+    statements = [
+        '-- session_id loses its unique constraint: on a partitioned table it can only be unique',
+        '-- together with start_time, so concurrent retries of an event batch are no longer deduplicated.',
+        'BEGIN;',
+        f'ALTER TABLE {table} RENAME TO {table}_unpartitioned;',
+        f'CREATE TABLE {table} (LIKE {table}_unpartitioned INCLUDING DEFAULTS INCLUDING IDENTITY) '
+        f'PARTITION BY RANGE (start_time);',
+        f'ALTER TABLE {table} ADD PRIMARY KEY (id, start_time);',
+        f'CREATE INDEX ON {table} (session_id);',
+        f'CREATE INDEX ON {table} (recorded_at);',
+        f'CREATE INDEX ON {table} (start_time);',
+    ]
+    for column, referenced in foreign_keys:
+        # Deletes are cascaded (or set to null) by Django, as for the other tables
+        statements += [
+            f'CREATE INDEX ON {table} ({column});',
+            f'ALTER TABLE {table} ADD FOREIGN KEY ({column}) REFERENCES {referenced} (id) '
+            f'DEFERRABLE INITIALLY DEFERRED;',
+        ]
+    month = month_start(first_month)
+    while month <= last_month:
+        start, end = partition_bounds(month)
+        statements.append(
+            f"CREATE TABLE {partition_name(month)} PARTITION OF {table} "
+            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}');"
+        )
+        month = next_month(month)
+    statements += [
+        f'INSERT INTO {table} SELECT * FROM {table}_unpartitioned;',
+        f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT COALESCE(MAX(id), 1) FROM {table}));",
+        f'DROP TABLE {table}_unpartitioned;',
+        'COMMIT;',
+    ]
+    return '\n'.join(statements)
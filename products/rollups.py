@@ -0,0 +1,171 @@
+"""
+Hourly and daily ViewSession rollups.
+
+rollup_view_sessions aggregates the sessions that ended since the previous run
+(tracked by a watermark on recorded_at, the time the end was written rather
+than the request's end_time, so sessions replayed from the event spool are
+still picked up) with one GROUP BY per window, and adds
+the totals to the HourlyViewRollup and DailyViewRollup rows of the hour/day
+each session started in. Analytics reads use these tables, so their cost
+doesn't grow with ViewSession.
+"""
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, ExpressionWrapper, F, FloatField, Q, Sum, Value
+from django.db.models.functions import Coalesce, NullIf, TruncHour
+from django.utils import timezone
+from .analytics_events import MIN_VIEW_SECONDS
+from .models import ViewSession, HourlyViewRollup, DailyViewRollup, RollupWatermark
+
+WATERMARK = 'view-sessions'
+
+ROLLUP_FIELDS = ['views', 'watch_seconds', 'completions', 'sessions']
+
+
+def rollup_lag():
+    """Seconds sessions are left to settle (commit) before they are rolled up"""
+    return getattr(settings, 'ANALYTICS_ROLLUP_LAG', 60)
+
+
+def view_filter():
+    # Same rule as analytics_events.counts_as_view: 3 seconds, or a quarter of a shorter video
+    quarter = ExpressionWrapper(
+        Coalesce(NullIf(F('product__video_duration'), Value(0)), Value(30)) * Value(0.25),
+        output_field=FloatField()
+    )
+    return Q(duration__gte=MIN_VIEW_SECONDS) | Q(duration__gte=quarter)
+
+
+def aggregate_sessions(start, end):
+    """Totals per product and start hour of the sessions whose end was recorded in (start, end]"""
+    view = view_filter()
+    return (
+        ViewSession.objects.filter(recorded_at__gt=start, recorded_at__lte=end)
+        .annotate(hour=TruncHour('start_time'))
+        .values('product_id', 'hour')
+        .annotate(
+            views=Count('id', filter=view),
+            watch_seconds=Coalesce(Sum('duration', filter=view), 0),
+            completions=Count('id', filter=Q(completed=True)),
+            sessions=Count('session_id', distinct=True),
+        )
+        .order_by()
+    )
+
+
+def add_to_rollups(model, totals):
+    """Add {(product id, bucket): [views, watch seconds, completions, sessions]} to rollup rows"""
+    model.objects.bulk_create(
+        [model(product_id=product_id, bucket=bucket) for product_id, bucket in totals],
+        ignore_conflicts=True
+    )
+    for (product_id, bucket), values in totals.items():
+        model.objects.filter(product_id=product_id, bucket=bucket).update(
+            **{field: F(field) + value for field, value in zip(ROLLUP_FIELDS, values)}
+        )
+
+
+def rollup_window(start, end):
+    """Roll up one window and move the watermark to its end; returns the number of hourly groups"""
+    with transaction.atomic():
+        watermark = RollupWatermark.objects.select_for_update().get(name=WATERMARK)
+        if watermark.position != start:
+            # Another run got here first
+            return 0
+
+        hourly = {}
+        daily = defaultdict(lambda: [0] * len(ROLLUP_FIELDS))
+        for row in aggregate_sessions(start, end):
+            values = [row[field] for field in ROLLUP_FIELDS]
+            hourly[(row['product_id'], row['hour'])] = values
+            day = timezone.localdate(row['hour'])
+            for i, value in enumerate(values):
+                daily[(row['product_id'], day)][i] += value
+
+        add_to_rollups(HourlyViewRollup, hourly)
+        add_to_rollups(DailyViewRollup, daily)
+        watermark.position = end
+        watermark.save()
+    return len(hourly)
+
+
+def backfill_recorded_at(using='default'):
+    """
+    Give sessions ended before recorded_at existed their end time as recorded
+    time; returns the number of sessions updated. Run after every migrate, so
+    older sessions are rolled up and pruned like the rest.
+    """
+    return ViewSession.objects.using(using).filter(
+        recorded_at__isnull=True, end_time__isnull=False
+    ).update(recorded_at=F('end_time'))
+
+
+def run_rollups(window=timedelta(days=1), now=None):
+    """Roll up every session that ended since the watermark, a window at a time"""
+    end = (now or timezone.now()) - timedelta(seconds=rollup_lag())
+    watermark, _ = RollupWatermark.objects.get_or_create(name=WATERMARK)
+    if watermark.position is None:
+        first = (
+            ViewSession.objects.filter(recorded_at__isnull=False)
+            .order_by('recorded_at').values_list('recorded_at', flat=True).first()
+        )
+        # Start just before the oldest ended session
+        watermark.position = (first or end) - timedelta(microseconds=1)
+        watermark.save()
+
+    start = watermark.position
+    groups = 0
+    while start < end:
+        window_end = min(start + window, end)
+        groups += rollup_window(start, window_end)
+        start = window_end
+    return groups
+
+
+def product_totals(product):
+    """All-time rolled-up totals of a product"""
+    return DailyViewRollup.objects.filter(product=product).aggregate(
+        **{field: Coalesce(Sum(field), 0) for field in ROLLUP_FIELDS}
+    )
+
+
+def completion_rate(product):
+    """Percentage of a product's sessions that were completed"""
+    totals = product_totals(product)
+    if not totals['sessions']:
+        return 0
+    return round((totals['completions'] / totals['sessions']) * 100, 2)
+
+
+def daily_totals(product, days=7):
+    """Rolled-up totals for each of the last `days` days, oldest first (days without views included)"""
+    today = timezone.localdate()
+    first_day = today - timedelta(days=days - 1)
+    rows = {
+        row['bucket']: row
+        for row in DailyViewRollup.objects.filter(product=product, bucket__gte=first_day)
+        .values('bucket', *ROLLUP_FIELDS)
+    }
+    series = []
+    for offset in range(days):
+        day = first_day + timedelta(days=offset)
+        series.append(rows.get(day) or {'bucket': day, **{field: 0 for field in ROLLUP_FIELDS}})
+    return series
+
+
+def hourly_totals(product, hours=24):
+    """Rolled-up totals for each of the last `hours` hours, oldest first (hours without views included)"""
+    current = timezone.localtime().replace(minute=0, second=0, microsecond=0)
+    first_hour = current - timedelta(hours=hours - 1)
+    rows = {
+        row['bucket']: row
+        for row in HourlyViewRollup.objects.filter(product=product, bucket__gte=first_hour)
+        .values('bucket', *ROLLUP_FIELDS)
+    }
+    series = []
+    for offset in range(hours):
+        hour = first_hour + timedelta(hours=offset)
+        series.append(rows.get(hour) or {'bucket': hour, **{field: 0 for field in ROLLUP_FIELDS}})
+    return series
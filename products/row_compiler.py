@@ -0,0 +1,126 @@
+"""
+Fast serialization of product lists.
+
+Builds the same dicts as ProductSerializer (with ProductGallerySerializer for
+gallery_items) straight from values() rows and one gallery query per page,
+without instantiating models or running DRF field machinery. File URLs are
+built by joining a per-storage prefix with the stored name.
+"""
+from collections import defaultdict
+from django.utils.encoding import filepath_to_uri
+from .fieldsets import FIELD_COLUMNS
+from .models import Product, ProductGallery
+from .serializers import ProductSerializer
+
+PRODUCT_FIELDS = list(ProductSerializer.Meta.fields)
+
+GALLERY_COLUMNS = [
+    'product_id', 'id', 'media_type', 'image', 'video', 'is_primary', 'alt_text', 'display_order'
+]
+
+# Names used to check that a storage builds URLs as prefix + quoted name + suffix
+PROBE_NAME = 'row-compiler-probe'
+CHECK_NAME = 'row compiler/check ü.jpg'
+
+
+class UrlBuilder:
+    """Turns stored file names into URLs the way storage.url() does"""
+
+    def __init__(self, storage, request=None):
+        self.storage = storage
+        self.request = request
+        self.prefix = self.suffix = None
+        url = storage.url(PROBE_NAME)
+        if url.count(PROBE_NAME) == 1:
+            prefix, suffix = url.split(PROBE_NAME)
+            # Signed or otherwise name-dependent URLs keep going through the storage
+            if storage.url(CHECK_NAME) == prefix + filepath_to_uri(CHECK_NAME) + suffix:
+                self.prefix, self.suffix = prefix, suffix
+        self.absolute_prefix = None
+        if request is not None and self.prefix is not None:
+            self.absolute_prefix = request.build_absolute_uri(self.prefix)
+
+    def url(self, name):
+        if not name:
+            return None
+        if self.prefix is None:
+            return self.storage.url(name)
+        return self.prefix + filepath_to_uri(name) + self.suffix
+
+    def absolute_url(self, name):
+        """URL as a DRF FileField renders it: absolute when there is a request"""
+        if not name:
+            return None
+        if self.request is None:
+            return self.url(name)
+        if self.absolute_prefix is None:
+            return self.request.build_absolute_uri(self.storage.url(name))
+        return self.absolute_prefix + filepath_to_uri(name) + self.suffix
+
+
+def product_columns(fields=None, extra_columns=()):
+    fields = PRODUCT_FIELDS if fields is None else fields
+    columns = ['id']
+    for name in [*fields, *(column.lstrip('-') for column in extra_columns)]:
+        for column in FIELD_COLUMNS.get(name, [name]):
+            if column not in columns:
+                columns.append(column)
+    return columns
+
+
+def product_values(queryset, fields=None, extra_columns=()):
+    """values() queryset with every column the chosen fields read, plus extra_columns"""
+    return queryset.values(*product_columns(fields, extra_columns))
+
+
+def gallery_map(product_ids, request=None):
+    """Serialized gallery items per product id, in gallery order"""
+    image_urls = UrlBuilder(ProductGallery._meta.get_field('image').storage, request)
+    video_urls = UrlBuilder(ProductGallery._meta.get_field('video').storage, request)
+
+    items = defaultdict(list)
+    for row in ProductGallery.objects.filter(product_id__in=product_ids).values_list(*GALLERY_COLUMNS):
+        product_id, item_id, media_type, image, video, is_primary, alt_text, display_order = row
+        if media_type == 'image' and image:
+            url = image_urls.url(image)
+        elif media_type == 'video' and video:
+            url = video_urls.url(video)
+        else:
+            url = None
+        items[product_id].append({
+            'id': item_id,
+            'media_type': media_type,
+            'image': image_urls.absolute_url(image),
+            'video': video_urls.absolute_url(video),
+            'is_primary': is_primary,
+            'alt_text': alt_text,
+            'display_order': display_order,
+            'url': url,
+        })
+    return items
+
+
+def compile_products(rows, fields=None, request=None):
+    """
+    Serialize product_values() rows exactly as ProductSerializer would.
+
+    `request` gives gallery file fields absolute URLs, like the serializer's context.
+    """
+    fields = PRODUCT_FIELDS if fields is None else fields
+    rows = list(rows)
+    image_urls = UrlBuilder(Product._meta.get_field('primary_image_file').storage)
+    flicks_urls = UrlBuilder(Product._meta.get_field('flicks').storage)
+    galleries = gallery_map([row['id'] for row in rows], request) if 'gallery_items' in fields else {}
+
+    getters = {
+        'manufacturer_name': lambda row: row['manufacturer__name'],
+        'image_url': lambda row: image_urls.url(row['primary_image_file']) or flicks_urls.url(row['flicks']),
+        'video_url': lambda row: flicks_urls.url(row['flicks']),
+        'gallery_items': lambda row: galleries.get(row['id'], []),
+    }
+    plan = [(name, getters.get(name)) for name in fields]
+
+    return [
+        {name: getter(row) if getter else row[name] for name, getter in plan}
+        for row in rows
+    ]
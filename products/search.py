@@ -0,0 +1,173 @@
+"""
+Ranked full-text product search.
+
+PostgreSQL keeps a weighted tsvector in Product.search_vector behind a GIN
+index. SQLite keeps an FTS5 table keyed by product id. Both are updated when
+a product or its manufacturer is saved. Matching, ranking and pagination all
+run in the database, so a page costs the same however large the catalog is.
+"""
+import hashlib
+import re
+from django.db import connections, connection
+from django.db.models import F, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+from .caching import cached_count
+from .models import Product, Manufacturer
+
+# Text search configuration used on PostgreSQL
+SEARCH_CONFIG = 'english'
+
+GIN_INDEX_NAME = 'products_product_search_gin'
+FTS_TABLE = 'products_product_fts'
+
+# Relative weights of the indexed columns: title, brand, category/age, description, manufacturer
+FTS_WEIGHTS = (10.0, 5.0, 3.0, 1.0, 5.0)
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def search_terms(query):
+    """Split a user query into plain word tokens, dropping operators and punctuation"""
+    return WORD_RE.findall(query.lower())
+
+
+def ensure_search_index(using='default'):
+    """Create the backend-specific search index if it doesn't exist yet"""
+    conn = connections[using]
+    with conn.cursor() as cursor:
+        if conn.vendor == 'postgresql':
+            cursor.execute(
+                f'CREATE INDEX IF NOT EXISTS {GIN_INDEX_NAME} '
+                f'ON products_product USING gin (search_vector)'
+            )
+        elif conn.vendor == 'sqlite':
+            cursor.execute(
+                f'CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5('
+                f'title, brand, category, description, manufacturer, '
+                f"tokenize='unicode61 remove_diacritics 2')"
+            )
+
+
+def index_products(product_ids):
+    """Refresh the search index entries of the given products"""
+    product_ids = list(product_ids)
+    if not product_ids:
+        return
+
+    if connection.vendor == 'postgresql':
+        from django.contrib.postgres.search import SearchVector
+
+        manufacturer_name = Subquery(
+            Manufacturer.objects.filter(pk=OuterRef('manufacturer_id')).values('name')[:1]
+        )
+        Product.objects.filter(pk__in=product_ids).update(
+            search_vector=(
+                SearchVector('title', weight='A', config=SEARCH_CONFIG) +
+                SearchVector('brand', weight='B', config=SEARCH_CONFIG) +
+                SearchVector(Coalesce(manufacturer_name, Value('')), weight='B', config=SEARCH_CONFIG) +
+                SearchVector('product_category', 'age_group', weight='C', config=SEARCH_CONFIG) +
+                SearchVector('description', weight='D', config=SEARCH_CONFIG)
+            )
+        )
+    elif connection.vendor == 'sqlite':
+        rows = Product.objects.filter(pk__in=product_ids).values_list(
+            'id', 'title', 'brand', 'product_category', 'age_group', 'description', 'manufacturer__name'
+        )
+        placeholders = ', '.join(['%s'] * len(product_ids))
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid IN ({placeholders})', product_ids)
+            cursor.executemany(
+                f'INSERT INTO {FTS_TABLE} (rowid, title, brand, category, description, manufacturer) '
+                f'VALUES (%s, %s, %s, %s, %s, %s)',
+                [
+                    (pk, title, brand, f'{category} {age_group}', description, manufacturer or '')
+                    for pk, title, brand, category, age_group, description, manufacturer in rows
+                ]
+            )
+
+
+def remove_products(product_ids):
+    """Drop deleted products from the search index (PostgreSQL rows go with the product)"""
+    product_ids = list(product_ids)
+    if product_ids and connection.vendor == 'sqlite':
+        placeholders = ', '.join(['%s'] * len(product_ids))
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid IN ({placeholders})', product_ids)
+
+
+def ranked_search(query, offset=0, limit=10):
+    """
+    Find products matching a query, best match first.
+
+    Every word is matched as a prefix and any word may match. Returns
+    (product_ids, total_count) for the requested page.
+    """
+    terms = search_terms(query)
+    if not terms:
+        return [], 0
+
+    if connection.vendor == 'postgresql':
+        return _postgres_search(terms, offset, limit)
+    if connection.vendor == 'sqlite':
+        return _sqlite_search(terms, offset, limit)
+    return _substring_search(terms, offset, limit)
+
+
+def _count_key(terms):
+    return hashlib.md5(' '.join(terms).encode()).hexdigest()
+
+
+def _postgres_search(terms, offset, limit):
+    from django.contrib.postgres.search import SearchQuery, SearchRank
+
+    search_query = SearchQuery(
+        ' | '.join(f'{term}:*' for term in terms), search_type='raw', config=SEARCH_CONFIG
+    )
+    matches = Product.objects.filter(search_vector=search_query)
+    product_ids = list(
+        matches.annotate(rank=SearchRank(F('search_vector'), search_query))
+        .order_by('-rank', 'id')
+        .values_list('id', flat=True)[offset:offset + limit]
+    )
+    return product_ids, cached_count(matches, 'search', _count_key(terms))
+
+
+def _sqlite_search(terms, offset, limit):
+    match = ' OR '.join('"{}"*'.format(term.replace('"', '""')) for term in terms)
+    weights = ', '.join(str(weight) for weight in FTS_WEIGHTS)
+    with connection.cursor() as cursor:
+        # bm25() is lower-is-better
+        cursor.execute(
+            f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s '
+            f'ORDER BY bm25({FTS_TABLE}, {weights}), rowid LIMIT %s OFFSET %s',
+            [match, limit, offset]
+        )
+        product_ids = [row[0] for row in cursor.fetchall()]
+
+    return product_ids, cached_count(_FtsMatchCount(match), 'search', _count_key(terms))
+
+
+class _FtsMatchCount:
+    """Queryset-like wrapper so FTS5 match counts can share cached_count()"""
+
+    def __init__(self, match):
+        self.match = match
+
+    def count(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT count(*) FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [self.match])
+            return cursor.fetchone()[0]
+
+
+def _substring_search(terms, offset, limit):
+    """Fallback for backends without a full-text index: unranked substring match"""
+    condition = Q()
+    for term in terms:
+        condition |= (
+            Q(title__icontains=term) | Q(brand__icontains=term) |
+            Q(product_category__icontains=term) | Q(age_group__icontains=term) |
+            Q(description__icontains=term) | Q(manufacturer__name__icontains=term)
+        )
+    matches = Product.objects.filter(condition)
+    product_ids = list(matches.order_by('id').values_list('id', flat=True)[offset:offset + limit])
+    return product_ids, cached_count(matches, 'search', _count_key(terms))
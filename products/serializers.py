@@ -26,6 +26,16 @@ class DistributorSerializer(serializers.ModelSerializer):
         model = Distributor
         fields = '__all__'
 
+class SparseFieldsMixin:
+    """Accepts a `fields` argument listing the only fields to serialize"""
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+
 class ProductGallerySerializer(serializers.ModelSerializer):
     url = serializers.SerializerMethodField()
     
@@ -40,7 +50,7 @@ class ProductGallerySerializer(serializers.ModelSerializer):
             return obj.video.url
         return None
         
-class ProductSerializer(serializers.ModelSerializer):
+class ProductSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     manufacturer_name = serializers.SerializerMethodField()
     image_url = serializers.SerializerMethodField()
     video_url = serializers.SerializerMethodField()
@@ -56,10 +66,9 @@ class ProductSerializer(serializers.ModelSerializer):
         return obj.manufacturer.name if obj.manufacturer else None
     
     def get_image_url(self, obj):
-        # Get primary image from gallery
-        primary_item = obj.gallery.filter(is_primary=True, media_type='image').first()
-        if primary_item and primary_item.image:
-            return primary_item.image.url
+        # Primary gallery image, denormalized onto the product row
+        if obj.primary_image_file:
+            return obj.primary_image_file.url
         # Fallback to flicks field if no primary image
         if obj.flicks:
             return obj.flicks.url
@@ -71,7 +80,7 @@ class ProductSerializer(serializers.ModelSerializer):
             return obj.flicks.url
         return None
 
-class ProductDetailSerializer(serializers.ModelSerializer):
+class ProductDetailSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     manufacturer_name = serializers.SerializerMethodField()
     image_url = serializers.SerializerMethodField()
     video_url = serializers.SerializerMethodField()
@@ -87,9 +96,8 @@ class ProductDetailSerializer(serializers.ModelSerializer):
         return obj.manufacturer.name if obj.manufacturer else None
     
     def get_image_url(self, obj):
-        primary = obj.gallery.filter(is_primary=True, media_type='image').first()
-        if primary and primary.image:
-            return primary.image.url
+        if obj.primary_image_file:
+            return obj.primary_image_file.url
         return None
         
     def get_video_url(self, obj):
@@ -0,0 +1,82 @@
+"""
+Signed view-session tokens.
+
+With ANALYTICS_SIGNED_SESSIONS enabled, starting a view writes nothing: the
+client gets a signed token holding the product, start time, user and a device
+fingerprint, and passes it back as the session_id when the view ends. Only
+then is a single, already completed ViewSession row inserted. Batched events
+work the same way (see analytics_events).
+"""
+import hashlib
+import uuid
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from django.core import signing
+
+SALT = 'products.view-session'
+
+
+class InvalidSessionToken(ValueError):
+    pass
+
+
+def signed_sessions_enabled():
+    return getattr(settings, 'ANALYTICS_SIGNED_SESSIONS', False)
+
+
+def token_max_age():
+    """Seconds a view may last before its token is no longer accepted"""
+    return getattr(settings, 'ANALYTICS_SESSION_TOKEN_MAX_AGE', 6 * 3600)
+
+
+def device_fingerprint(request):
+    user_agent = request.META.get('HTTP_USER_AGENT', '')
+    return hashlib.sha256(user_agent.encode()).hexdigest()[:16]
+
+
+def is_token(session_id):
+    # Signed values are "payload:timestamp:signature"; plain session ids are UUIDs
+    return isinstance(session_id, str) and session_id.count(':') == 2
+
+
+def issue_token(product, request, start_time):
+    """Token for a view of `product` that started at `start_time`"""
+    return signing.dumps(
+        {
+            'session': uuid.uuid4().hex,
+            'product': product.pk,
+            'start': start_time.timestamp(),
+            'user': request.user.pk if request.user.is_authenticated else None,
+            'device': device_fingerprint(request),
+        },
+        salt=SALT,
+        compress=True
+    )
+
+
+class RequestTokens:
+    """Issues and reads the tokens of the views in one request"""
+
+    def __init__(self, request):
+        self.request = request
+
+    def issue(self, product, start_time):
+        return issue_token(product, self.request, start_time)
+
+    def read(self, token):
+        return read_token(token, self.request)
+
+
+def read_token(token, request):
+    """Verify a token issued to the same device; returns its payload with start as a datetime"""
+    try:
+        payload = signing.loads(token, salt=SALT, max_age=token_max_age())
+    except signing.SignatureExpired:
+        raise InvalidSessionToken("Session has expired")
+    except signing.BadSignature:
+        raise InvalidSessionToken("Invalid session token")
+
+    if payload.get('device') != device_fingerprint(request):
+        raise InvalidSessionToken("Session token was issued to another device")
+    payload['start'] = datetime.fromtimestamp(payload['start'], tz=dt_timezone.utc)
+    return payload
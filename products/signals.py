@@ -0,0 +1,114 @@
+from django.db.models.signals import post_save, post_delete, post_migrate
+from django.db.models import F
+from django.dispatch import receiver
+from django.utils import timezone
+from .models import Product, Manufacturer, ProductGallery, FeaturedProduct, CatalogVersion
+from .caching import bump_catalog_generation
+from . import featured, rollups, search, suggest
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_catalog_caches(sender, **kwargs):
+    """Drop cached counts and listings when a product is added, edited or removed"""
+    bump_catalog_generation()
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, **kwargs):
+    search.index_products([instance.pk])
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    search.remove_products([instance.pk])
+
+
+@receiver(post_save, sender=Manufacturer)
+def reindex_manufacturer_products(sender, instance, created, **kwargs):
+    """Manufacturer names are part of the search document of their products"""
+    if not created:
+        search.index_products(instance.products.values_list('id', flat=True))
+        bump_catalog_generation()
+
+
+@receiver(post_migrate)
+def create_search_index(sender, using, **kwargs):
+    if sender.name == 'products':
+        search.ensure_search_index(using)
+
+
+@receiver(post_migrate)
+def backfill_session_recorded_at(sender, using, **kwargs):
+    if sender.name == 'products':
+        rollups.backfill_recorded_at(using)
+
+
+@receiver(post_save, sender=Product)
+def update_suggestions(sender, instance, **kwargs):
+    suggest.product_changed(instance)
+
+
+@receiver(post_delete, sender=Product)
+def remove_suggestions(sender, instance, **kwargs):
+    suggest.product_removed(instance.pk)
+
+
+@receiver(post_save, sender=Manufacturer)
+def update_manufacturer_suggestions(sender, instance, **kwargs):
+    suggest.manufacturer_changed(instance)
+
+
+@receiver(post_save, sender=FeaturedProduct)
+@receiver(post_delete, sender=FeaturedProduct)
+def rebuild_featured_lists(sender, instance, **kwargs):
+    featured.schedule_rebuild([instance.featured_type])
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def rebuild_featured_for_product(sender, instance, **kwargs):
+    featured.product_changed(instance.pk)
+
+
+@receiver(post_save, sender=ProductGallery)
+@receiver(post_delete, sender=ProductGallery)
+def rebuild_featured_for_gallery(sender, instance, **kwargs):
+    featured.product_changed(instance.product_id)
+
+
+@receiver(post_save, sender=Manufacturer)
+def rebuild_featured_for_manufacturer(sender, instance, created, **kwargs):
+    if not created:
+        featured.manufacturer_changed(instance)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Manufacturer)
+@receiver(post_save, sender=ProductGallery)
+@receiver(post_delete, sender=ProductGallery)
+@receiver(post_save, sender=FeaturedProduct)
+@receiver(post_delete, sender=FeaturedProduct)
+def bump_catalog_version(sender, **kwargs):
+    """Move list ETags on to a new version (see products.conditional)"""
+    CatalogVersion.bump()
+
+
+@receiver(post_delete, sender=ProductGallery)
+def refresh_primary_media(sender, instance, **kwargs):
+    """Keep the product's primary media current after any delete, including queryset and cascade deletes"""
+    Product(pk=instance.product_id).refresh_primary_media()
+
+
+@receiver(post_save, sender=ProductGallery)
+@receiver(post_delete, sender=ProductGallery)
+def bump_product_version(sender, instance, **kwargs):
+    """Gallery items are part of the product detail response"""
+    Product(pk=instance.product_id).bump_version()
+
+
+@receiver(post_save, sender=Manufacturer)
+def bump_manufacturer_product_versions(sender, instance, created, **kwargs):
+    if not created:
+        instance.products.update(version=F('version') + 1, updated_at=timezone.now())
@@ -0,0 +1,371 @@
+"""
+In-process autocomplete index for product titles, brands, categories and
+manufacturers.
+
+Completions are held in a sorted list of search keys, so a prefix lookup is a
+binary search plus a short scan. Top results for very short prefixes are
+memoized. Typos are handled by correcting query words against the indexed
+vocabulary with a trigram candidate search and a bounded edit distance.
+
+The index is built from the database on first use, then kept current by the
+product/manufacturer signals in this process, once their transaction commits
+(a rolled back save leaves the index alone). Changes made by other workers
+are picked up by a background rebuild once CatalogVersion moves past the
+version the index was built at. CatalogVersion lives in the database, so this
+works whether or not the workers share a cache. Local updates don't advance
+that version: they can't tell which of the bumps since the build were their
+own, so a local change also leads to one (redundant) rebuild.
+"""
+import bisect
+import heapq
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter, defaultdict
+from django.conf import settings
+from django.db import connection, transaction
+
+MAX_SUGGESTIONS = 20
+
+# Completions are also reachable from the start of each of their first few words,
+# so "blocks" finds "Building Blocks"
+MAX_WORD_STARTS = 6
+
+# Top results for prefixes up to this length are memoized
+SHORT_PREFIX_LENGTH = 3
+
+# Seconds between checks for catalog changes made by other processes
+REFRESH_INTERVAL = getattr(settings, 'SUGGEST_INDEX_REFRESH_INTERVAL', 60)
+
+NON_WORD_RE = re.compile(r'[\W_]+', re.UNICODE)
+
+
+def normalize(text):
+    """Lowercase, strip accents and collapse punctuation to single spaces"""
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return ' '.join(word for word in NON_WORD_RE.split(text.lower()) if word)
+
+
+def trigrams(word):
+    # Pad the start so that the beginning of a word carries the most weight
+    padded = '$$' + word
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a, b, limit, prefix=False):
+    """
+    Optimal string alignment distance, or limit + 1 once it is exceeded.
+
+    With prefix=True, the distance from a to the closest prefix of b.
+    """
+    if prefix:
+        b = b[:len(a) + limit]
+    elif abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return min(previous) if prefix else previous[-1]
+
+
+def max_typos(word):
+    return 1 if len(word) < 6 else 2
+
+
+class SuggestIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        # (kind, key) -> [display text, number of products using it]
+        self._entries = {}
+        # Sorted (search key, kind, key) tuples, one per word start of each entry
+        self._keys = []
+        # product id -> (manufacturer id, [(kind, display text), ...])
+        self._products = {}
+        self._manufacturer_products = defaultdict(set)
+        self._manufacturer_names = {}
+        # Vocabulary for typo correction
+        self._words = Counter()
+        self._trigrams = defaultdict(set)
+        self._top_cache = {}
+        self._typo_cache = {}
+        # CatalogVersion the index was built from
+        self.version = None
+        self.built_at = None
+
+    # Building and incremental updates
+
+    def load(self, product_rows, manufacturer_names):
+        """Bulk load (id, title, brand, category, manufacturer id) rows"""
+        with self._lock:
+            self._manufacturer_names.update(manufacturer_names)
+            for product_id, title, brand, category, manufacturer_id in product_rows:
+                self._set_product(product_id, manufacturer_id, title, brand, category, bulk=True)
+            self._keys.sort()
+            self._top_cache.clear()
+
+    def set_product(self, product_id, manufacturer_id, title, brand, category):
+        with self._lock:
+            self._remove_product(product_id)
+            self._set_product(product_id, manufacturer_id, title, brand, category)
+
+    def remove_product(self, product_id):
+        with self._lock:
+            self._remove_product(product_id)
+
+    def set_manufacturer(self, manufacturer_id, name):
+        with self._lock:
+            old_name = self._manufacturer_names.get(manufacturer_id)
+            self._manufacturer_names[manufacturer_id] = name
+            if old_name == name:
+                return
+            for product_id in self._manufacturer_products.get(manufacturer_id, ()):
+                _, terms = self._products[product_id]
+                # Names without any words were never indexed (see _set_product)
+                if ('manufacturer', old_name) in terms:
+                    self._remove_term('manufacturer', old_name)
+                    terms.remove(('manufacturer', old_name))
+                if normalize(name):
+                    self._add_term('manufacturer', name)
+                    terms.append(('manufacturer', name))
+
+    def _set_product(self, product_id, manufacturer_id, title, brand, category, bulk=False):
+        terms = [('title', title), ('brand', brand), ('category', category)]
+        manufacturer_name = self._manufacturer_names.get(manufacturer_id)
+        if manufacturer_name:
+            terms.append(('manufacturer', manufacturer_name))
+        terms = [(kind, text) for kind, text in terms if normalize(text)]
+        for kind, text in terms:
+            self._add_term(kind, text, bulk=bulk)
+        self._products[product_id] = (manufacturer_id, terms)
+        if manufacturer_id:
+            self._manufacturer_products[manufacturer_id].add(product_id)
+
+    def _remove_product(self, product_id):
+        manufacturer_id, terms = self._products.pop(product_id, (None, []))
+        for kind, text in terms:
+            self._remove_term(kind, text)
+        if manufacturer_id:
+            self._manufacturer_products[manufacturer_id].discard(product_id)
+
+    def _add_term(self, kind, text, bulk=False):
+        key = normalize(text)
+        entry = self._entries.get((kind, key))
+        if entry:
+            entry[1] += 1
+            self._invalidate(key)
+            return
+
+        self._entries[(kind, key)] = [text.strip(), 1]
+        for search_key in self._word_starts(key):
+            if bulk:
+                self._keys.append((search_key, kind, key))
+            else:
+                bisect.insort(self._keys, (search_key, kind, key))
+        for word in key.split(' '):
+            if not self._words[word]:
+                for trigram in trigrams(word):
+                    self._trigrams[trigram].add(word)
+                self._typo_cache.clear()
+            self._words[word] += 1
+        if not bulk:
+            self._invalidate(key)
+
+    def _remove_term(self, kind, text):
+        key = normalize(text)
+        entry = self._entries.get((kind, key))
+        if not entry:
+            return
+        self._invalidate(key)
+        entry[1] -= 1
+        if entry[1] > 0:
+            return
+
+        del self._entries[(kind, key)]
+        for search_key in self._word_starts(key):
+            position = bisect.bisect_left(self._keys, (search_key, kind, key))
+            if position < len(self._keys) and self._keys[position] == (search_key, kind, key):
+                del self._keys[position]
+        for word in key.split(' '):
+            self._words[word] -= 1
+            if self._words[word] <= 0:
+                del self._words[word]
+                for trigram in trigrams(word):
+                    self._trigrams[trigram].discard(word)
+                self._typo_cache.clear()
+
+    def _word_starts(self, key):
+        words = key.split(' ')
+        return {' '.join(words[i:]) for i in range(min(len(words), MAX_WORD_STARTS))}
+
+    def _invalidate(self, key):
+        for search_key in self._word_starts(key):
+            for length in range(1, SHORT_PREFIX_LENGTH + 1):
+                self._top_cache.pop(search_key[:length], None)
+
+    # Lookups
+
+    def suggest(self, query, limit=10):
+        """Get up to `limit` completions for a typed prefix, best first"""
+        key = normalize(query)
+        if not key:
+            return []
+        limit = min(limit, MAX_SUGGESTIONS)
+
+        with self._lock:
+            matches = self._prefix_matches(key)
+            if len(matches) < limit:
+                seen = set(matches)
+                for corrected in self._corrections(key):
+                    for match in self._prefix_matches(corrected):
+                        if match not in seen:
+                            seen.add(match)
+                            matches.append(match)
+            return [
+                {'text': self._entries[match][0], 'type': match[0]}
+                for match in matches[:limit]
+            ]
+
+    def _prefix_matches(self, prefix):
+        if len(prefix) <= SHORT_PREFIX_LENGTH and prefix in self._top_cache:
+            return list(self._top_cache[prefix])
+
+        start = bisect.bisect_left(self._keys, (prefix,))
+        end = bisect.bisect_left(self._keys, (prefix + '\uffff',))
+        candidates = {(kind, key) for _, kind, key in self._keys[start:end]}
+        top = heapq.nsmallest(
+            MAX_SUGGESTIONS,
+            candidates,
+            key=lambda match: (-self._entries[match][1], len(match[1]), match[1], match[0])
+        )
+
+        if len(prefix) <= SHORT_PREFIX_LENGTH:
+            self._top_cache[prefix] = top
+        return list(top)
+
+    def _corrections(self, key):
+        """Spell-corrected versions of the query, closest first"""
+        words = key.split(' ')
+        corrected = []
+        for word in words[:-1]:
+            if word in self._words:
+                corrected.append([word])
+            else:
+                corrected.append(self._closest_words(word, prefix=False)[:1] or [word])
+
+        last = words[-1]
+        if len(last) < 3:
+            return []
+        candidates = self._closest_words(last, prefix=True)[:3]
+        head = ' '.join(options[0] for options in corrected)
+        return [f'{head} {word}'.strip() for word in candidates if f'{head} {word}'.strip() != key]
+
+    def _closest_words(self, word, prefix):
+        cache_key = (word, prefix)
+        if cache_key in self._typo_cache:
+            return self._typo_cache[cache_key]
+
+        limit = max_typos(word)
+        overlap = Counter()
+        for trigram in trigrams(word):
+            overlap.update(self._trigrams.get(trigram, ()))
+
+        # Only the candidates sharing the most trigrams are worth an edit distance
+        scored = []
+        for candidate, _ in overlap.most_common(30):
+            distance = edit_distance(word, candidate, limit, prefix=prefix)
+            if distance <= limit:
+                scored.append((distance, -self._words[candidate], candidate))
+        result = [candidate for _, _, candidate in sorted(scored)]
+
+        if len(self._typo_cache) > 10000:
+            self._typo_cache.clear()
+        self._typo_cache[cache_key] = result
+        return result
+
+
+_index = None
+_index_lock = threading.Lock()
+_refreshing = False
+
+
+def catalog_version():
+    from .models import CatalogVersion
+
+    return CatalogVersion.current()[0]
+
+
+def build_index():
+    from .models import Product, Manufacturer
+
+    index = SuggestIndex()
+    # Read before loading, so changes made while loading lead to another rebuild
+    index.version = catalog_version()
+    index.load(
+        Product.objects.values_list('id', 'title', 'brand', 'product_category', 'manufacturer_id').iterator(),
+        dict(Manufacturer.objects.values_list('id', 'name'))
+    )
+    index.built_at = time.monotonic()
+    return index
+
+
+def _background_rebuild():
+    global _index, _refreshing
+    try:
+        _index = build_index()
+    finally:
+        _refreshing = False
+        connection.close()
+
+
+def get_index():
+    """Get the process-wide index, building it on first use"""
+    global _index, _refreshing
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = build_index()
+        return _index
+
+    if time.monotonic() - _index.built_at > REFRESH_INTERVAL and not _refreshing:
+        _index.built_at = time.monotonic()
+        if catalog_version() != _index.version:
+            # Another process changed the catalog; rebuild without blocking lookups
+            _refreshing = True
+            threading.Thread(target=_background_rebuild, daemon=True).start()
+    return _index
+
+
+def _on_commit(update):
+    """Apply update(index) to the built index once the current transaction commits"""
+    def apply():
+        if _index is not None:
+            update(_index)
+    transaction.on_commit(apply)
+
+
+def product_changed(product):
+    values = (product.pk, product.manufacturer_id, product.title, product.brand, product.product_category)
+    _on_commit(lambda index: index.set_product(*values))
+
+
+def product_removed(product_id):
+    _on_commit(lambda index: index.remove_product(product_id))
+
+
+def manufacturer_changed(manufacturer):
+    values = (manufacturer.pk, manufacturer.name)
+    _on_commit(lambda index: index.set_manufacturer(*values))
+
+
+def suggest(query, limit=10):
+    return get_index().suggest(query, limit)
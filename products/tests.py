@@ -1,9 +1,34 @@
 # products/tests.py
-from django.test import TestCase
+import datetime
+import decimal
+import json
+import os
+import shutil
+import tempfile
+from io import BytesIO, StringIO
+from unittest import mock
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
+from django.core.files.uploadedfile import SimpleUploadedFile
 from rest_framework.test import APIClient
 from django.contrib.auth import get_user_model
-from .models import Shop, Product
+from .models import (
+    Shop, Product, Manufacturer, ProductGallery, FeaturedProduct, CatalogVersion, FlicksAnalytics,
+    FlicksAnalyticsShard, ViewSession, HourlyViewRollup, DailyViewRollup, RollupWatermark, Device, SpoolCheckpoint,
+    TrendingScore
+)
+from . import analytics_buffer, devices, event_spool, retention, rollups, suggest, trending, unique_viewers, watch_histograms
+from .analytics_events import process_events
+from .hyperloglog import HyperLogLog, hash_value
+from .session_tokens import is_token
+from .row_compiler import compile_products, product_values
+from .serializers import ProductSerializer
+from rest_framework.test import APIRequestFactory
 
 User = get_user_model()
 
@@ -47,4 +72,1610 @@ class APIEndpointTests(TestCase):
         url = reverse('store-info')
         self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.token}')
         response = self.client.get(url)
-        self.assertEqual(response.status_code, 200)
\ No newline at end of file
+        self.assertEqual(response.status_code, 200)
+
+
+TEST_STORAGES = {
+    "default": {"BACKEND": "django.core.files.storage.InMemoryStorage"},
+    "staticfiles": {"BACKEND": "django.core.files.storage.InMemoryStorage"},
+}
+
+
+def create_product(manufacturer=None, **kwargs):
+    data = {
+        'title': 'Test Product',
+        'product_category': 'Puzzles',
+        'age_group': '3-5 yrs',
+        'standardized_age': '3-5 Years',
+        'brand': 'TestBrand',
+        'gender': 'U',
+        'description': 'A test product',
+    }
+    data.update(kwargs)
+    return Product.objects.create(manufacturer=manufacturer, **data)
+
+
+def add_gallery_image(product, name='photo.jpg', **kwargs):
+    return ProductGallery.objects.create(
+        product=product,
+        media_type='image',
+        image=SimpleUploadedFile(name, b'image-bytes', content_type='image/jpeg'),
+        **kwargs
+    )
+
+
+@override_settings(STORAGES=TEST_STORAGES)
+class ProductListQueryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='lister', password='testpassword')
+        self.manufacturer = Manufacturer.objects.create(
+            name='Acme', email='acme@example.com', phone='123', address='Somewhere'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_products(self, count):
+        for i in range(count):
+            product = create_product(self.manufacturer, title=f'Product {i}')
+            add_gallery_image(product, name=f'photo{i}.jpg')
+            add_gallery_image(product, name=f'extra{i}.jpg')
+
+    def test_all_products_query_count_is_constant(self):
+        self.create_products(3)
+        # catalog version + products + count + gallery prefetch
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('all-products'))
+        self.assertEqual(response.status_code, 200)
+
+        self.create_products(5)
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('all-products'))
+        self.assertEqual(len(response.data['results']), 8)
+
+    def test_primary_image_comes_from_prefetched_gallery(self):
+        self.create_products(2)
+        response = self.client.get(reverse('all-products'))
+        for item in response.data['results']:
+            primary = [g for g in item['gallery_items'] if g['is_primary']]
+            self.assertEqual(len(primary), 1)
+            self.assertEqual(item['image_url'], primary[0]['url'])
+
+    def test_featured_and_filter_lists_query_count_is_constant(self):
+        self.create_products(4)
+        for i, product in enumerate(Product.objects.order_by('id')):
+            FeaturedProduct.objects.create(product=product, featured_type='trending', display_order=i)
+
+        # catalog version + trending pins + trending ranking + products + gallery prefetch
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse('trending-products'))
+        self.assertEqual([p['title'] for p in response.json()], [f'Product {i}' for i in range(4)])
+
+        # fallback list when nothing is featured: version + featured check + products + gallery prefetch
+        with self.assertNumQueries(4):
+            self.client.get(reverse('top-products'))
+
+        with self.assertNumQueries(3):
+            self.client.get(reverse('filter-products'), {'gender': 'U'})
+
+    def test_product_detail_uses_prefetched_gallery(self):
+        self.create_products(1)
+        product = Product.objects.get()
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('product-detail', args=[product.id]))
+        self.assertEqual(len(response.data['gallery']), 2)
+        self.assertIsNotNone(response.data['image_url'])
+
+
+@override_settings(STORAGES=TEST_STORAGES)
+class PrimaryMediaDenormalizationTests(TestCase):
+    def setUp(self):
+        self.product = create_product()
+
+    def test_first_image_is_copied_to_product(self):
+        item = add_gallery_image(self.product)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.primary_image_file.name, item.image.name)
+
+    def test_primary_reassignment_updates_product(self):
+        add_gallery_image(self.product, name='first.jpg')
+        second = add_gallery_image(self.product, name='second.jpg', is_primary=True)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.primary_image_file.name, second.image.name)
+
+    def test_deleting_primary_clears_product(self):
+        item = add_gallery_image(self.product)
+        item.delete()
+        self.product.refresh_from_db()
+        self.assertFalse(self.product.primary_image_file)
+
+    def test_queryset_delete_clears_product(self):
+        add_gallery_image(self.product)
+        ProductGallery.objects.filter(product=self.product).delete()
+        self.product.refresh_from_db()
+        self.assertFalse(self.product.primary_image_file)
+
+    def test_stale_instance_keeps_primary_media(self):
+        stale = Product.objects.get(pk=self.product.pk)
+        item = add_gallery_image(self.product)
+        stale.title = 'Renamed'
+        stale.save()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.title, 'Renamed')
+        self.assertEqual(self.product.primary_image_file.name, item.image.name)
+
+    def test_video_duration_is_copied(self):
+        ProductGallery.objects.create(
+            product=self.product,
+            media_type='video',
+            video=SimpleUploadedFile('clip.mp4', b'video-bytes', content_type='video/mp4'),
+            video_duration=12,
+        )
+        self.product.refresh_from_db()
+        self.assertTrue(self.product.primary_video_file)
+        self.assertEqual(self.product.primary_video_duration, 12)
+
+    def test_backfill_command_populates_existing_rows(self):
+        item = add_gallery_image(self.product)
+        Product.objects.update(primary_image_file=None)
+        call_command('backfill_primary_media', batch_size=1, stdout=StringIO())
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.primary_image_file.name, item.image.name)
+
+
+class CursorPaginationTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.products = [create_product(title=f'Product {i:02d}', brand=f'Brand {i % 3}') for i in range(25)]
+
+    def walk(self, params):
+        titles, after = [], None
+        while True:
+            query = dict(params, **({'after': after} if after else {}))
+            response = self.client.get(reverse('all-products'), query)
+            self.assertEqual(response.status_code, 200)
+            titles += [p['title'] for p in response.data['results']]
+            after = response.data['next_cursor']
+            if not after:
+                return titles
+
+    def test_cursor_walk_visits_every_product_once(self):
+        titles = self.walk({'pagination': 'cursor', 'page_size': 7})
+        self.assertEqual(titles, [p.title for p in self.products])
+
+    def test_cursor_walk_on_sort_key(self):
+        titles = self.walk({'sort': '-brand', 'page_size': 4})
+        expected = sorted(self.products, key=lambda p: (p.brand, p.id), reverse=True)
+        self.assertEqual(titles, [p.title for p in expected])
+
+    def test_before_cursor_returns_previous_page(self):
+        first = self.client.get(reverse('all-products'), {'sort': 'title', 'page_size': 5}).data
+        second = self.client.get(reverse('all-products'), {'sort': 'title', 'page_size': 5, 'after': first['next_cursor']}).data
+        back = self.client.get(reverse('all-products'), {'sort': 'title', 'page_size': 5, 'before': second['previous_cursor']}).data
+        self.assertEqual(back['results'], first['results'])
+
+    def test_count_is_optional_and_cached(self):
+        response = self.client.get(reverse('all-products'), {'pagination': 'cursor'})
+        self.assertNotIn('count', response.data)
+        response = self.client.get(reverse('all-products'), {'pagination': 'cursor', 'include_count': 'true'})
+        self.assertEqual(response.data['count'], 25)
+        with self.assertNumQueries(3):
+            self.client.get(reverse('all-products'), {'pagination': 'cursor', 'include_count': 'true'})
+        create_product()
+        response = self.client.get(reverse('all-products'), {'pagination': 'cursor', 'include_count': 'true'})
+        self.assertEqual(response.data['count'], 26)
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get(reverse('all-products'), {'after': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 400)
+        token = self.client.get(reverse('all-products'), {'sort': 'title'}).data['next_cursor']
+        response = self.client.get(reverse('all-products'), {'sort': 'brand', 'after': token})
+        self.assertEqual(response.status_code, 400)
+
+    def test_tampered_cursor_is_rejected(self):
+        from .pagination import encode_cursor
+        for sort, values in (
+            ('id', [{'a': 1}]), ('id', ['abc']), ('id', [None]), ('id', [[1, 2]]), ('id', [True]),
+            ('title', [5, 'x']), ('title', ['x', 1.5]),
+        ):
+            for direction in ('after', 'before'):
+                response = self.client.get(reverse('all-products'), {'sort': sort, direction: encode_cursor(sort, values)})
+                self.assertEqual(response.status_code, 400, (sort, values))
+
+    def test_page_mode_still_supported(self):
+        response = self.client.get(reverse('all-products'), {'page': 3, 'page_size': 10})
+        self.assertEqual(response.data['count'], 25)
+        self.assertEqual(response.data['total_pages'], 3)
+        self.assertEqual(len(response.data['results']), 5)
+
+
+class ProductSearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='searcher', password='testpassword')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.manufacturer = Manufacturer.objects.create(
+            name='Funskool', email='fun@example.com', phone='123', address='Chennai'
+        )
+        self.puzzle = create_product(title='Wooden Jigsaw Puzzle', brand='Woodies',
+                                     product_category='Games', description='Fifty pieces')
+        self.blocks = create_product(self.manufacturer, title='Building Blocks', brand='Blocko',
+                                     product_category='Construction',
+                                     description='Great companion to any puzzle collection')
+        self.car = create_product(title='Racing Car', brand='Speedy',
+                                  product_category='Vehicles', description='Remote controlled')
+
+    def search(self, query, **params):
+        response = self.client.get(reverse('search-products'), {'q': query, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_title_matches_rank_above_description_matches(self):
+        data = self.search('puzzle')
+        self.assertEqual([p['id'] for p in data['results']], [self.puzzle.id, self.blocks.id])
+        self.assertEqual(data['count'], 2)
+
+    def test_prefix_and_manufacturer_matches(self):
+        self.assertEqual([p['id'] for p in self.search('racin')['results']], [self.car.id])
+        self.assertEqual([p['id'] for p in self.search('funskool')['results']], [self.blocks.id])
+
+    def test_index_follows_product_and_manufacturer_changes(self):
+        self.car.title = 'Racing Truck'
+        self.car.save()
+        self.assertEqual([p['id'] for p in self.search('truck')['results']], [self.car.id])
+
+        self.manufacturer.name = 'Toyland'
+        self.manufacturer.save()
+        self.assertEqual(self.search('funskool')['count'], 0)
+        self.assertEqual([p['id'] for p in self.search('toyland')['results']], [self.blocks.id])
+
+        self.car.delete()
+        self.assertEqual(self.search('truck')['count'], 0)
+
+    def test_pagination_happens_in_the_index(self):
+        for i in range(5):
+            create_product(title=f'Puzzle box {i}', product_category='Games')
+        data = self.search('puzzle', page=2, page_size=3)
+        self.assertEqual(len(data['results']), 3)
+        self.assertEqual(data['count'], 7)
+        self.assertTrue(data['has_more'])
+
+    def test_out_of_range_paging_is_clamped(self):
+        data = self.search('puzzle', page=0, page_size=-5)
+        self.assertEqual((data['page'], data['page_size']), (1, 1))
+        self.assertEqual([p['id'] for p in data['results']], [self.puzzle.id])
+
+    def test_punctuation_only_query_returns_nothing(self):
+        self.assertEqual(self.search('"*')['count'], 0)
+
+
+class ProductSuggestTests(TestCase):
+    def setUp(self):
+        suggest._index = None
+        self.user = User.objects.create_user(username='typer', password='testpassword')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.manufacturer = Manufacturer.objects.create(
+            name='Funskool', email='fun@example.com', phone='123', address='Chennai'
+        )
+        create_product(self.manufacturer, title='Lego City Police Station', brand='Lego', product_category='Construction')
+        create_product(self.manufacturer, title='Lego Friends Cafe', brand='Lego', product_category='Construction')
+        create_product(title='Wooden Jigsaw Puzzle', brand='Woodies', product_category='Puzzles')
+
+    def suggestions(self, query, **params):
+        response = self.client.get(reverse('suggest-products'), {'q': query, **params})
+        self.assertEqual(response.status_code, 200)
+        return [(s['text'], s['type']) for s in response.data['suggestions']]
+
+    def test_prefix_completions_rank_shared_terms_first(self):
+        results = self.suggestions('le')
+        self.assertEqual(results[0], ('Lego', 'brand'))
+        self.assertIn(('Lego City Police Station', 'title'), results)
+
+    def test_word_starts_inside_titles_match(self):
+        self.assertIn(('Lego City Police Station', 'title'), self.suggestions('police'))
+
+    def test_typos_are_tolerated(self):
+        self.assertIn(('Lego', 'brand'), self.suggestions('lgeo'))
+        self.assertIn(('Wooden Jigsaw Puzzle', 'title'), self.suggestions('jigsow puz'))
+        self.assertIn(('Funskool', 'manufacturer'), self.suggestions('funskol'))
+
+    def test_lookups_do_not_query_the_database(self):
+        self.suggestions('lego')
+        with self.assertNumQueries(0):
+            suggest.suggest('lego')
+            suggest.suggest('puzzle')
+
+    def test_changes_from_other_workers_trigger_a_rebuild(self):
+        index = suggest.get_index()
+        # Another worker's change, then one of our own: ours mustn't hide theirs
+        CatalogVersion.bump()
+        create_product(title='Magnetic Tiles', brand='Magna')
+        index.built_at -= suggest.REFRESH_INTERVAL + 1
+        with mock.patch.object(suggest.threading, 'Thread') as thread:
+            suggest.get_index()
+        thread.assert_called_once()
+
+        # Once rebuilt, nothing more to do until the catalog changes again
+        suggest._index, suggest._refreshing = suggest.build_index(), False
+        suggest._index.built_at -= suggest.REFRESH_INTERVAL + 1
+        with mock.patch.object(suggest.threading, 'Thread') as thread:
+            suggest.get_index()
+        thread.assert_not_called()
+        self.assertFalse(suggest._refreshing)
+
+    def test_index_is_updated_incrementally(self):
+        self.suggestions('lego')
+        with self.captureOnCommitCallbacks(execute=True):
+            product = create_product(title='Magnetic Tiles', brand='Magna')
+        self.assertIn(('Magnetic Tiles', 'title'), self.suggestions('magn'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            product.delete()
+        self.assertEqual(self.suggestions('magn'), [])
+
+        self.manufacturer.name = 'Toyland'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.manufacturer.save()
+        self.assertIn(('Toyland', 'manufacturer'), self.suggestions('toy'))
+        self.assertNotIn(('Funskool', 'manufacturer'), self.suggestions('funs'))
+
+    def test_rolled_back_changes_leave_the_index_alone(self):
+        self.suggestions('lego')
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                create_product(title='Magnetic Tiles', brand='Magna')
+                self.manufacturer.name = 'Toyland'
+                self.manufacturer.save()
+                raise IntegrityError
+        self.assertEqual(self.suggestions('magn'), [])
+        self.assertIn(('Funskool', 'manufacturer'), self.suggestions('funs'))
+
+    def test_manufacturer_names_without_words(self):
+        self.suggestions('lego')
+        for name in ('***', 'Toyland', '---'):
+            self.manufacturer.name = name
+            with self.captureOnCommitCallbacks(execute=True):
+                self.manufacturer.save()
+        self.assertEqual(self.suggestions('toy'), [])
+        self.assertIn(('Lego', 'brand'), self.suggestions('le'))
+
+    def test_limit(self):
+        self.assertEqual(len(self.suggestions('l', limit=2)), 2)
+
+
+class FilterProductsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='filterer', password='testpassword')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        for i in range(12):
+            create_product(
+                title=f'Product {i:02d}',
+                gender='MFU'[i % 3],
+                standardized_age=['3-5 Years', '5-7 Years'][i % 2],
+                product_category=['Puzzles', 'Vehicles', 'Dolls'][i % 3],
+            )
+
+    def test_multi_value_filters(self):
+        response = self.client.get(reverse('filter-products'), {'category': ['Puzzles', 'Dolls'], 'age_group': '3-5 Years'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({p['product_category'] for p in response.data}, {'Puzzles', 'Dolls'})
+        self.assertEqual(len(response.data), 4)
+
+    def test_cursor_pages_cover_the_filtered_set(self):
+        params = {'gender': ['M', 'F'], 'sort': '-title', 'page_size': 3, 'include_count': 'true'}
+        first = self.client.get(reverse('filter-products'), params).data
+        self.assertEqual(first['count'], 8)
+        titles = [p['title'] for p in first['results']]
+        after = first['next_cursor']
+        while after:
+            page = self.client.get(reverse('filter-products'), {**params, 'after': after}).data
+            titles += [p['title'] for p in page['results']]
+            after = page['next_cursor']
+        expected = Product.objects.filter(gender__in=['M', 'F']).order_by('-title').values_list('title', flat=True)
+        self.assertEqual(titles, list(expected))
+
+    def test_common_filters_use_an_index(self):
+        ordered_filters = [
+            {'gender': 'U'},
+            {'product_category': 'Puzzles'},
+            {'standardized_age': '3-5 Years'},
+            {'gender': 'F', 'standardized_age': '5-7 Years'},
+        ]
+        for filters in ordered_filters:
+            plan = Product.objects.filter(**filters).order_by('id')[:11].explain()
+            self.assertIn('USING INDEX', plan, f'{filters}: {plan}')
+            # The index also supplies the id order, so a page needs no sort
+            self.assertNotIn('TEMP B-TREE', plan, f'{filters}: {plan}')
+
+        plan = Product.objects.filter(product_category__in=['Puzzles', 'Dolls'], gender='U').order_by('id')[:11].explain()
+        self.assertIn('USING INDEX', plan)
+
+
+class ProductFacetsTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.manufacturer = Manufacturer.objects.create(
+            name='Acme', email='acme@example.com', phone='123', address='Somewhere'
+        )
+        create_product(self.manufacturer, product_category='Puzzles', gender='U', brand='Woodies')
+        create_product(self.manufacturer, product_category='Puzzles', gender='M', brand='Woodies')
+        create_product(product_category='Vehicles', gender='M', brand='Speedy', standardized_age='7-12 Years')
+
+    def facets(self, **params):
+        response = self.client.get(reverse('product-facets'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def counts(self, data, facet):
+        return {item['value']: item['count'] for item in data['facets'][facet]}
+
+    def test_unfiltered_counts(self):
+        data = self.facets()
+        self.assertEqual(data['count'], 3)
+        self.assertEqual(self.counts(data, 'category'), {'Puzzles': 2, 'Vehicles': 1})
+        self.assertEqual(self.counts(data, 'age_group'), {'3-5 Years': 2, '7-12 Years': 1})
+        self.assertEqual(data['facets']['manufacturer'], [{'value': self.manufacturer.id, 'name': 'Acme', 'count': 2}])
+
+    def test_facets_ignore_their_own_filter(self):
+        data = self.facets(gender='M')
+        self.assertEqual(data['count'], 2)
+        # Other facets narrowed by gender
+        self.assertEqual(self.counts(data, 'category'), {'Puzzles': 1, 'Vehicles': 1})
+        # Gender itself still shows every option
+        self.assertEqual(self.counts(data, 'gender'), {'M': 2, 'U': 1})
+
+    def test_counts_are_cached_until_products_change(self):
+        self.facets(category='Puzzles')
+        with self.assertNumQueries(1):
+            self.facets(category='Puzzles')
+        create_product(product_category='Puzzles')
+        self.assertEqual(self.facets(category='Puzzles')['count'], 3)
+
+    def test_categories_endpoint_uses_facets(self):
+        response = self.client.get(reverse('product-categories'))
+        self.assertEqual(response.data, ['Puzzles', 'Vehicles'])
+
+
+@override_settings(STORAGES=TEST_STORAGES)
+class FeaturedListCacheTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='home', password='testpassword')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.products = [create_product(title=f'Product {i}') for i in range(3)]
+        FeaturedProduct.objects.create(product=self.products[1], featured_type='trending', display_order=0)
+
+    def titles(self, url_name):
+        return [p['title'] for p in self.client.get(reverse(url_name)).json()]
+
+    def test_cached_list_is_a_single_cache_read(self):
+        self.assertEqual(self.titles('trending-products'), ['Product 1'])
+        # Only the catalog version lookup for the ETag hits the database
+        with self.assertNumQueries(1):
+            self.assertEqual(self.titles('trending-products'), ['Product 1'])
+
+    def test_rebuilt_eagerly_when_placements_change(self):
+        self.titles('trending-products')
+        with self.captureOnCommitCallbacks(execute=True):
+            FeaturedProduct.objects.create(product=self.products[2], featured_type='trending', display_order=1)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.titles('trending-products'), ['Product 1', 'Product 2'])
+
+    def test_csv_import_is_one_transaction(self):
+        admin_user = User.objects.create_superuser(username='admin', password='testpassword', email='a@example.com')
+        self.client.force_login(admin_user)
+        manufacturer = Manufacturer.objects.create(name='Acme', email='acme@example.com', phone='123', address='Here')
+        header = 'Title,Product Category,Age Group,Brand,Gender,SEO Description\n'
+        upload = SimpleUploadedFile('products.csv', (
+            header + 'Kite,Outdoor,3-5 yrs,Sky,Unisex,A kite\n' + 'Broken row,Outdoor\n'
+        ).encode(), content_type='text/csv')
+
+        self.client.post(reverse('admin:upload-csv', args=[manufacturer.id]), {'file': upload})
+        # The second row is missing columns, so the first isn't imported either
+        self.assertFalse(Product.objects.filter(title='Kite').exists())
+
+    def test_featured_product_and_gallery_changes_refresh_the_list(self):
+        self.titles('trending-products')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products[1].title = 'Renamed'
+            self.products[1].save()
+        self.assertEqual(self.titles('trending-products'), ['Renamed'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            add_gallery_image(self.products[1])
+        self.assertIsNotNone(self.client.get(reverse('trending-products')).json()[0]['image_url'])
+
+    def test_manufacturer_renames_refresh_the_list(self):
+        manufacturer = Manufacturer.objects.create(name='Acme', email='acme@example.com', phone='1', address='x')
+        Product.objects.filter(pk=self.products[1].pk).update(manufacturer=manufacturer)
+        self.assertEqual(self.client.get(reverse('trending-products')).json()[0]['manufacturer_name'], 'Acme')
+        with self.captureOnCommitCallbacks(execute=True):
+            manufacturer.name = 'Acme Toys'
+            manufacturer.save()
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('trending-products'))
+        self.assertEqual(response.json()[0]['manufacturer_name'], 'Acme Toys')
+
+    def test_narrower_cached_views_are_refreshed(self):
+        cache.clear()
+        self.client.get(reverse('trending-products'), {'view': 'card'})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products[1].title = 'Renamed'
+            self.products[1].save()
+        response = self.client.get(reverse('trending-products'), {'view': 'card'})
+        self.assertEqual([p['title'] for p in response.json()], ['Renamed'])
+
+    def test_unrelated_products_leave_curated_list_alone(self):
+        self.titles('trending-products')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products[0].title = 'Not featured'
+            self.products[0].save()
+        with self.assertNumQueries(1):
+            self.titles('trending-products')
+
+    def test_fallback_list_follows_new_products(self):
+        self.assertEqual(self.titles('top-products'), ['Product 2', 'Product 1', 'Product 0'])
+        create_product(title='Newest')
+        self.assertEqual(self.titles('top-products')[0], 'Newest')
+
+
+@override_settings(STORAGES=TEST_STORAGES)
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='etag', password='testpassword')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.product = create_product(title='Cached')
+
+    def test_product_detail_revalidates_with_one_lookup(self):
+        url = reverse('product-detail', args=[self.product.id])
+        etag = self.client.get(url)['ETag']
+        self.assertTrue(etag.startswith('"'))
+
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self.product.title = 'Edited'
+        self.product.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_gallery_changes_move_the_product_version_on(self):
+        url = reverse('product-detail', args=[self.product.id])
+        etag = self.client.get(url)['ETag']
+        add_gallery_image(self.product)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        self.product.refresh_from_db()
+        self.assertGreater(self.product.version, 1)
+
+    def test_stale_instance_edit_gets_a_new_version(self):
+        stale = Product.objects.get(pk=self.product.pk)
+        add_gallery_image(self.product)
+        after_gallery = Product.objects.get(pk=self.product.pk).version
+        stale.title = 'Edited'
+        stale.save()
+        self.assertEqual(stale.version, after_gallery + 1)
+        self.assertEqual(Product.objects.get(pk=self.product.pk).version, after_gallery + 1)
+
+    def test_list_etags_follow_the_catalog_version(self):
+        url = reverse('all-products')
+        response = self.client.get(url, {'page_size': 5})
+        etag = response['ETag']
+        self.assertIn('Last-Modified', response)
+        self.assertNotEqual(self.client.get(url, {'page_size': 6})['ETag'], etag)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(url, {'page_size': 5}, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        version = CatalogVersion.current()[0]
+        create_product(title='New arrival')
+        self.assertEqual(CatalogVersion.current()[0], version + 1)
+        self.assertEqual(self.client.get(url, {'page_size': 5}, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_missing_product_is_not_conditional(self):
+        response = self.client.get(reverse('product-detail', args=[999999]), HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(STORAGES=TEST_STORAGES)
+class SparseFieldsetTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='grid', password='testpassword')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        for i in range(3):
+            add_gallery_image(create_product(title=f'Card {i}', description='Long description ' * 50))
+
+    def test_card_view_skips_unused_columns_and_gallery(self):
+        full = self.client.get(reverse('all-products'))
+        # catalog version + products (the count is cached), no gallery prefetch
+        with self.assertNumQueries(2) as queries:
+            card = self.client.get(reverse('all-products'), {'view': 'card'})
+        self.assertNotIn('description', queries.captured_queries[1]['sql'])
+
+        item = card.data['results'][0]
+        self.assertEqual(list(item), ['id', 'title', 'brand', 'image_url'])
+        self.assertEqual(item['image_url'], full.data['results'][0]['image_url'])
+        self.assertLess(len(card.content) * 3, len(full.content))
+
+    def test_fields_and_exclude(self):
+        response = self.client.get(reverse('filter-products'), {'fields': 'title,manufacturer_name'})
+        self.assertEqual(list(response.data[0]), ['title', 'manufacturer_name'])
+
+        response = self.client.get(reverse('all-products'), {'exclude': 'gallery_items,description'})
+        item = response.data['results'][0]
+        self.assertNotIn('gallery_items', item)
+        self.assertIn('video_url', item)
+
+        response = self.client.get(reverse('all-products'), {'fields': 'title,price'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get(reverse('all-products'), {'view': 'tiny'}).status_code, 400)
+
+    def test_cursor_pages_load_sort_columns(self):
+        # catalog version + products, with the sort column loaded up front
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('all-products'), {'sort': '-title', 'fields': 'id', 'page_size': 2})
+        self.assertEqual(response.data['results'], [{'id': 3}, {'id': 2}])
+        self.assertIsNotNone(response.data['next_cursor'])
+
+    def test_detail_and_featured_lists(self):
+        product = Product.objects.get(title='Card 1')
+        response = self.client.get(reverse('product-detail', args=[product.id]), {'fields': 'title,gallery'})
+        self.assertEqual(list(response.data), ['title', 'gallery'])
+        self.assertEqual(len(response.data['gallery']), 1)
+
+        FeaturedProduct.objects.create(product=product, featured_type='trending', display_order=0)
+        self.assertEqual(self.client.get(reverse('trending-products'), {'view': 'card'}).json(), [{
+            'id': product.id, 'title': 'Card 1', 'brand': 'TestBrand', 'image_url': product.primary_image_file.url,
+        }])
+        self.assertIn('description', self.client.get(reverse('trending-products')).json()[0])
+        self.assertEqual(list(self.client.get(reverse('top-products'), {'fields': 'id'}).json()[0]), ['id'])
+
+
+@override_settings(STORAGES=TEST_STORAGES)
+class RowCompilerTests(TestCase):
+    def setUp(self):
+        manufacturer = Manufacturer.objects.create(name='Acme', email='acme@example.com', phone='1', address='x')
+        with_gallery = create_product(manufacturer, title='With gallery', description='')
+        add_gallery_image(with_gallery, name='second photo.jpg', display_order=2, alt_text='Side')
+        add_gallery_image(with_gallery, name='first.jpg', display_order=1)
+        clip = add_gallery_image(with_gallery, name='clip.jpg', display_order=3)
+        ProductGallery.objects.filter(pk=clip.pk).update(media_type='video', image='', video='products/gallery/clip one.mp4')
+        flicks_only = create_product(title='Flicks only')
+        Product.objects.filter(pk=flicks_only.pk).update(flicks='products/videos/flick ü.mp4')
+        create_product(title='Bare', brand='')
+
+    def assertMatchesSerializer(self, fields=None, request=None):
+        products = Product.objects.with_media().order_by('id')
+        context = {'request': request} if request else {}
+        expected = ProductSerializer(products, many=True, fields=fields, context=context).data
+        compiled = compile_products(product_values(Product.objects.order_by('id'), fields), fields, request)
+        self.assertEqual(compiled, [dict(item) for item in expected])
+
+    def test_output_matches_drf_serializer(self):
+        self.assertMatchesSerializer()
+        self.assertMatchesSerializer(request=APIRequestFactory().get('/api/products/'))
+        self.assertMatchesSerializer(fields=['id', 'title', 'image_url'])
+        self.assertMatchesSerializer(fields=['gallery_items', 'manufacturer_name'])
+
+    def test_one_query_per_page_plus_gallery(self):
+        with self.assertNumQueries(2):
+            compile_products(product_values(Product.objects.all()))
+        with self.assertNumQueries(1):
+            compile_products(product_values(Product.objects.all(), ['id', 'title']), ['id', 'title'])
+
+
+@override_settings(STORAGES=TEST_STORAGES)
+class BatchProductsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='carousel', password='testpassword')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        manufacturer = Manufacturer.objects.create(name='Acme', email='acme@example.com', phone='1', address='x')
+        self.products = [create_product(manufacturer, title=f'Flick {i}') for i in range(4)]
+        for product in self.products:
+            add_gallery_image(product)
+
+    def test_keeps_requested_order_and_reports_missing(self):
+        ids = [self.products[2].id, 999999, self.products[0].id, self.products[2].id]
+        # catalog version + products with manufacturers + gallery items
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('batch-products'), {'ids': ','.join(map(str, ids))})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([p['title'] for p in response.data['results']], ['Flick 2', 'Flick 0'])
+        self.assertEqual(response.data['missing'], [999999])
+
+        detail = self.client.get(reverse('product-detail', args=[self.products[2].id])).data
+        self.assertEqual(response.data['results'][0], detail)
+
+    def test_post_body_and_validation(self):
+        response = self.client.post(
+            reverse('batch-products') + '?view=card',
+            {'ids': [self.products[1].id, self.products[3].id]},
+            format='json'
+        )
+        self.assertEqual([p['title'] for p in response.data['results']], ['Flick 1', 'Flick 3'])
+        self.assertNotIn('gallery', response.data['results'][0])
+
+        self.assertEqual(self.client.get(reverse('batch-products'), {'ids': '1,x'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('batch-products')).status_code, 400)
+        self.assertEqual(self.client.post(reverse('batch-products'), {'ids': list(range(101))}, format='json').status_code, 400)
+        for ids in ([True], [1.7], ['1'], [None]):
+            self.assertEqual(self.client.post(reverse('batch-products'), {'ids': ids}, format='json').status_code, 400, ids)
+
+    def test_post_ignores_conditional_headers(self):
+        ids = [self.products[0].id]
+        etag = self.client.get(reverse('batch-products'), {'ids': str(ids[0])})['ETag']
+        response = self.client.post(reverse('batch-products'), {'ids': ids}, format='json', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response)
+
+
+
+class FastJSONTests(TestCase):
+    def test_renderer_matches_drf(self):
+        from django.utils.translation import gettext_lazy
+        from rest_framework.renderers import JSONRenderer
+        from .renderers import FastJSONRenderer
+
+        data = {
+            'start_time': datetime.datetime(2025, 3, 1, 12, 30, 5, 123456, tzinfo=datetime.timezone.utc),
+            'naive': datetime.datetime(2025, 3, 1, 12, 30),
+            'day': datetime.date(2025, 3, 1),
+            'price': decimal.Decimal('12.50'),
+            'label': gettext_lazy('Product'),
+            'nested': [{'ids': (1, 2)}, None, 'caf\u00e9 \u2028'],
+            7: 'non-string key',
+        }
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(FastJSONRenderer().render(None), b'')
+
+    def test_parser(self):
+        from rest_framework.exceptions import ParseError
+        from .renderers import FastJSONParser
+
+        self.assertEqual(FastJSONParser().parse(BytesIO(b'{"ids": [1, 2], "name": "caf\xc3\xa9"}')),
+                         {'ids': [1, 2], 'name': 'caf\u00e9'})
+        with self.assertRaises(ParseError):
+            FastJSONParser().parse(BytesIO(b'{"ids": '))
+
+    def test_analytics_post_round_trip(self):
+        product = create_product()
+        Product.objects.filter(pk=product.pk).update(flicks='products/videos/clip.mp4')
+        response = APIClient().post(reverse('start-view'), {'product_id': product.id}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(response.json()['start_time'].endswith('Z'))
+
+    def test_large_filter_results_are_streamed(self):
+        user = User.objects.create_user(username='bulk', password='testpassword')
+        client = APIClient()
+        client.force_authenticate(user)
+        for i in range(7):
+            create_product(title=f'Bulk {i}')
+
+        with mock.patch('products.api.STREAM_CHUNK_SIZE', 3):
+            response = client.get(reverse('filter-products'), {'gender': 'U', 'view': 'card'})
+            self.assertTrue(response.streaming)
+            streamed = json.loads(b''.join(response.streaming_content))
+        self.assertEqual([p['title'] for p in streamed], [f'Bulk {i}' for i in range(7)])
+
+        response = client.get(reverse('filter-products'), {'gender': 'U', 'view': 'card'})
+        self.assertFalse(response.streaming)
+        self.assertEqual(response.data, streamed)
+
+
+@override_settings(ANALYTICS_FLUSH_INTERVAL=60)
+class AnalyticsBufferTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.product = create_product()
+        Product.objects.filter(pk=self.product.pk).update(flicks='products/videos/clip.mp4', video_duration=20)
+        self.addCleanup(analytics_buffer.buffer.flush)
+
+    def watch(self, seconds):
+        session_id = self.client.post(reverse('start-view'), {'product_id': self.product.id}, format='json').data['session_id']
+        self.client.post(reverse('end-view'), {'session_id': session_id, 'duration': seconds}, format='json')
+
+    def test_views_are_aggregated_until_flushed(self):
+        self.watch(10)
+        self.watch(4)
+        self.watch(1)  # too short to count
+        self.assertFalse(FlicksAnalytics.objects.exists())
+
+        # one existence check, one bulk insert and one update, then an insert, a locked read and an
+        # update for each of the product, hourly and daily viewer sketches and for the watch histograms
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(analytics_buffer.flush(), 1)
+        self.assertEqual(len([q for q in queries if 'SAVEPOINT' not in q['sql']]), 15)
+        analytics = FlicksAnalytics.objects.get(product=self.product)
+        self.assertEqual((analytics.views, analytics.total_watch_time), (2, 14))
+
+        self.watch(6)
+        analytics_buffer.flush()
+        analytics.refresh_from_db()
+        self.assertEqual((analytics.views, analytics.total_watch_time), (3, 20))
+
+    def test_write_through_and_size_limit(self):
+        with self.settings(ANALYTICS_FLUSH_INTERVAL=0):
+            self.watch(5)
+        self.assertEqual(FlicksAnalytics.objects.get(product=self.product).views, 1)
+
+        other = create_product(title='Other')
+        with self.settings(ANALYTICS_BUFFER_MAX_PRODUCTS=1):
+            analytics_buffer.record_view(self.product.id, 3)
+            self.assertEqual(FlicksAnalytics.objects.get(product=self.product).views, 1)
+            analytics_buffer.record_view(other.id, 3)
+        self.assertEqual(FlicksAnalytics.objects.get(product=self.product).views, 2)
+        self.assertEqual(FlicksAnalytics.objects.get(product=other).views, 1)
+
+    def test_failed_flush_keeps_increments(self):
+        analytics_buffer.record_view(self.product.id, 8)
+        with mock.patch('products.analytics_buffer.write_increments', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                analytics_buffer.flush()
+        analytics_buffer.record_view(999999, 8)  # deleted products are skipped
+        analytics_buffer.flush()
+        self.assertEqual(FlicksAnalytics.objects.get(product=self.product).total_watch_time, 8)
+        self.assertEqual(FlicksAnalytics.objects.count(), 1)
+
+    def test_flush_failing_part_way_is_not_applied_twice(self):
+        analytics_buffer.record_view(self.product.id, 8, viewer=(timezone.now(), 42))
+        with mock.patch('products.analytics_buffer.write_viewers', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                analytics_buffer.flush()
+        # The counters written before the viewer sketches failed were rolled back with them
+        self.assertFalse(FlicksAnalytics.objects.filter(views__gt=0).exists())
+        analytics_buffer.flush()
+        analytics = FlicksAnalytics.objects.get(product=self.product)
+        self.assertEqual((analytics.views, analytics.total_watch_time), (1, 8))
+
+
+
+@override_settings(ANALYTICS_COUNTER_SHARDS=4, ANALYTICS_FLUSH_INTERVAL=0)
+class ShardedCounterTests(TestCase):
+    def setUp(self):
+        self.product = create_product()
+
+    def test_reads_and_compaction_match_unsharded_counts(self):
+        for seconds in [10, 20, 30, 40, 50, 60]:
+            analytics_buffer.record_view(self.product.id, seconds)
+        self.assertFalse(FlicksAnalytics.objects.exists())
+        self.assertEqual(FlicksAnalyticsShard.objects.filter(product=self.product).count(),
+                         len(set(FlicksAnalyticsShard.objects.values_list('shard', flat=True))))
+
+        analytics = FlicksAnalytics.for_product(self.product)
+        self.assertEqual((analytics.views, analytics.total_watch_time, analytics.average_watch_time), (6, 210, 35))
+
+        out = StringIO()
+        call_command('compact_analytics_shards', stdout=out)
+        self.assertIn('1 products', out.getvalue())
+        canonical = FlicksAnalytics.objects.get(product=self.product)
+        self.assertEqual((canonical.views, canonical.total_watch_time), (6, 210))
+        self.assertFalse(FlicksAnalyticsShard.objects.exclude(views=0).exists())
+
+        analytics_buffer.record_view(self.product.id, 5)
+        analytics = FlicksAnalytics.for_product(self.product)
+        self.assertEqual((analytics.views, analytics.total_watch_time), (7, 215))
+
+    def test_admin_reads_include_shards(self):
+        from django.contrib.admin.sites import site
+        analytics_buffer.record_view(self.product.id, 75)
+        FlicksAnalytics.objects.create(product=self.product, views=2, total_watch_time=30)
+        product_admin = site._registry[Product]
+        request = APIRequestFactory().get('/')
+        request.user = User.objects.create_superuser(username='admin', password='testpassword', email='a@example.com')
+        product = product_admin.get_queryset(request).get(pk=self.product.pk)
+        self.assertEqual(product_admin.view_count(product), 3)
+        self.assertEqual(product_admin.total_watch_time_display(product), '1m 45s')
+
+    def test_admin_changelist_query_count_is_constant(self):
+        self.client.force_login(User.objects.create_superuser(username='admin', password='testpassword', email='a@example.com'))
+        url = reverse('admin:products_product_changelist')
+        with CaptureQueriesContext(connection) as one_product:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        for i in range(3):
+            analytics_buffer.record_view(create_product(title=f'More {i}').id, 10)
+        with CaptureQueriesContext(connection) as four_products:
+            self.client.get(url)
+        self.assertEqual(len(four_products), len(one_product))
+
+
+@override_settings(ANALYTICS_FLUSH_INTERVAL=0)
+class AnalyticsEventsTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.products = [create_product(title=f'Flick {i}') for i in range(2)]
+        Product.objects.update(flicks='products/videos/clip.mp4', video_duration=20)
+        self.no_video = create_product(title='No video')
+
+    def send(self, events):
+        return self.client.post(reverse('analytics-events'), {'events': events}, format='json')
+
+    def test_batch_creates_closes_and_counts_sessions(self):
+        first, second = self.products
+        events = [
+            {'type': 'start', 'product_id': first.id, 'session_id': 's-1'},
+            {'type': 'start', 'product_id': second.id, 'session_id': 's-2'},
+            {'type': 'heartbeat', 'session_id': 's-1', 'duration': 5},
+            {'type': 'end', 'session_id': 's-1', 'duration': 18, 'percent_watched': 90},
+            {'type': 'end', 'session_id': 's-2', 'duration': 1, 'percent_watched': 5},
+            {'type': 'start', 'product_id': self.no_video.id, 'session_id': 's-3'},
+            {'type': 'end', 'session_id': 'unknown', 'duration': 4},
+            {'type': 'pause', 'session_id': 's-1'},
+        ]
+        results = self.send(events).data['results']
+        self.assertEqual([r['status'] for r in results], ['ok'] * 5 + ['error'] * 3)
+        self.assertEqual([r['index'] for r in results], list(range(8)))
+        self.assertTrue(results[3]['completed'] and results[3]['counted'])
+        self.assertFalse(results[4]['counted'])
+
+        session = ViewSession.objects.get(session_id='s-1')
+        self.assertEqual((session.duration, session.completed), (18, True))
+        self.assertIsNotNone(session.end_time)
+        analytics = FlicksAnalytics.objects.get(product=first)
+        self.assertEqual((analytics.views, analytics.total_watch_time), (1, 18))
+        self.assertFalse(FlicksAnalytics.objects.filter(product=second, views__gt=0).exists())
+
+        # Retrying the whole batch changes nothing
+        retried = self.send(events).data['results']
+        self.assertEqual([r['status'] for r in retried[:5]], ['duplicate'] * 5)
+        self.assertEqual(ViewSession.objects.count(), 2)
+        self.assertEqual(FlicksAnalytics.objects.get(product=first).views, 1)
+
+    def test_writes_are_batched(self):
+        events = [{'type': 'start', 'product_id': self.products[i % 2].id, 'session_id': f'b-{i}'} for i in range(20)]
+        events += [{'type': 'end', 'session_id': f'b-{i}', 'duration': 10, 'percent_watched': 50} for i in range(20)]
+        with CaptureQueriesContext(connection) as queries:
+            results = self.send(events).data['results']
+        self.assertTrue(all(r['status'] == 'ok' for r in results))
+        inserts = [q for q in queries if q['sql'].startswith('INSERT INTO "products_viewsession"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(FlicksAnalytics.objects.get(product=self.products[0]).views, 10)
+        # Independent of the number of events; each product's write-through flush also
+        # merges 3 viewer sketches and the watch histograms
+        self.assertLess(len([q for q in queries if 'SAVEPOINT' not in q['sql']]), 50)
+
+    def test_rejects_malformed_batches(self):
+        self.assertEqual(self.client.post(reverse('analytics-events'), {'events': []}, format='json').status_code, 400)
+        self.assertEqual(self.send([{'type': 'start'}] * 501).status_code, 400)
+        result = self.send([{'type': 'end', 'session_id': 'x', 'duration': -1}]).data['results'][0]
+        self.assertEqual(result['status'], 'error')
+
+
+class ConcurrentBatchTests(TestCase):
+    def setUp(self):
+        self.product = create_product()
+        Product.objects.filter(pk=self.product.pk).update(flicks='products/videos/clip.mp4', video_duration=20)
+
+    def test_session_inserted_concurrently_is_a_duplicate(self):
+        # Another copy of the batch inserted the session, but hadn't committed when we looked
+        ViewSession.objects.create(product=self.product, session_id='client-1')
+        select_for_update = ViewSession.objects.select_for_update
+        reads = []
+
+        def not_yet_visible(*args, **kwargs):
+            reads.append(1)
+            queryset = select_for_update(*args, **kwargs)
+            return queryset.none() if len(reads) == 1 else queryset
+
+        with mock.patch.object(ViewSession.objects, 'select_for_update', side_effect=not_yet_visible):
+            results = process_events([{'type': 'start', 'product_id': self.product.id, 'session_id': 'client-1'}])
+        self.assertEqual(results[0]['status'], 'duplicate')
+        self.assertEqual(ViewSession.objects.filter(session_id='client-1').count(), 1)
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            ViewSession.objects.create(product=self.product, session_id='client-1')
+
+
+@override_settings(ANALYTICS_SIGNED_SESSIONS=True, ANALYTICS_FLUSH_INTERVAL=0)
+class SignedViewSessionTests(TestCase):
+    def setUp(self):
+        self.client = APIClient(HTTP_USER_AGENT='FlicksApp/1.0')
+        self.product = create_product()
+        Product.objects.filter(pk=self.product.pk).update(flicks='products/videos/clip.mp4', video_duration=20)
+
+    def start(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('start-view'), {'product_id': self.product.id}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse([q for q in queries if not q['sql'].startswith('SELECT')])
+        return response.data['session_id']
+
+    def end(self, token, **data):
+        return self.client.post(reverse('end-view'), {'session_id': token, 'duration': 12, 'percent_watched': 85, **data}, format='json')
+
+    def test_start_writes_nothing_and_end_inserts_one_completed_session(self):
+        token = self.start()
+        self.assertFalse(ViewSession.objects.exists())
+
+        response = self.end(token)
+        self.assertEqual(response.data, {'status': 'success', 'duration': 12, 'completed': True})
+        session = ViewSession.objects.get()
+        self.assertEqual((session.product_id, session.duration, session.completed), (self.product.id, 12, True))
+        self.assertLessEqual(session.start_time, session.end_time)
+        self.assertEqual(FlicksAnalytics.objects.get(product=self.product).views, 1)
+
+        # A token ends a single view
+        self.assertEqual(self.end(token).status_code, 404)
+        self.assertEqual(ViewSession.objects.count(), 1)
+
+    def test_rejects_tampered_foreign_and_expired_tokens(self):
+        token = self.start()
+        self.assertEqual(self.end(token[:-2] + 'xx').status_code, 400)
+        other_device = APIClient(HTTP_USER_AGENT='SomethingElse')
+        response = other_device.post(reverse('end-view'), {'session_id': token, 'duration': 5}, format='json')
+        self.assertEqual(response.status_code, 400)
+        with self.settings(ANALYTICS_SESSION_TOKEN_MAX_AGE=-1):
+            self.assertEqual(self.end(token).status_code, 400)
+        self.assertFalse(ViewSession.objects.exists())
+
+    def events(self, *events):
+        response = self.client.post(reverse('analytics-events'), {'events': list(events)}, format='json')
+        return response.data['results']
+
+    def test_batched_events_use_tokens(self):
+        [start] = self.events({'type': 'start', 'product_id': self.product.id})
+        token = start['session_id']
+        self.assertTrue(is_token(token))
+        self.assertFalse(ViewSession.objects.exists())
+
+        results = self.events(
+            {'type': 'heartbeat', 'session_id': token, 'duration': 5},
+            {'type': 'end', 'session_id': token, 'duration': 12, 'percent_watched': 85},
+            {'type': 'end', 'session_id': token, 'duration': 12, 'percent_watched': 85},
+            {'type': 'end', 'session_id': token[:-2] + 'xx', 'duration': 12},
+        )
+        self.assertEqual([r['status'] for r in results], ['ok', 'ok', 'duplicate', 'error'])
+        self.assertEqual(results[1]['session_id'], token)
+        session = ViewSession.objects.get()
+        self.assertEqual((session.duration, session.completed, session.end_time is not None), (12, True, True))
+        self.assertEqual(FlicksAnalytics.objects.get(product=self.product).views, 1)
+
+        # A token started on the single-view endpoint ends in a batch too, once
+        self.assertEqual(self.events({'type': 'end', 'session_id': self.start(), 'duration': 4})[0]['status'], 'ok')
+        self.assertEqual(ViewSession.objects.count(), 2)
+        self.assertEqual(self.events({'type': 'end', 'session_id': token, 'duration': 4})[0]['status'], 'duplicate')
+
+
+
+@override_settings(ANALYTICS_ROLLUP_LAG=0)
+class ViewRollupTests(TestCase):
+    def setUp(self):
+        self.product = create_product()
+        Product.objects.filter(pk=self.product.pk).update(video_duration=8)
+        self.now = (timezone.now() - datetime.timedelta(hours=1)).replace(minute=30, second=0, microsecond=0)
+
+    def session(self, started_hours_ago, duration, completed=False, ended=True):
+        start = self.now - datetime.timedelta(hours=started_hours_ago)
+        end = start + datetime.timedelta(seconds=duration) if ended else None
+        return ViewSession.objects.create(
+            product=self.product, session_id=f'session-{ViewSession.objects.count()}', start_time=start,
+            end_time=end, recorded_at=end, duration=duration, completed=completed
+        )
+
+    def test_incremental_rollups(self):
+        self.session(26, 10, completed=True)
+        self.session(2, 2)  # a quarter of the 8 second video counts as a view
+        self.session(2, 1)  # too short
+        self.session(1, 5, ended=False)
+
+        out = StringIO()
+        call_command('rollup_view_sessions', stdout=out)
+        self.assertIn('2 product-hours', out.getvalue())
+        hour = HourlyViewRollup.objects.get(bucket=self.now.replace(minute=0) - datetime.timedelta(hours=2))
+        self.assertEqual((hour.views, hour.watch_seconds, hour.completions, hour.sessions), (1, 2, 0, 2))
+        self.assertEqual(DailyViewRollup.objects.count(), len({
+            timezone.localdate(self.now - datetime.timedelta(hours=h)) for h in (26, 2)
+        }))
+
+        # Only sessions ended since the watermark are added
+        ViewSession.objects.create(
+            product=self.product, session_id='latest', start_time=timezone.now() - datetime.timedelta(seconds=4),
+            end_time=timezone.now(), recorded_at=timezone.now(), duration=4, completed=True
+        )
+        rollups.run_rollups()
+        rollups.run_rollups()
+        totals = rollups.product_totals(self.product)
+        self.assertEqual(totals, {'views': 3, 'watch_seconds': 16, 'completions': 2, 'sessions': 4})
+
+    def test_sessions_ended_before_recorded_at_are_backfilled(self):
+        legacy = self.session(3, 10, completed=True)
+        ViewSession.objects.filter(pk=legacy.pk).update(recorded_at=None)
+        unended = self.session(1, 5, ended=False)
+
+        call_command('migrate', verbosity=0)
+        self.assertEqual(ViewSession.objects.get(pk=legacy.pk).recorded_at, legacy.end_time)
+        self.assertIsNone(ViewSession.objects.get(pk=unended.pk).recorded_at)
+        rollups.run_rollups()
+        self.assertEqual(rollups.product_totals(self.product)['completions'], 1)
+        self.assertIn(legacy.pk, retention.prunable_sessions(timezone.now()).values_list('pk', flat=True))
+
+    def test_reads_come_from_rollups(self):
+        from .analytics import get_completion_rate
+        self.session(3, 10, completed=True)
+        self.session(3, 10)
+        rollups.run_rollups()
+        with self.assertNumQueries(1):
+            self.assertEqual(get_completion_rate(self.product), 50.0)
+        series = rollups.daily_totals(self.product, days=3)
+        self.assertEqual([day['bucket'] for day in series][-1], timezone.localdate())
+        self.assertEqual(sum(day['sessions'] for day in series), 2)
+
+
+@override_settings(STORAGES=TEST_STORAGES, ANALYTICS_SESSION_RETENTION_DAYS=30)
+class SessionRetentionTests(TestCase):
+    def setUp(self):
+        self.product = create_product()
+        self.now = timezone.now()
+
+    def session(self, days_ago, ended=True, **kwargs):
+        start = self.now - datetime.timedelta(days=days_ago)
+        end = start + datetime.timedelta(seconds=10) if ended else None
+        return ViewSession.objects.create(
+            product=self.product, session_id=f'session-{ViewSession.objects.count()}', start_time=start,
+            end_time=end, recorded_at=end, duration=10,
+            ip_address='10.0.0.1', device_info={'user_agent': 'test'}, **kwargs
+        )
+
+    def test_prune_archives_rolled_up_sessions(self):
+        old = [self.session(40), self.session(35, completed=True), self.session(33, ended=False)]
+        late = self.session(31)
+        recent = self.session(2)
+        # The rollups have only reached sessions ending before the late one
+        RollupWatermark.objects.create(
+            name=rollups.WATERMARK, position=late.end_time - datetime.timedelta(seconds=1)
+        )
+
+        out = StringIO()
+        call_command('prune_view_sessions', '--batch-size', '2', stdout=out)
+        self.assertIn('Archived and removed 3', out.getvalue())
+        self.assertEqual(set(ViewSession.objects.values_list('pk', flat=True)), {late.pk, recent.pk})
+
+        from django.core.files.storage import default_storage
+        names = retention.archive_names(retention.archive_prefix())
+        self.assertEqual(len(names), 2)
+        rows = [row for name in names for row in retention.read_archive(name)]
+        self.assertEqual([row['id'] for row in rows], [session.pk for session in old])
+        self.assertEqual(rows[1]['start_time'], old[1].start_time)
+        self.assertTrue(rows[1]['completed'])
+        self.assertIsNone(rows[2]['end_time'])
+        self.assertTrue(default_storage.exists(names[0]))
+
+        # Re-import the archive for an investigation; a second load adds nothing
+        out = StringIO()
+        call_command('load_view_session_archive', retention.archive_prefix(), stdout=out)
+        self.assertIn('Loaded 3 view sessions', out.getvalue())
+        restored = ViewSession.objects.get(pk=old[0].pk)
+        self.assertEqual((restored.device_info, restored.ip_address), ({'user_agent': 'test'}, '10.0.0.1'))
+        self.assertEqual(retention.load_archive(names[0]), (0, 2))
+
+    def test_dry_run_and_no_rollups(self):
+        self.session(40)
+        self.session(40, ended=False)
+        out = StringIO()
+        call_command('prune_view_sessions', '--dry-run', stdout=out)
+        # Without a rollup watermark only sessions that never ended can go
+        self.assertIn('1 view sessions', out.getvalue())
+        self.assertEqual(ViewSession.objects.count(), 2)
+
+    def test_partition_sql_keeps_foreign_keys(self):
+        out = StringIO()
+        call_command('prune_view_sessions', '--print-partition-sql', stdout=out)
+        sql = out.getvalue()
+        for column in ('product_id', 'user_id', 'device_id'):
+            self.assertIn(f'ADD FOREIGN KEY ({column})', sql)
+        self.assertIn('PARTITION OF products_viewsession', sql)
+
+
+PHONE_USER_AGENT = 'Mozilla/5.0 (iPhone; CPU iPhone OS 17_2 like Mac OS X) Version/17.2 Mobile/15E148 Safari/604.1'
+TABLET_USER_AGENT = 'Mozilla/5.0 (iPad; CPU OS 17_2 like Mac OS X) Version/17.2 Mobile/15E148 Safari/604.1'
+
+
+@override_settings(ANALYTICS_FLUSH_INTERVAL=60)
+class UniqueViewerTests(TestCase):
+    def setUp(self):
+        self.product = create_product()
+        Product.objects.filter(pk=self.product.pk).update(flicks='products/videos/clip.mp4', video_duration=20)
+        self.addCleanup(analytics_buffer.buffer.flush)
+
+    def watch(self, client, seconds=10, user_agent=PHONE_USER_AGENT):
+        session_id = client.post(
+            reverse('start-view'), {'product_id': self.product.id}, format='json', HTTP_USER_AGENT=user_agent
+        ).data['session_id']
+        client.post(reverse('end-view'), {'session_id': session_id, 'duration': seconds}, format='json', HTTP_USER_AGENT=user_agent)
+
+    def test_anonymous_viewers_are_identified_by_raw_user_agent(self):
+        anonymous = APIClient()
+        self.watch(anonymous)
+        # Another phone on the same network: the same Device row, a different user agent
+        self.watch(anonymous, user_agent=PHONE_USER_AGENT.replace('17_2', '17_3'))
+        self.assertEqual(Device.objects.count(), 1)
+        analytics_buffer.flush()
+        sketch = HyperLogLog.from_bytes(FlicksAnalytics.objects.get(product=self.product).unique_viewers)
+        self.assertEqual(round(sketch.estimate()), 2)
+
+        # The same identity as before sessions moved to the Device table
+        session = ViewSession.objects.first()
+        self.assertEqual(
+            unique_viewers.session_viewer(session, PHONE_USER_AGENT)[1],
+            hash_value(f'anon:{session.ip_address}:{PHONE_USER_AGENT}')
+        )
+
+    def test_sketches_estimate_and_merge(self):
+        first, second = HyperLogLog(), HyperLogLog()
+        for i in range(20000):
+            first.add(f'viewer-{i}')
+            second.add(f'viewer-{i + 10000}')
+        self.assertAlmostEqual(first.estimate(), 20000, delta=20000 * 3 * first.relative_error)
+        merged = HyperLogLog.from_bytes(first.to_bytes()).merge(second)
+        self.assertAlmostEqual(merged.estimate(), 30000, delta=30000 * 3 * merged.relative_error)
+        with self.assertRaises(ValueError):
+            first.merge(HyperLogLog(precision=10))
+
+    def test_counted_views_update_sketches(self):
+        user = User.objects.create_user(username='viewer', password='testpassword')
+        signed_in = APIClient()
+        signed_in.force_authenticate(user)
+        staff = APIClient()
+        staff.force_authenticate(User.objects.create_user(username='analyst', password='testpassword', is_staff=True))
+        anonymous = APIClient()
+        self.watch(signed_in)
+        self.watch(signed_in, user_agent=TABLET_USER_AGENT)  # the same person on another device
+        self.watch(anonymous)
+        self.watch(anonymous, user_agent=TABLET_USER_AGENT)  # anonymous viewers are told apart by device
+        self.watch(anonymous, seconds=1)  # too short to count
+        analytics_buffer.flush()
+
+        response = staff.get(reverse('unique-viewers'), {'ids': str(self.product.id)})
+        self.assertEqual(response.data['unique_viewers'], 3)
+        self.assertLessEqual(response.data['lower_bound'], 3)
+        self.assertGreaterEqual(response.data['upper_bound'], 3)
+        self.assertEqual(staff.get(reverse('unique-viewers'), {'days': 1}).data['unique_viewers'], 3)
+        hour = HourlyViewRollup.objects.get(product=self.product)
+        self.assertEqual(len(HyperLogLog.from_bytes(hour.unique_viewers)), 3)
+
+        # A returning viewer isn't counted again
+        self.watch(signed_in)
+        analytics_buffer.flush()
+        self.assertEqual(staff.get(reverse('unique-viewers')).data['unique_viewers'], 3)
+        self.assertEqual(staff.get(reverse('unique-viewers'), {'days': 0}).status_code, 400)
+
+
+@override_settings(ANALYTICS_FLUSH_INTERVAL=60)
+class WatchRetentionTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.product = create_product()
+        Product.objects.filter(pk=self.product.pk).update(flicks='products/videos/clip.mp4', video_duration=20)
+        self.addCleanup(analytics_buffer.buffer.flush)
+
+    def watch(self, seconds, percent):
+        session_id = self.client.post(reverse('start-view'), {'product_id': self.product.id}, format='json').data['session_id']
+        self.client.post(
+            reverse('end-view'), {'session_id': session_id, 'duration': seconds, 'percent_watched': percent}, format='json'
+        )
+
+    def test_failed_histogram_write_rolls_back_the_counters(self):
+        self.watch(10, 50)
+        with mock.patch.object(watch_histograms, 'pack', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                analytics_buffer.flush()
+        self.assertFalse(FlicksAnalytics.objects.filter(views__gt=0).exists())
+
+        analytics_buffer.flush()
+        analytics = FlicksAnalytics.objects.get(product=self.product)
+        self.assertEqual((analytics.views, analytics.total_watch_time), (1, 10))
+        percent, _ = watch_histograms.histograms([self.product.id])
+        self.assertEqual(percent.sum(), 1)
+
+    def test_histograms_and_percentiles(self):
+        percent, seconds = watch_histograms.bucket_counts([(0.5, 2), (7, 35), (20, 100), (900, 100)])
+        self.assertEqual(percent[[0, 7, 19]].tolist(), [1, 1, 2])
+        self.assertEqual(seconds[[0, 6, 11, 20]].tolist(), [1, 1, 1, 1])
+        edges = watch_histograms.seconds_bucket_edges()
+        self.assertEqual(watch_histograms.percentile(seconds, edges, 50), 8.0)
+        self.assertEqual(watch_histograms.percentile(seconds, edges, 100), 600.0)
+
+    def test_ended_sessions_fill_histograms(self):
+        for seconds, percent in [(1, 5), (2, 10), (10, 50), (20, 100)]:
+            self.watch(seconds, percent)
+        analytics_buffer.flush()
+        # Short sessions are in the histograms even though they aren't counted as views
+        analytics = FlicksAnalytics.objects.get(product=self.product)
+        self.assertEqual((analytics.views, analytics.total_watch_time), (2, 30))
+        self.watch(19, 95)
+        analytics_buffer.flush()
+
+        self.client.force_authenticate(User.objects.create_user(username='owner', password='testpassword', is_staff=True))
+        response = self.client.get(reverse('watch-retention'), {'ids': str(self.product.id)})
+        data = response.data
+        self.assertEqual(data['sessions'], 5)
+        self.assertEqual(data['percent_drop_off'][0], {'at': 0, 'retained': 1.0})
+        self.assertEqual(data['percent_drop_off'][10]['retained'], 0.6)  # 3 of 5 reached 50%
+        self.assertEqual(data['percent_histogram'][19], 2)
+        self.assertTrue(10 <= data['p50_seconds'] <= 12)
+        self.assertTrue(95 <= data['p90_percent'] <= 100)
+
+        # Products are summed; an unwatched product adds nothing
+        other = create_product(title='Other')
+        self.assertEqual(self.client.get(reverse('watch-retention'), {'ids': f'{self.product.id},{other.id}'}).data['sessions'], 5)
+        self.assertEqual(self.client.get(reverse('watch-retention'), {'ids': 'x'}).status_code, 400)
+
+
+class AnalyticsReportTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user(username='owner', password='testpassword', is_staff=True))
+        self.first = create_product(title='First')
+        self.second = create_product(title='Second')
+        today = timezone.localdate()
+        for product, day, views, completions in [
+            (self.first, today, 5, 1),
+            (self.first, today - datetime.timedelta(days=10), 50, 10),
+            (self.second, today - datetime.timedelta(days=1), 8, 6),
+        ]:
+            DailyViewRollup.objects.create(
+                product=product, bucket=day, views=views, watch_seconds=views * 10,
+                completions=completions, sessions=views + 2
+            )
+
+    def test_product_report(self):
+        response = self.client.get(reverse('product-analytics', args=[self.first.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['totals']['sessions'], 59)
+        self.assertEqual(response.data['completion_rate'], round(11 / 59 * 100, 2))
+        self.assertEqual(len(response.data['series']), 7)
+        self.assertEqual(response.data['series'][-1]['views'], 5)
+        self.assertEqual(len(self.client.get(reverse('product-analytics', args=[self.first.id]), {'window': '24h'}).data['series']), 24)
+
+        # Cached: the product and the rollup watermark are all that's read
+        with self.assertNumQueries(2):
+            self.client.get(reverse('product-analytics', args=[self.first.id]))
+        self.assertEqual(self.client.get(reverse('product-analytics', args=[0])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('product-analytics', args=[self.first.id]), {'window': '7w'}).status_code, 400)
+
+    def test_reports_are_for_staff_only(self):
+        shop_user = APIClient()
+        shop_user.force_authenticate(User.objects.create_user(username='shopkeeper', password='testpassword'))
+        for url in [
+            reverse('product-analytics', args=[self.first.id]), reverse('analytics-leaderboard'),
+            reverse('unique-viewers'), reverse('watch-retention'),
+        ]:
+            self.assertEqual(shop_user.get(url).status_code, 403)
+            self.assertEqual(APIClient().get(url).status_code, 401)
+
+    def test_leaderboard(self):
+        url = reverse('analytics-leaderboard')
+        results = self.client.get(url, {'metric': 'views', 'window': '7d'}).data['results']
+        self.assertEqual([(r['rank'], r['product_id'], r['value']) for r in results], [(1, self.second.id, 8), (2, self.first.id, 5)])
+        self.assertEqual(results[0]['title'], 'Second')
+
+        results = self.client.get(url, {'metric': 'completion_rate', 'window': '30d', 'limit': 1}).data['results']
+        self.assertEqual([(r['product_id'], r['value']) for r in results], [(self.second.id, 60.0)])
+
+        # Reports are rebuilt once the rollups move on
+        DailyViewRollup.objects.filter(product=self.first, bucket=timezone.localdate()).update(views=100)
+        self.assertEqual(self.client.get(url).data['results'][0]['product_id'], self.second.id)
+        RollupWatermark.objects.create(name=rollups.WATERMARK, position=timezone.now())
+        self.assertEqual(self.client.get(url).data['results'][0]['product_id'], self.first.id)
+
+        self.assertEqual(self.client.get(url, {'metric': 'likes'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'window': '400d'}).status_code, 400)
+        self.client.force_authenticate(None)
+        self.assertEqual(self.client.get(url).status_code, 401)
+
+
+class DeviceDimensionTests(TestCase):
+    def test_user_agents_are_parsed_and_deduplicated(self):
+        self.assertEqual(devices.parse_user_agent(PHONE_USER_AGENT), {
+            'platform': 'web', 'os': 'iOS', 'browser': 'Safari', 'app_version': '', 'form_factor': 'mobile'
+        })
+        self.assertEqual(devices.parse_user_agent('Flicks/2.4.1 (Android 14; Pixel 8) Mobile'), {
+            'platform': 'app', 'os': 'Android', 'browser': '', 'app_version': '2.4.1', 'form_factor': 'mobile'
+        })
+        self.assertEqual(devices.parse_user_agent(TABLET_USER_AGENT)['form_factor'], 'tablet')
+
+        # Different strings with the same dimensions share one row
+        other_phone = PHONE_USER_AGENT.replace('17_2', '16_0')
+        self.assertEqual(devices.device_id(PHONE_USER_AGENT), devices.device_id(other_phone))
+        self.assertNotEqual(devices.device_id(PHONE_USER_AGENT), devices.device_id(TABLET_USER_AGENT))
+        self.assertEqual(Device.objects.count(), 2)
+
+    def test_sessions_reference_devices(self):
+        product = create_product()
+        Product.objects.filter(pk=product.pk).update(flicks='products/videos/clip.mp4')
+        for user_agent in (PHONE_USER_AGENT, PHONE_USER_AGENT, TABLET_USER_AGENT):
+            APIClient(HTTP_USER_AGENT=user_agent).post(reverse('start-view'), {'product_id': product.id}, format='json')
+        session = ViewSession.objects.first()
+        self.assertEqual((session.device.os, session.device_info), ('iOS', {}))
+        self.assertEqual(devices.device_breakdown(product.view_sessions.all()), [
+            {'device__form_factor': 'mobile', 'sessions': 2},
+            {'device__form_factor': 'tablet', 'sessions': 1},
+        ])
+
+        # Older sessions keep the raw user agent until backfilled
+        old = ViewSession.objects.create(product=product, session_id='old', device_info={'user_agent': TABLET_USER_AGENT})
+        call_command('backfill_session_devices', stdout=StringIO())
+        old.refresh_from_db()
+        self.assertEqual((old.device.form_factor, old.device_info), ('tablet', {}))
+        self.assertEqual(Device.objects.count(), 2)
+
+
+class EventSpoolTests(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.addCleanup(event_spool.writer.close)
+        settings = self.settings(ANALYTICS_SPOOL_ENABLED=True, ANALYTICS_SPOOL_DIR=directory, ANALYTICS_FLUSH_INTERVAL=0)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.directory = directory
+        self.client = APIClient(HTTP_USER_AGENT=PHONE_USER_AGENT)
+        self.product = create_product()
+        Product.objects.filter(pk=self.product.pk).update(flicks='products/videos/clip.mp4', video_duration=20)
+
+    def test_requests_are_spooled_then_loaded_once(self):
+        session_id = self.client.post(reverse('start-view'), {'product_id': self.product.id}, format='json').data['session_id']
+        response = self.client.post(
+            reverse('end-view'), {'session_id': session_id, 'duration': 12, 'percent_watched': 90}, format='json'
+        )
+        self.assertEqual((response.data['status'], response.data['completed']), ('success', True))
+        results = self.client.post(reverse('analytics-events'), {'events': [
+            {'type': 'start', 'product_id': self.product.id, 'session_id': 'batched'},
+            {'type': 'end', 'session_id': 'batched', 'duration': 5, 'percent_watched': 20},
+            {'type': 'start'},
+        ]}, format='json').data['results']
+        self.assertEqual([r['status'] for r in results], ['accepted', 'accepted', 'error'])
+        # Nothing reached the database
+        self.assertFalse(ViewSession.objects.exists())
+
+        event_spool.writer.close()
+        [segment] = event_spool.closed_segments(self.directory)
+        self.assertEqual(len(list(event_spool.read_segment(segment))), 3)
+        shutil.copy(segment, segment + '.copy')
+
+        out = StringIO()
+        call_command('load_analytics_spool', '--dir', self.directory, stdout=out)
+        self.assertIn('Loaded 3 records from 1 spool segments', out.getvalue())
+        self.assertEqual(os.listdir(self.directory), [os.path.basename(segment) + '.copy'])
+        session = ViewSession.objects.get(session_id=session_id)
+        self.assertEqual((session.duration, session.completed, session.device.os), (12, True, 'iOS'))
+        self.assertLess(session.start_time, session.end_time)
+        self.assertEqual(FlicksAnalytics.objects.get(product=self.product).views, 2)
+
+        # Loading the same segment again changes nothing
+        os.rename(segment + '.copy', segment)
+        self.assertEqual(event_spool.load_spool(self.directory), (0, 0))
+        self.assertEqual(SpoolCheckpoint.objects.count(), 1)
+        self.assertEqual(FlicksAnalytics.objects.get(product=self.product).views, 2)
+
+
+    def test_signed_batches_are_verified_when_spooled(self):
+        with self.settings(ANALYTICS_SIGNED_SESSIONS=True):
+            [start] = self.client.post(reverse('analytics-events'), {'events': [
+                {'type': 'start', 'product_id': self.product.id},
+            ]}, format='json').data['results']
+            results = self.client.post(reverse('analytics-events'), {'events': [
+                {'type': 'heartbeat', 'session_id': start['session_id'], 'duration': 3},
+                {'type': 'end', 'session_id': start['session_id'], 'duration': 12, 'percent_watched': 90},
+                {'type': 'end', 'session_id': start['session_id'][:-2] + 'xx', 'duration': 12},
+            ]}, format='json').data['results']
+        self.assertEqual([r['status'] for r in results], ['accepted', 'accepted', 'error'])
+
+        # Only the end is spooled, after the start it implies
+        event_spool.writer.close()
+        event_spool.load_spool(self.directory)
+        session = ViewSession.objects.get()
+        self.assertEqual((session.duration, session.completed), (12, True))
+        self.assertLess(session.start_time, session.end_time)
+
+    def test_ends_loaded_before_their_start_are_retried(self):
+        start = {'at': timezone.now().isoformat(), 'user_id': None, 'ip_address': '10.0.0.1', 'user_agent': '',
+                 'events': [{'type': 'start', 'product_id': self.product.id, 'session_id': 'late'}]}
+        end = {**start, 'events': [{'type': 'end', 'session_id': 'late', 'duration': 8, 'percent_watched': 40}]}
+        # Another process's older segment holds the end
+        for name, record in (('1-1-1.jsonl', end), ('2-2-1.jsonl', start)):
+            with open(os.path.join(self.directory, name), 'wb') as segment:
+                segment.write(json.dumps(record).encode() + b'\n')
+
+        self.assertEqual(event_spool.load_spool(self.directory), (2, 2))
+        self.assertIsNone(ViewSession.objects.get(session_id='late').end_time)
+        self.assertEqual(event_spool.load_spool(self.directory), (1, 1))
+        self.assertEqual(ViewSession.objects.get(session_id='late').duration, 8)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    @override_settings(STORAGES=TEST_STORAGES)
+    def test_spooled_sessions_are_rolled_up_after_loading(self):
+        self.client.post(reverse('analytics-events'), {'events': [
+            {'type': 'start', 'product_id': self.product.id, 'session_id': 'spooled'},
+            {'type': 'end', 'session_id': 'spooled', 'duration': 12, 'percent_watched': 90},
+        ]}, format='json')
+        event_spool.writer.close()
+
+        # The rollups move past the request time before the segment is loaded
+        later = timezone.now() + datetime.timedelta(minutes=5)
+        rollups.run_rollups(now=later)
+        with mock.patch('django.utils.timezone.now', return_value=later):
+            event_spool.load_spool(self.directory)
+        session = ViewSession.objects.get()
+        self.assertLess(session.end_time, RollupWatermark.objects.get(name=rollups.WATERMARK).position)
+
+        # Not rolled up yet, so retention keeps it
+        self.assertEqual(retention.prune_sessions(cutoff=later + datetime.timedelta(days=1)), 0)
+        rollups.run_rollups(now=later + datetime.timedelta(minutes=5))
+        self.assertEqual(rollups.product_totals(self.product)['views'], 1)
+        self.assertEqual(retention.prune_sessions(cutoff=later + datetime.timedelta(days=1)), 1)
+
+
+@override_settings(STORAGES=TEST_STORAGES)
+class TrendingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='trends', password='testpassword')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.products = [create_product(title=f'Trending {i}') for i in range(3)]
+        self.now = timezone.now()
+
+    def watch(self, product, hours_ago, count=1, completed=False):
+        start = self.now - datetime.timedelta(hours=hours_ago)
+        end = start + datetime.timedelta(seconds=20)
+        for _ in range(count):
+            ViewSession.objects.create(
+                product=product, session_id=f'session-{ViewSession.objects.count()}', start_time=start,
+                end_time=end, recorded_at=end, duration=20, completed=completed
+            )
+
+    def test_recent_engagement_outranks_older(self):
+        old, recent, _ = self.products
+        self.watch(old, 72, count=4)
+        self.watch(recent, 3, count=2, completed=True)
+
+        out = StringIO()
+        call_command('compute_trending', stdout=out)
+        self.assertIn('2 products', out.getvalue())
+        self.assertEqual(trending.ranked_ids(), [recent.id, old.id])
+        # Three half-lives old: an eighth of the engagement, give or take the start-hour rounding
+        self.assertAlmostEqual(
+            TrendingScore.objects.get(product=old).score,
+            4 * trending.engagement({'views': 1, 'completions': 0, 'watch_seconds': 20}) / 8,
+            delta=0.2
+        )
+
+    def test_scores_decay_between_runs(self):
+        product = self.products[0]
+        self.watch(product, 1, count=3)
+        trending.run_trending(now=self.now)
+        score = TrendingScore.objects.get(product=product).score
+
+        # A day later with nothing new, the score has halved and sessions aren't counted twice
+        trending.run_trending(now=self.now + datetime.timedelta(hours=24))
+        self.assertAlmostEqual(TrendingScore.objects.get(product=product).score, score / 2)
+        self.assertEqual(
+            RollupWatermark.objects.get(name=trending.WATERMARK).position,
+            self.now + datetime.timedelta(hours=24) - datetime.timedelta(seconds=rollups.rollup_lag())
+        )
+
+    def test_trending_list_reads_ranking_after_pins(self):
+        first, second, pinned = self.products
+        self.watch(first, 1, count=3)
+        self.watch(second, 1, count=1)
+        FeaturedProduct.objects.create(product=pinned, featured_type='trending', display_order=0)
+        with self.captureOnCommitCallbacks(execute=True):
+            trending.run_trending(now=self.now)
+
+        response = self.client.get(reverse('trending-products'))
+        self.assertEqual([p['title'] for p in response.json()], ['Trending 2', 'Trending 0', 'Trending 1'])
+
+        # A new ranking changes the list's ETag
+        etag = response['ETag']
+        self.watch(second, 0, count=10)
+        with self.captureOnCommitCallbacks(execute=True):
+            trending.run_trending(now=self.now + datetime.timedelta(minutes=5))
+        response = self.client.get(reverse('trending-products'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([p['title'] for p in response.json()], ['Trending 2', 'Trending 1', 'Trending 0'])
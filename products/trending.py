@@ -0,0 +1,116 @@
+"""
+Engagement-driven trending ranking.
+
+Every product has a TrendingScore: the sum of the engagement of its view
+sessions (views, completions and watch time), each weighted by
+2 ** -(age / half-life). Because the weight decays exponentially, the scores
+are maintained incrementally: compute_trending multiplies every stored score
+by the decay since the previous run, then adds the engagement of sessions
+that ended since then (one GROUP BY, shared with the rollups). The top
+SNAPSHOT_SIZE products are then ranked, and the trending list is built from
+that snapshot, after the products manually pinned with FeaturedProduct
+(see featured.trending_product_ids).
+"""
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from . import featured
+from .models import CatalogVersion, RollupWatermark, TrendingScore
+from .rollups import aggregate_sessions, rollup_lag
+
+WATERMARK = 'trending'
+
+# Engagement of a product in a bucket = views + weighted completions + weighted watch minutes
+COMPLETION_WEIGHT = 2.0
+WATCH_MINUTE_WEIGHT = 0.5
+
+# Products ranked in each snapshot
+SNAPSHOT_SIZE = 100
+
+# Scores that have decayed below this are dropped
+MIN_SCORE = 0.01
+
+# Sessions counted on the first run
+SEED_WINDOW = timedelta(days=7)
+
+
+def half_life():
+    return timedelta(hours=getattr(settings, 'ANALYTICS_TRENDING_HALF_LIFE_HOURS', 24))
+
+
+def decay(age):
+    """Weight of engagement `age` old"""
+    return 0.5 ** (max(age, timedelta(0)) / half_life())
+
+
+def engagement(row):
+    return (
+        row['views']
+        + COMPLETION_WEIGHT * row['completions']
+        + WATCH_MINUTE_WEIGHT * row['watch_seconds'] / 60
+    )
+
+
+def session_scores(start, end):
+    """{product id: decayed engagement at `end`} of the sessions whose end was recorded in (start, end]"""
+    scores = {}
+    for row in aggregate_sessions(start, end):
+        # Sessions are timed by the hour they started in
+        score = engagement(row) * decay(end - row['hour'])
+        scores[row['product_id']] = scores.get(row['product_id'], 0) + score
+    return scores
+
+
+def ranked_ids(limit=SNAPSHOT_SIZE):
+    return list(
+        TrendingScore.objects.filter(rank__isnull=False).order_by('rank').values_list('product_id', flat=True)[:limit]
+    )
+
+
+def store_snapshot():
+    """Rank the top-scoring products; returns whether the ranking changed"""
+    previous = ranked_ids()
+    top = list(
+        TrendingScore.objects.filter(score__gte=MIN_SCORE)
+        .order_by('-score', 'product_id')
+        .values_list('pk', 'product_id')[:SNAPSHOT_SIZE]
+    )
+    TrendingScore.objects.filter(rank__isnull=False).update(rank=None)
+    for rank, (pk, _) in enumerate(top, start=1):
+        TrendingScore.objects.filter(pk=pk).update(rank=rank)
+    return [product_id for _, product_id in top] != previous
+
+
+def run_trending(now=None):
+    """Bring the scores up to date and store a new snapshot; returns the number of products scored"""
+    end = (now or timezone.now()) - timedelta(seconds=rollup_lag())
+    RollupWatermark.objects.get_or_create(name=WATERMARK)
+
+    with transaction.atomic():
+        watermark = RollupWatermark.objects.select_for_update().get(name=WATERMARK)
+        start = watermark.position or end - SEED_WINDOW
+        if start >= end:
+            return 0
+
+        TrendingScore.objects.update(score=F('score') * decay(end - start))
+        TrendingScore.objects.filter(score__lt=MIN_SCORE).delete()
+
+        scores = session_scores(start, end)
+        TrendingScore.objects.bulk_create(
+            [TrendingScore(product_id=product_id) for product_id in scores],
+            ignore_conflicts=True
+        )
+        for product_id, score in scores.items():
+            TrendingScore.objects.filter(product_id=product_id).update(score=F('score') + score)
+
+        watermark.position = end
+        watermark.save()
+
+        if store_snapshot():
+            # A new ranking is a new trending list: new ETags, and a rebuilt cached list
+            CatalogVersion.bump()
+            featured.schedule_rebuild(['trending'])
+    return len(scores)
+
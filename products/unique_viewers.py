@@ -0,0 +1,111 @@
+"""
+Unique-viewer estimates.
+
+Every counted view adds its viewer (the user id, or the IP address and raw
+user agent of an anonymous viewer) to HyperLogLog sketches: one per product on
+FlicksAnalytics, and one on each HourlyViewRollup and DailyViewRollup row,
+bucketed by session start like the other rollup totals. Viewers are buffered
+with the view counters and merged into the stored sketches when the buffer
+flushes. Estimates merge stored sketches (one per product, or one per product
+and day), so they cost the same however many sessions there were.
+"""
+import math
+from collections import defaultdict
+from datetime import timedelta
+from django.db import transaction
+from django.utils import timezone
+from .hyperloglog import HyperLogLog, hash_value
+from .models import FlicksAnalytics, HourlyViewRollup, DailyViewRollup
+
+# Estimates are reported with bounds of this many standard errors (~95% confidence)
+BOUND_ERRORS = 2
+
+
+def viewer_hash(user_id, ip_address, user_agent):
+    if user_id:
+        return hash_value(f'user:{user_id}')
+    return hash_value(f'anon:{ip_address or ""}:{user_agent or ""}')
+
+
+def session_viewer(session, user_agent=None):
+    """
+    (start hour, viewer hash) of a ViewSession, as buffered with its view.
+
+    Anonymous viewers are told apart by the raw user agent of the client
+    (`user_agent`, or the one sessions from before the Device table kept), not
+    by their Device: many people share a coarse device behind one IP address.
+    """
+    hour = timezone.localtime(session.start_time).replace(minute=0, second=0, microsecond=0)
+    if user_agent is None:
+        user_agent = (session.device_info or {}).get('user_agent')
+    return hour, viewer_hash(session.user_id, session.ip_address, user_agent)
+
+
+def merge_sketches(model, sketches, key_fields):
+    """Merge {key: HyperLogLog} into the unique_viewers sketches of the model's rows with those keys"""
+    model.objects.bulk_create(
+        [model(**dict(zip(key_fields, key))) for key in sketches],
+        ignore_conflicts=True
+    )
+    # One locked read for all the rows (and possibly a few others sharing a product or bucket)
+    rows = (
+        model.objects.select_for_update()
+        .filter(**{f'{field}__in': {key[i] for key in sketches} for i, field in enumerate(key_fields)})
+        .order_by('pk')
+        .values_list('pk', *key_fields, 'unique_viewers')
+    )
+    for pk, *key, stored in rows:
+        sketch = sketches.get(tuple(key))
+        if sketch is None:
+            continue
+        if stored:
+            sketch.merge(HyperLogLog.from_bytes(stored))
+        model.objects.filter(pk=pk).update(unique_viewers=sketch.to_bytes())
+
+
+def write_viewers(viewers, product_ids):
+    """Add {(product id, start hour): set of viewer hashes} to the stored sketches of existing products"""
+    hourly, daily, overall = {}, {}, {}
+    for (product_id, hour), hashes in viewers.items():
+        if product_id not in product_ids:
+            continue
+        for sketches, key in (
+            (hourly, (product_id, hour)),
+            (daily, (product_id, timezone.localdate(hour))),
+            (overall, (product_id,)),
+        ):
+            sketch = sketches.setdefault(key, HyperLogLog())
+            for hashed in hashes:
+                sketch.add_hash(hashed)
+
+    with transaction.atomic():
+        merge_sketches(FlicksAnalytics, overall, ['product_id'])
+        merge_sketches(HourlyViewRollup, hourly, ['product_id', 'bucket'])
+        merge_sketches(DailyViewRollup, daily, ['product_id', 'bucket'])
+
+
+def viewer_sketch(product_ids=None, days=None):
+    """
+    Union of the viewer sketches of some products (all when None), over all
+    time or over the last `days` days
+    """
+    if days is None:
+        rows = FlicksAnalytics.objects.all()
+    else:
+        rows = DailyViewRollup.objects.filter(bucket__gt=timezone.localdate() - timedelta(days=days))
+    if product_ids is not None:
+        rows = rows.filter(product_id__in=product_ids)
+    stored = rows.filter(unique_viewers__isnull=False).values_list('unique_viewers', flat=True)
+    return HyperLogLog.union(HyperLogLog.from_bytes(data) for data in stored)
+
+
+def estimate(sketch):
+    """Estimated distinct viewers with the standard error and bounds"""
+    value = sketch.estimate()
+    error = sketch.relative_error
+    return {
+        'unique_viewers': round(value),
+        'relative_error': round(error, 4),
+        'lower_bound': max(0, math.floor(value * (1 - BOUND_ERRORS * error))),
+        'upper_bound': math.ceil(value * (1 + BOUND_ERRORS * error)),
+    }
@@ -22,7 +22,10 @@ urlpatterns = [
     path('products/filter/', api.filter_products, name='filter-products'),
     path('products/<int:product_id>/', api.product_detail, name='product-detail'),    
     path('products/search/', api.search_products, name='search-products'),
+    path('products/suggest/', api.suggest_products, name='suggest-products'),
     path('products/categories/', api.product_categories, name='product-categories'),
+    path('products/facets/', api.product_facets, name='product-facets'),
+    path('products/batch/', api.batch_products, name='batch-products'),
 
     # path('products/age_groups/', api.age_groups, name='product-age-groups'),
     
@@ -33,6 +36,11 @@ urlpatterns = [
     
     path('analytics/start-view/', analytics.start_view_session, name='start-view'),
     path('analytics/end-view/', analytics.end_view_session, name='end-view'),
+    path('analytics/events/', analytics.record_events, name='analytics-events'),
+    path('analytics/unique-viewers/', analytics.unique_viewers, name='unique-viewers'),
+    path('analytics/watch-retention/', analytics.watch_retention, name='watch-retention'),
+    path('analytics/products/<int:product_id>/', analytics.product_analytics, name='product-analytics'),
+    path('analytics/leaderboard/', analytics.analytics_leaderboard, name='analytics-leaderboard'),
 
     path('', api.api_overview, name='api-overview'),
 ]
@@ -3,6 +3,7 @@ import subprocess
 import tempfile
 import logging
 from django.core.files.base import ContentFile
+from django.core.files.images import get_image_dimensions
 
 logger = logging.getLogger(__name__)
 
@@ -85,6 +86,19 @@ def process_video(video_file):
         logger.error(f"Error processing video: {e}")
         return video_file, duration  # Return original file if processing fails
 
+def get_image_size(image_file):
+    """
+    Read the pixel dimensions of an image file
+    
+    Returns: (width, height), or (None, None) if the file can't be read as an image
+    """
+    try:
+        width, height = get_image_dimensions(image_file)
+        return width, height
+    except Exception as e:
+        logger.error(f"Error reading image dimensions: {e}")
+        return None, None
+
 def process_product_image(image_file):
     """
     Process product image to make it 1:1 aspect ratio by cropping
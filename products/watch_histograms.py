@@ -0,0 +1,151 @@
+"""
+Watch-retention histograms.
+
+Every ended view session is counted in two fixed-bucket histograms per
+product, stored on FlicksAnalytics as packed little-endian int64 arrays: one
+by percent of the video watched (5% buckets) and one by seconds watched
+(buckets with the edges in SECONDS_EDGES). Sessions are buffered with the
+view counters and added to the stored arrays when the buffer flushes.
+
+Percentiles and drop-off curves are computed from the histograms alone;
+histograms of many products are summed as one numpy array.
+"""
+import numpy as np
+from django.db import transaction
+from .models import FlicksAnalytics
+
+PERCENT_BUCKET_SIZE = 5
+PERCENT_BUCKETS = 100 // PERCENT_BUCKET_SIZE  # the last bucket includes 100%
+
+# Lower edges (seconds) of every bucket after [0, 1); the last bucket is open-ended
+SECONDS_EDGES = np.array([1, 2, 3, 4, 5, 6, 8, 10, 12, 15, 20, 25, 30, 45, 60, 90, 120, 180, 300, 600])
+SECONDS_BUCKETS = len(SECONDS_EDGES) + 1
+
+DTYPE = np.dtype('<i8')
+
+
+def percent_bucket_edges():
+    return np.arange(PERCENT_BUCKETS + 1) * PERCENT_BUCKET_SIZE
+
+
+def seconds_bucket_edges():
+    return np.concatenate(([0], SECONDS_EDGES))
+
+
+def to_number(value):
+    """A client-reported duration or percentage as a non-negative float (0 when malformed)"""
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return 0.0
+    return value if value > 0 else 0.0
+
+
+def bucket_counts(watched):
+    """(percent counts, seconds counts) of a list of (seconds, percent) pairs"""
+    watched = np.asarray(watched, dtype=float).reshape(-1, 2)
+    seconds = np.searchsorted(SECONDS_EDGES, watched[:, 0], side='right')
+    percent = np.minimum(watched[:, 1] // PERCENT_BUCKET_SIZE, PERCENT_BUCKETS - 1).astype(int)
+    return (
+        np.bincount(percent, minlength=PERCENT_BUCKETS).astype(DTYPE),
+        np.bincount(seconds, minlength=SECONDS_BUCKETS).astype(DTYPE),
+    )
+
+
+def pack(counts):
+    return counts.astype(DTYPE).tobytes()
+
+
+def unpack(data, size):
+    if not data:
+        return np.zeros(size, dtype=DTYPE)
+    return np.frombuffer(bytes(data), dtype=DTYPE).copy()
+
+
+def write_histograms(watched, product_ids):
+    """
+    Add {product id: [(seconds, percent), ...]} to the stored histograms of
+    existing products. Runs in the transaction of the counter flush
+    (analytics_buffer.write_increments), so a failure here rolls the
+    counters back with it.
+    """
+    watched = {product_id: pairs for product_id, pairs in watched.items() if pairs and product_id in product_ids}
+    if not watched:
+        return
+    with transaction.atomic():
+        FlicksAnalytics.objects.bulk_create(
+            [FlicksAnalytics(product_id=product_id) for product_id in watched],
+            ignore_conflicts=True
+        )
+        rows = (
+            FlicksAnalytics.objects.select_for_update()
+            .filter(product_id__in=watched)
+            .order_by('pk')
+            .values_list('pk', 'product_id', 'percent_histogram', 'seconds_histogram')
+        )
+        for pk, product_id, percent_data, seconds_data in rows:
+            percent, seconds = bucket_counts(watched[product_id])
+            FlicksAnalytics.objects.filter(pk=pk).update(
+                percent_histogram=pack(unpack(percent_data, PERCENT_BUCKETS) + percent),
+                seconds_histogram=pack(unpack(seconds_data, SECONDS_BUCKETS) + seconds),
+            )
+
+
+def histograms(product_ids=None):
+    """Summed (percent counts, seconds counts) of some products, all when None"""
+    rows = FlicksAnalytics.objects.filter(percent_histogram__isnull=False)
+    if product_ids is not None:
+        rows = rows.filter(product_id__in=product_ids)
+    stored = list(rows.values_list('percent_histogram', 'seconds_histogram'))
+    if not stored:
+        return np.zeros(PERCENT_BUCKETS, dtype=DTYPE), np.zeros(SECONDS_BUCKETS, dtype=DTYPE)
+    percent = np.vstack([unpack(data, PERCENT_BUCKETS) for data, _ in stored]).sum(axis=0)
+    seconds = np.vstack([unpack(data, SECONDS_BUCKETS) for _, data in stored]).sum(axis=0)
+    return percent, seconds
+
+
+def percentile(counts, edges, q):
+    """
+    The q-th percentile of a histogram, interpolated linearly within its bucket.
+
+    `edges` are the lower edges of the buckets plus the upper edge of the last
+    one; an open-ended last bucket has only its lower edge, which is returned.
+    """
+    total = counts.sum()
+    if not total:
+        return None
+    cumulative = np.cumsum(counts)
+    rank = total * q / 100
+    index = int(np.searchsorted(cumulative, rank, side='left'))
+    if index + 1 >= len(edges):
+        return float(edges[index])
+    before = cumulative[index - 1] if index else 0
+    share = (rank - before) / counts[index] if counts[index] else 0
+    return round(float(edges[index] + share * (edges[index + 1] - edges[index])), 2)
+
+
+def drop_off(counts, edges):
+    """Share of sessions that watched at least each bucket's lower edge"""
+    total = counts.sum()
+    if not total:
+        return []
+    # Sessions in bucket i or later reached edge i
+    reached = np.cumsum(counts[::-1])[::-1] / total
+    return [{'at': int(edge), 'retained': round(float(share), 4)} for edge, share in zip(edges, reached)]
+
+
+def watch_stats(product_ids=None):
+    percent, seconds = histograms(product_ids)
+    percent_edges = percent_bucket_edges()
+    seconds_edges = seconds_bucket_edges()
+    return {
+        'sessions': int(percent.sum()),
+        'p50_seconds': percentile(seconds, seconds_edges, 50),
+        'p90_seconds': percentile(seconds, seconds_edges, 90),
+        'p50_percent': percentile(percent, percent_edges, 50),
+        'p90_percent': percentile(percent, percent_edges, 90),
+        'percent_drop_off': drop_off(percent, percent_edges),
+        'seconds_drop_off': drop_off(seconds, seconds_edges),
+        'percent_histogram': percent.tolist(),
+        'seconds_histogram': seconds.tolist(),
+    }